@@ -1,31 +1,50 @@
+import concurrent.futures
+import contextlib
 import datetime
 import functools
+import hashlib
 import json
 import logging
-import logging.handlers
+import math
 import os
 import queue
 import re
 import subprocess
+import threading
 import time
 import uuid
+import zipfile
 
 import flask
 import humanize
 import pygeoprocessing
 import pygeoprocessing.geoprocessing
 import requests
-import shapely.prepared
-import shapely.wkb
-import yaml
+import shapely
+import shapely.geometry
+import shapely.validation
 from flask import jsonify
 from flask import request
 from flask_cors import CORS
-from google.cloud import storage
 from osgeo import gdal
-from osgeo import ogr
 from osgeo import osr
 
+import estimate
+import gdal_profile
+import jobs
+import metadata_cache
+import metrics
+import output_format
+import preview
+import progress
+import raster_clip
+import remote
+import result_cache
+import single_flight
+import sqlite_cache
+import upload
+import vector_clip
+
 app = flask.Flask(__name__, template_folder='templates')
 
 cors_origins = [
@@ -47,25 +66,31 @@ CORS(app, resources={
 
 logging.basicConfig(level=logging.DEBUG)
 
-# PLAN: write a logging handler to listen for progress messages and send those
-# to the client.
-
-# TODO: write a logging filter to filter out logging that isn't
-# relevant to the current context (in case we have multiple clipping operations
-# on the same process)
-
+# Progress messages logged by pygeoprocessing are routed to the clip job
+# running on the logging thread, see progress.py.
 SOURCE_LOGGER = logging.getLogger('pygeoprocessing')
 SOURCE_LOGGER.setLevel(logging.DEBUG)
-GOOGLE_STORAGE_URL = 'https://storage.googleapis.com'
+SOURCE_LOGGER.addHandler(progress.ProgressLogHandler())
 DATAHUB_URL = 'https://data.naturalcapitalalliance.stanford.edu'
-TRUSTED_URL_PREFIXES = (
-    f'{GOOGLE_STORAGE_URL}/natcap-data-cache',
-    f'{DATAHUB_URL}/download',
-    'https://data.naturalcapitalproject.stanford.edu/download',
-)
-TARGET_FILE_BUCKET = 'gs://jupyter-app-temp-storage'
+TRUSTED_URL_PREFIXES = remote.TRUSTED_URL_PREFIXES
+# Where clipped files are uploaded: a gs:// bucket or, for local
+# development and testing, a file:// directory.  See upload.py.
+TARGET_FILE_BUCKET = os.environ.get(
+    'UPLOAD_TARGET', 'gs://jupyter-app-temp-storage')
 TARGET_BUCKET_SUBDIR = 'clipped'
 TARGET_DOWNLOAD_URL = f'{DATAHUB_URL}/download/{TARGET_BUCKET_SUBDIR}'
+
+# Identical clips are served from the result cache; see result_cache.py.
+# The backend is one of 'local', 'gcs' or 'none'.
+RESULT_CACHE_BACKEND = os.environ.get('RESULT_CACHE_BACKEND', 'local')
+RESULT_CACHE_MAX_AGE = float(
+    os.environ.get('RESULT_CACHE_MAX_AGE', 24 * 60 * 60))
+RESULT_CACHE_MAX_BYTES = int(
+    os.environ.get('RESULT_CACHE_MAX_BYTES', 10 * 1024**3))
+# Cached clips are only deleted once the URLs handed out for them are at
+# least this many seconds old.
+RESULT_CACHE_URL_LIFETIME = float(
+    os.environ.get('RESULT_CACHE_URL_LIFETIME', result_cache.URL_LIFETIME))
 WORKSPACE_DIR = os.environ.get('WORKSPACE_DIR', os.getcwd())
 app.logger.info("WORKSPACE_DIR: %s", WORKSPACE_DIR)
 pygeoprocessing.geoprocessing._LOGGING_PERIOD = 1.0
@@ -73,128 +98,131 @@ pygeoprocessing.geoprocessing._LOGGING_PERIOD = 1.0
 RASTER = 'raster'
 VECTOR = 'vector'
 
-
+# Raster and vector info is cached on local disk, shared by all workers.
+FILE_INFO_CACHE = sqlite_cache.SQLiteCache(
+    os.path.join(WORKSPACE_DIR, 'metadata-cache.sqlite'), 'file_info',
+    max_entries=int(os.environ.get('INFO_CACHE_MAX_ENTRIES', 1000)),
+    ttl=float(os.environ.get('INFO_CACHE_TTL', 24 * 60 * 60)))
+
+# gdalinfo output for /info is cached the same way.
+GDAL_INFO_CACHE = sqlite_cache.SQLiteCache(
+    os.path.join(WORKSPACE_DIR, 'metadata-cache.sqlite'), 'gdal_info',
+    max_entries=int(os.environ.get('INFO_CACHE_MAX_ENTRIES', 1000)),
+    ttl=float(os.environ.get('INFO_CACHE_TTL', 24 * 60 * 60)))
+
+# Previews for /clip/preview (see preview.py) are cached the same way, in a
+# database of their own, for this many seconds.
+PREVIEW_CACHE_TTL = float(
+    os.environ.get('CLIP_PREVIEW_CACHE_TTL', 24 * 60 * 60))
+PREVIEW_CACHE = sqlite_cache.SQLiteCache(
+    os.path.join(WORKSPACE_DIR, 'preview-cache.sqlite'), 'preview',
+    max_entries=int(os.environ.get('CLIP_PREVIEW_CACHE_MAX_ENTRIES', 1000)),
+    ttl=PREVIEW_CACHE_TTL)
+
+# Parsed metadata documents for /metadata, kept in memory.
+METADATA_CACHE = metadata_cache.MetadataCache(
+    fresh_ttl=float(os.environ.get('METADATA_CACHE_FRESH_TTL', 5 * 60)),
+    stale_ttl=float(os.environ.get('METADATA_CACHE_STALE_TTL', 24 * 60 * 60)),
+    max_entries=int(os.environ.get('METADATA_CACHE_MAX_ENTRIES', 500)))
+
+# How long browsers and proxies may cache /info responses, in seconds.
+INFO_CACHE_CONTROL_MAX_AGE = int(
+    os.environ.get('INFO_CACHE_CONTROL_MAX_AGE', 60 * 60))
+
+# The maximum number of files in a single /info/batch request.
+INFO_BATCH_MAX_FILES = 32
+
+# Seconds between keepalive comments on an idle progress stream.
+SSE_KEEPALIVE_PERIOD = 15
+
+# Large clips (see estimate.py) run in at most this many slots per worker, and
+# wait up to LARGE_CLIP_WAIT seconds for one to be free.
+LARGE_CLIP_SLOTS = threading.BoundedSemaphore(
+    int(os.environ.get('CLIP_LARGE_SLOTS', 1)))
+LARGE_CLIP_WAIT = float(os.environ.get('CLIP_LARGE_WAIT', 10 * 60))
+
+# Clips of at most INLINE_MAX_BYTES may be returned in the /clip response
+# rather than through the bucket.
+INLINE_MAX_BYTES = int(os.environ.get('CLIP_INLINE_MAX_BYTES', 32 * 1024**2))
+INLINE_CHUNK_SIZE = 1024**2
+INLINE_MIMETYPES = {
+    '.tif': 'image/tiff; application=geotiff',
+    '.fgb': 'application/flatgeobuf',
+    '.gpkg': 'application/geopackage+sqlite3',
+    '.parquet': 'application/vnd.apache.parquet',
+}
+
+# Areas of interest (target_aoi) may have at most this many vertices.
+AOI_MAX_VERTICES = int(os.environ.get('CLIP_AOI_MAX_VERTICES', 100000))
+
+# Batch clips run up to BATCH_CLIP_WORKERS of their layers at once.
+BATCH_CLIP_WORKERS = int(os.environ.get('BATCH_CLIP_WORKERS', 4))
+BATCH_CLIP_MAX_LAYERS = 50
+
+# Coalesces identical clips requested at the same time, across the workers
+# of this host by default.  Set SINGLE_FLIGHT_URL to a redis:// URL to
+# coalesce across hosts.
+SINGLE_FLIGHT = single_flight.get_single_flight(
+    lock_dir=os.path.join(WORKSPACE_DIR, 'single-flight'))
+
+# Clips submitted through /clip/jobs are run by a bounded pool of threads so
+# that a handful of large clips can't tie up every gunicorn worker.
+JOB_QUEUE = jobs.JobQueue(
+    jobs.get_job_store(),
+    max_workers=int(os.environ.get('CLIP_JOB_WORKERS', 2)),
+    max_pending=int(os.environ.get('CLIP_JOB_MAX_PENDING', 20)))
+
+
+@functools.lru_cache(maxsize=256)
 def _epsg_to_wkt(epsg_code):
     srs = osr.SpatialReference()
     srs.ImportFromEPSG(int(epsg_code))
     return srs.ExportToWkt()
 
 
-def _clip_vector_to_bounding_box(
-        source_vector_path, target_bounding_box, target_vector_path,
-        target_projection_wkt=None):
-    """Clip a vector to the intersection of a target bounding box.
+def cached_file_info(vsi_file_path, file_type):
+    """Get the pygeoprocessing info of a raster or vector.
 
-    Optionally also reproject the vector.
+    Results are kept in a cache shared by all workers on this host and are
+    revalidated against the version (GCS generation or ETag) of the remote
+    object, so a replaced object is read again.
 
     Args:
-        source_vector_path (str): path to a FlatGeobuf to be clipped.
-        target_bounding_box (list): list of the form [xmin, ymin, xmax, ymax]
-        target_vector_path (str): path to a FlatGeobuf to store the clipped
-            vector.
-        target_projection_wkt=None (str): target projection in wkt. Can be
-            none to indicate no reprojection is required.
+        vsi_file_path (str): the ``/vsicurl/`` path of the file.
+        file_type (str): ``raster`` or ``vector``.
 
     Returns:
-        None
+        The dict returned by ``pygeoprocessing.get_raster_info`` or
+        ``pygeoprocessing.get_vector_info``.
     """
-    shapely_mask = shapely.prepared.prep(
-        shapely.geometry.box(*target_bounding_box))
-
-    app.logger.debug("Opening base vector...")
-    base_vector = gdal.OpenEx(source_vector_path, gdal.OF_VECTOR)
-    base_layer = base_vector.GetLayer()
-    base_layer.SetSpatialFilterRect(*target_bounding_box)
-    base_layer_defn = base_layer.GetLayerDefn()
-    base_geom_type = base_layer.GetGeomType()
-    base_srs = base_layer.GetSpatialRef()
-
-    if target_projection_wkt is not None:
-        target_srs = osr.SpatialReference()
-        target_srs.ImportFromWkt(target_projection_wkt)
-        coord_trans = osr.CreateCoordinateTransformation(base_srs, target_srs)
-    else:
-        target_srs = base_srs
-
-    app.logger.debug("Setting up target...")
-    target_driver = gdal.GetDriverByName('FlatGeobuf')
-    target_vector = target_driver.Create(
-        target_vector_path, 0, 0, 0, gdal.GDT_Unknown)
-    target_layer = target_vector.CreateLayer(
-        base_layer_defn.GetName(), target_srs, base_geom_type)
-    target_layer.CreateFields(base_layer.schema)
-
-    app.logger.debug("Clipping vector...")
-    target_layer.StartTransaction()
-    invalid_feature_count = 0
-    n_processed = 0
-    last_log_msg_time = time.time()
-    for feature in base_layer:
-        now = time.time()
-        if now >= last_log_msg_time+2.0:
-            app.logger.debug(f"Processed {n_processed} features so far")
-            last_log_msg_time = now
-        n_processed += 1
-
-        invalid = False
-        geometry = feature.GetGeometryRef()
-        try:
-            shapely_geom = shapely.wkb.loads(bytes(geometry.ExportToWkb()))
-        # Catch invalid geometries that cannot be loaded by Shapely;
-        # e.g. polygons with too few points for their type
-        except shapely.errors.ShapelyError:
-            invalid = True
-        else:
-            if shapely_geom.is_valid:
-                # Check for intersection rather than use gdal.Layer.Clip()
-                # to preserve the shape of the polygons
-                if shapely_mask.intersects(shapely_geom):
-                    # This appears to use the network WAY less
-                    new_feature = ogr.Feature.Clone(feature)
-
-                    # If we need to, transform the geometry
-                    if target_projection_wkt is not None:
-                        geometry.Transform(coord_trans)
-                        new_feature.SetGeometry(geometry)
-
-                    target_layer.CreateFeature(new_feature)
-            else:
-                invalid = True
-        finally:
-            if invalid:
-                invalid_feature_count += 1
-                app.logger.warning(
-                    f"The geometry at feature {feature.GetFID()} is invalid "
-                    "and will be skipped.")
-
-    target_layer.CommitTransaction()
-
-    if invalid_feature_count:
-        app.logger.warning(
-            f"{invalid_feature_count} features in {source_vector_path} "
-            "were found to be invalid during clipping and were skipped.")
-
-    base_layer = None
-    base_vector = None
-    target_layer = None
-    target_vector = None
+    cache_key = f'{file_type}:{vsi_file_path}'
+    version = remote.object_version(vsi_file_path)
+    file_info = FILE_INFO_CACHE.get(cache_key, version)
+    metrics.record_cache_lookup('file_info', file_info is not None)
+    if file_info is not None:
+        return file_info
 
-
-@functools.lru_cache
-def cached_file_info(vsi_file_path, file_type):
     app.logger.info(f"Getting file info for {file_type} at {vsi_file_path}")
-    if file_type == RASTER:
-        try:
-            return pygeoprocessing.get_raster_info(vsi_file_path)
-        except Exception:
-            app.logger.error("Failed to read raster info for %s", vsi_file_path)
-            raise
-    elif file_type == VECTOR:
-        try:
-            return pygeoprocessing.get_vector_info(vsi_file_path)
-        except Exception:
-            app.logger.error("Failed to read vector info for %s", vsi_file_path)
-            raise
+    read_path = remote.gdal_path(vsi_file_path)
+    with gdal_profile.config_options():
+        if file_type == RASTER:
+            try:
+                file_info = pygeoprocessing.get_raster_info(read_path)
+                file_info['overview_pixel_sizes'] = (
+                    raster_clip.overview_pixel_sizes(read_path))
+            except Exception:
+                app.logger.error(
+                    "Failed to read raster info for %s", vsi_file_path)
+                raise
+        elif file_type == VECTOR:
+            try:
+                file_info = pygeoprocessing.get_vector_info(read_path)
+            except Exception:
+                app.logger.error(
+                    "Failed to read vector info for %s", vsi_file_path)
+                raise
+    FILE_INFO_CACHE.put(cache_key, file_info, version)
+    return file_info
 
 
 def _align_bbox(bbox, raster_info):
@@ -215,15 +243,19 @@ def _align_bbox(bbox, raster_info):
 
 @app.route('/epsg_info', methods=['GET'])
 def epsg_info():
-    epsg_code = request.args.get('epsg_code')
+    return jsonify(_epsg_info(request.args.get('epsg_code')))
+
+
+def _epsg_info(epsg_code):
+    """Describe an EPSG code for /epsg_info."""
     try:
         epsg_code = int(epsg_code)
-    except ValueError:
-        return jsonify({
+    except (TypeError, ValueError):
+        return {
             "status": "failure",
             "epsg_name": "",
             "srs_units": "",
-        })
+        }
 
     srs = osr.SpatialReference()
     srs.ImportFromEPSG(epsg_code)
@@ -237,35 +269,126 @@ def epsg_info():
         srs_name = f"EPSG:{epsg_code} not recognized"
         srs_units = "unknown"
 
-    return jsonify({
+    return {
         "status": "success",
         "epsg_name": srs_name,
         "srs_units": srs_units,
-    })
+    }
 
 
 @app.route('/metadata', methods=['GET'])
 def metadata():
     file_url = request.args.get('file_url')
 
-    yaml_data = yaml.load(
-        requests.get(f'{file_url}.yml', stream=True).content,
-        Loader=yaml.Loader)
+    try:
+        yaml_data = METADATA_CACHE.get(f'{file_url}.yml')
+    except requests.RequestException as error:
+        app.logger.exception("Failed to fetch metadata for %s", file_url)
+        return jsonify({
+            'status': 'failure',
+            'error': str(error),
+        }), 502
     return yaml_data
 
 
+def _gdal_info(file_url):
+    """Get the ``gdalinfo -json`` output of a remote file.
+
+    Results are cached per URL and revalidated against the version of the
+    remote object.
+    """
+    return _read_gdal_info(
+        file_url, remote.object_version(f'/vsicurl/{file_url}'))
+
+
+def _read_gdal_info(file_url, version):
+    """Get the ``gdalinfo -json`` output of a remote file at a version."""
+    result = GDAL_INFO_CACHE.get(file_url, version)
+    metrics.record_cache_lookup('gdal_info', result is not None)
+    if result is None:
+        result = gdal.Info(f'/vsicurl/{file_url}', options=['-json'])
+        GDAL_INFO_CACHE.put(file_url, result, version)
+    return result
+
+
+def _cacheable_json(payload):
+    """Make a JSON response that browsers and nginx may cache.
+
+    The response has an ``ETag`` computed from its content, and a matching
+    ``If-None-Match`` request header gets a ``304 Not Modified``.
+    """
+    response = jsonify(payload)
+    response.set_etag(hashlib.sha256(
+        json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest())
+    response.cache_control.public = True
+    response.cache_control.max_age = INFO_CACHE_CONTROL_MAX_AGE
+    return response.make_conditional(request)
+
+
 @app.route('/info', methods=['GET'])
-@functools.lru_cache
 def info():
     file_url = request.args.get("file_url")
-    result = gdal.Info(f'/vsicurl/{file_url}', options=['-json'])
+    if not file_url:
+        return jsonify({
+            'status': 'failure',
+            'error': "Missing parameter: file_url",
+        }), 400
+    result = _gdal_info(file_url)
 
-    return jsonify({
+    return _cacheable_json({
         'status': 'success',
         'info': result,
     })
 
 
+@app.route('/info/batch', methods=['GET', 'POST'])
+def info_batch():
+    """Get the info of several files in one round trip.
+
+    The files are given as repeated ``file_url`` query parameters, or as a
+    ``file_urls`` list in a JSON body.  The response maps each URL to its
+    info, or to ``null`` if its info could not be read.
+    """
+    if request.method == 'POST':
+        file_urls = request.get_json().get('file_urls', [])
+    else:
+        file_urls = request.args.getlist('file_url')
+    if not file_urls:
+        return jsonify({
+            'status': 'failure',
+            'error': "Missing parameter: file_url",
+        }), 400
+    if len(file_urls) > INFO_BATCH_MAX_FILES:
+        return jsonify({
+            'status': 'failure',
+            'error': f"At most {INFO_BATCH_MAX_FILES} files may be requested "
+                     "at once",
+        }), 400
+
+    def _info_or_none(file_url):
+        try:
+            return _gdal_info(file_url)
+        except Exception:
+            app.logger.exception("Failed to read info for %s", file_url)
+            return None
+
+    # gdal.Info spends most of its time waiting on the network.
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(len(file_urls), INFO_BATCH_MAX_FILES)) as pool:
+        results = dict(zip(file_urls, pool.map(_info_or_none, file_urls)))
+
+    return _cacheable_json({
+        'status': 'success',
+        'info': results,
+    })
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Serve the metrics of this service; see metrics.py."""
+    return flask.Response(metrics.render(), mimetype=metrics.CONTENT_TYPE)
+
+
 @app.route('/hello')
 def hello_world():
     return 'Hello, World!'
@@ -276,21 +399,217 @@ def clip_app():
     return flask.render_template('clip.html')
 
 
-@app.route("/clip", methods=['POST'])
-def clip():
-    parameters = request.get_json()
-    app.logger.info(parameters)
+def _validate_clip_parameters(parameters):
+    """Check that clip parameters are safe to act on.
 
-    if not parameters['file_url'].startswith(TRUSTED_URL_PREFIXES):
+    Args:
+        parameters (dict): the clip request parameters.
+
+    Raises:
+        ValueError: if the parameters are not valid.
+    """
+    if not remote.is_trusted_url(
+            parameters['file_url'], TRUSTED_URL_PREFIXES):
         app.logger.error("Invalid source file, not from a trusted host: %s",
                          parameters['file_url'])
         raise ValueError("Invalid source file provided.")
 
-    source_file_type = parameters['layer_type']
-    if source_file_type not in [RASTER, VECTOR]:
+    if parameters['layer_type'] not in [RASTER, VECTOR]:
         raise ValueError("Invalid file type.")
 
-    target_bbox = parameters["target_bbox"]
+    if 'target_bbox' in parameters:
+        xmin, ymin, xmax, ymax = _parse_numbers(parameters, 'target_bbox', 4)
+        if xmin > xmax or ymin > ymax:
+            raise ValueError("target_bbox must be [xmin, ymin, xmax, ymax].")
+    if parameters.get('target_aoi') is not None:
+        target_aoi = _parse_aoi(parameters['target_aoi'])
+        if ('target_bbox' in parameters and not shapely.intersects(
+                target_aoi, shapely.box(*parameters['target_bbox']))):
+            raise ValueError("target_aoi does not intersect target_bbox.")
+    elif 'target_bbox' not in parameters:
+        raise KeyError('target_bbox')
+
+    if 'target_cellsize' in parameters:
+        if 0 in _parse_numbers(parameters, 'target_cellsize', 2):
+            raise ValueError("target_cellsize must not be 0.")
+    if 'target_epsg' in parameters:
+        try:
+            _epsg_to_wkt(parameters['target_epsg'])
+        except (TypeError, ValueError, RuntimeError):
+            raise ValueError(
+                f"Invalid target_epsg: {parameters['target_epsg']}")
+
+    _parse_vector_options(parameters)
+    _parse_output(parameters)
+
+
+def _parse_numbers(parameters, name, count):
+    """Get a parameter that is a list of ``count`` numbers.
+
+    Raises:
+        ValueError: if it is not.
+    """
+    value = parameters[name]
+    if (not isinstance(value, list) or len(value) != count or not all(
+            isinstance(number, (int, float)) and not isinstance(number, bool)
+            and math.isfinite(number) for number in value)):
+        raise ValueError(f"{name} must be a list of {count} numbers.")
+    return value
+
+
+def _invalid_parameters(error):
+    """Respond to clip parameters that failed validation.
+
+    Args:
+        error (KeyError or ValueError): as raised by
+            ``_validate_clip_parameters`` and friends.
+
+    Returns:
+        A 400 response with the reason.
+    """
+    if isinstance(error, KeyError):
+        message = f"Missing parameter: {error}"
+    else:
+        message = str(error)
+    return jsonify({
+        'status': 'failure',
+        'error': message,
+    }), 400
+
+
+def _parse_vector_options(parameters):
+    """Get the fields to keep and the simplification tolerance of a clip.
+
+    Returns:
+        A tuple of the list of field names to keep (``None`` for all of
+        them) and the simplification tolerance in target units (``None``
+        to keep the geometries as they are).
+
+    Raises:
+        ValueError: if the options are not valid.
+    """
+    fields = parameters.get('fields')
+    simplify_tolerance = parameters.get('simplify_tolerance')
+    if fields is None and simplify_tolerance is None:
+        return None, None
+    if parameters['layer_type'] != VECTOR:
+        raise ValueError(
+            "fields and simplify_tolerance only apply to vectors.")
+
+    if fields is not None:
+        if (not isinstance(fields, list) or
+                not all(isinstance(field, str) for field in fields)):
+            raise ValueError("fields must be a list of field names.")
+    if simplify_tolerance is not None:
+        try:
+            simplify_tolerance = float(simplify_tolerance)
+        except (TypeError, ValueError):
+            raise ValueError(
+                f"Invalid simplify_tolerance: {simplify_tolerance}")
+        if not simplify_tolerance >= 0:
+            raise ValueError("simplify_tolerance must not be negative.")
+    return fields, simplify_tolerance
+
+
+def _parse_output(parameters):
+    """Get the output format options of a clip; see output_format.py.
+
+    Raises:
+        ValueError: if the options are not valid.
+    """
+    return output_format.parse(
+        parameters['layer_type'], parameters.get('output_format'),
+        parameters.get('compression'), parameters.get('compression_level'))
+
+
+def _parse_preview_size(parameters):
+    """Get the size of a preview; see preview.py.
+
+    Raises:
+        ValueError: if the size is not valid.
+    """
+    size = parameters.get('preview_size', preview.PREVIEW_DEFAULT_SIZE)
+    if (isinstance(size, bool) or not isinstance(size, int) or
+            not 0 < size <= preview.PREVIEW_MAX_SIZE):
+        raise ValueError(
+            "preview_size must be a number of pixels from 1 to "
+            f"{preview.PREVIEW_MAX_SIZE}.")
+    return size
+
+
+def _parse_aoi(geojson):
+    """Parse a GeoJSON polygon or multipolygon area of interest.
+
+    Args:
+        geojson (dict): a GeoJSON geometry, or a Feature with one.
+
+    Returns:
+        A Shapely geometry.
+
+    Raises:
+        ValueError: if it is not a valid polygon or multipolygon.
+    """
+    if isinstance(geojson, dict) and geojson.get('type') == 'Feature':
+        geojson = geojson.get('geometry')
+    try:
+        aoi = shapely.geometry.shape(geojson)
+    except Exception as error:
+        raise ValueError(f"Invalid target_aoi: {error}")
+    if aoi.geom_type not in ('Polygon', 'MultiPolygon') or aoi.is_empty:
+        raise ValueError("target_aoi must be a Polygon or MultiPolygon.")
+    if shapely.get_num_coordinates(aoi) > AOI_MAX_VERTICES:
+        raise ValueError(
+            f"target_aoi may have at most {AOI_MAX_VERTICES} vertices.")
+    if not aoi.is_valid:
+        raise ValueError(
+            f"Invalid target_aoi: {shapely.validation.explain_validity(aoi)}")
+    return aoi
+
+
+@functools.lru_cache(maxsize=256)
+def _transform_bounding_box(bbox, base_projection_wkt, target_projection_wkt):
+    # Cached, since the layers of a batch usually share a projection and the
+    # same bounding box is requested over and over.
+    return tuple(pygeoprocessing.transform_bounding_box(
+        list(bbox), base_projection_wkt, target_projection_wkt))
+
+
+def _prepare_clip(parameters):
+    """Work out how to clip a layer, without touching its data.
+
+    Args:
+        parameters (dict): the clip request parameters.
+
+    Returns:
+        A dict describing the clip: ``source_file_path``,
+        ``source_file_type``, ``source_file_info``, ``source_bbox`` (the
+        requested bounding box, in the source projection), ``target_bbox``
+        (aligned to the source grid for rasters), ``target_cellsize`` and
+        ``overview_level`` (rasters only), ``target_projection_wkt``
+        (``None`` to keep the source projection), ``target_aoi`` (a Shapely
+        polygon in the source projection, or ``None``), ``fields`` and
+        ``simplify_tolerance`` (vectors only), ``output`` (see
+        ``output_format.parse``) and ``target_basename``.
+    """
+    _validate_clip_parameters(parameters)
+    source_file_type = parameters['layer_type']
+    fields, simplify_tolerance = _parse_vector_options(parameters)
+
+    # Clip to the envelope of the area of interest, if there is one; data
+    # outside the area itself are masked out while clipping.
+    target_aoi = None
+    if parameters.get('target_aoi') is not None:
+        target_aoi = _parse_aoi(parameters['target_aoi'])
+        if 'target_bbox' in parameters:
+            target_aoi = shapely.intersection(
+                target_aoi, shapely.box(*parameters['target_bbox']))
+            if target_aoi.is_empty:
+                raise ValueError(
+                    "target_aoi does not intersect target_bbox.")
+        target_bbox = list(target_aoi.bounds)
+    else:
+        target_bbox = parameters["target_bbox"]
+    source_bbox = target_bbox
 
     # align the bounding box
     source_file_path = f'/vsicurl/{parameters["file_url"]}'
@@ -299,126 +618,799 @@ def clip():
         # but leaving this flexible in case we support .geojson again in the future
         source_file_path = os.path.splitext(source_file_path)[0] + '.fgb'
 
-    source_file_info = cached_file_info(source_file_path, source_file_type)
+    with metrics.phase('file_info', source_file_type):
+        source_file_info = cached_file_info(
+            source_file_path, source_file_type)
+
+    try:
+        target_projection_wkt = _epsg_to_wkt(parameters["target_epsg"])
+    except KeyError:
+        target_projection_wkt = None
 
+    target_cellsize = None
+    overview_level = None
     if source_file_type == RASTER:
-        app.logger.info("CLIPPING RASTER...")
-        warping_kwargs = {}
-        try:
-            warping_kwargs['target_projection_wkt'] = _epsg_to_wkt(
-                parameters["target_epsg"])
-            aligned_target_bbox = pygeoprocessing.transform_bounding_box(
-                target_bbox, source_file_info['projection_wkt'],
-                warping_kwargs['target_projection_wkt'])
-        except KeyError:
-            # If we're keeping the same projection, just align the requested bounding
-            # box to the raster's grid.
-            aligned_target_bbox = _align_bbox(target_bbox, source_file_info)
+        with metrics.phase('transform_bbox', source_file_type):
+            if target_projection_wkt is not None:
+                target_bbox = list(_transform_bounding_box(
+                    tuple(target_bbox), source_file_info['projection_wkt'],
+                    target_projection_wkt))
+            else:
+                # If we're keeping the same projection, just align the
+                # requested bounding box to the raster's grid.
+                target_bbox = _align_bbox(target_bbox, source_file_info)
 
         try:
             # Make sure pixel sizes are floats.
             target_cellsize = list(map(float, parameters["target_cellsize"]))
         except KeyError:
-            target_cellsize = source_file_info['pixel_size']
+            target_cellsize = list(source_file_info['pixel_size'])
 
         # make sure the target cell's height is negative
         if not target_cellsize[1] < 0:
             target_cellsize[1] *= -1
 
+        overview_level = raster_clip.choose_overview_level(
+            source_file_info, source_bbox, target_bbox, target_cellsize)
+
+    return {
+        'source_file_path': source_file_path,
+        'source_file_type': source_file_type,
+        'source_file_info': source_file_info,
+        'source_bbox': source_bbox,
+        'target_bbox': target_bbox,
+        'target_cellsize': target_cellsize,
+        'overview_level': overview_level,
+        'target_projection_wkt': target_projection_wkt,
+        'target_aoi': target_aoi,
+        'fields': fields,
+        'simplify_tolerance': simplify_tolerance,
+        'output': _parse_output(parameters),
+        'target_basename': os.path.splitext(
+            os.path.basename(parameters["file_url"]))[0],
+    }
+
+
+def _execute_clip(plan, clip_estimate=None):
+    """Clip a layer into a local file.
+
+    Args:
+        plan (dict): the clip, as returned by ``_prepare_clip``.
+        clip_estimate=None (dict): the clip's estimate, as returned by
+            ``_estimate_clip``, if there is one.
+
+    Returns:
+        The path to the clipped file in ``WORKSPACE_DIR``.
+    """
+    # Read through the range cache, if there is one.
+    source_file_path = remote.gdal_path(plan['source_file_path'])
+    target_basename = plan['target_basename']
+
+    if plan['source_file_type'] == RASTER:
+        app.logger.info("CLIPPING RASTER...")
         try:
             # do the clipping
-            target_basename = os.path.splitext(
-                os.path.basename(parameters["file_url"]))[0]
             target_file_path = os.path.join(
                 WORKSPACE_DIR, f'{target_basename}--{uuid.uuid4()}.tif')
-            pygeoprocessing.warp_raster(
-                source_file_path, target_cellsize, target_file_path, 'near',
-                target_bb=aligned_target_bbox, **warping_kwargs)
+            progress.watch_file(target_file_path)
+            with metrics.phase('clip', RASTER):
+                raster_clip.clip_raster(
+                    source_file_path, plan['target_cellsize'],
+                    target_file_path, plan['target_bbox'],
+                    plan['target_projection_wkt'], plan['overview_level'],
+                    mask_geometry=plan['target_aoi'],
+                    mask_projection_wkt=plan['source_file_info'][
+                        'projection_wkt'],
+                    output_spec=plan['output'])
         except Exception:
             app.logger.exception("Failed to warp raster; aborting")
-            os.remove(target_file_path)
+            if os.path.exists(target_file_path):
+                os.remove(target_file_path)
             raise
 
-    elif source_file_type == VECTOR:
+    elif plan['source_file_type'] == VECTOR:
         app.logger.info("CLIPPING VECTOR...")
-        try:
-            target_projection_wkt = _epsg_to_wkt(
-                parameters["target_epsg"])
-        except KeyError:
-            target_projection_wkt = None
-
         try:
             # do the clipping
-            target_basename = os.path.splitext(
-                os.path.basename(parameters["file_url"]))[0]
             target_file_path = os.path.join(
                 WORKSPACE_DIR, f'{target_basename}--{uuid.uuid4()}.fgb')
-            _clip_vector_to_bounding_box(
-                source_file_path, target_bbox, target_file_path,
-                target_projection_wkt)
+            with metrics.phase('clip', VECTOR):
+                feature_counts = vector_clip.clip_vector_to_bounding_box(
+                    source_file_path, plan['target_bbox'], target_file_path,
+                    plan['target_projection_wkt'],
+                    mask_geometry=plan['target_aoi'], fields=plan['fields'],
+                    simplify_tolerance=plan['simplify_tolerance'],
+                    estimated_feature_count=(
+                        clip_estimate['n_features'] if clip_estimate
+                        else None))
+            metrics.record_features(**feature_counts)
         except Exception:
             app.logger.exception("Failed to clip vector; aborting")
-            os.remove(target_file_path)
+            if os.path.exists(target_file_path):
+                os.remove(target_file_path)
             raise
 
+        # The vector engines write FlatGeobufs, which are then converted if
+        # needed.
+        output_spec = plan['output']
+        if output_spec is not None and output_spec['format'] != 'fgb':
+            clipped_file_path = target_file_path
+            target_file_path = (os.path.splitext(clipped_file_path)[0] +
+                                output_spec['extension'])
+            try:
+                with metrics.phase('convert', VECTOR):
+                    output_format.convert_vector(
+                        clipped_file_path, target_file_path, output_spec)
+            except Exception:
+                app.logger.exception("Failed to convert vector; aborting")
+                if os.path.exists(target_file_path):
+                    os.remove(target_file_path)
+                raise
+            finally:
+                os.remove(clipped_file_path)
+
+    metrics.record_output(
+        plan['source_file_type'], os.path.getsize(target_file_path))
+    return target_file_path
+
+
+@functools.cache
+def _target_bucket():
+    return upload.get_bucket(TARGET_FILE_BUCKET)
+
+
+@functools.cache
+def _result_cache():
+    return result_cache.get_result_cache(
+        RESULT_CACHE_BACKEND, _target_bucket(), WORKSPACE_DIR,
+        f'{TARGET_BUCKET_SUBDIR}/.cache', RESULT_CACHE_MAX_AGE,
+        RESULT_CACHE_MAX_BYTES, RESULT_CACHE_URL_LIFETIME)
+
+
+def _upload_clip(target_file_path):
+    """Upload a clipped file to the bucket and delete the local copy.
+
+    Args:
+        target_file_path (str): path to the clipped file.
+
+    Returns:
+        A dict with the ``url`` of the uploaded file, its ``object_name`` in
+        the bucket, its size in bytes (``nbytes``) and its human-readable
+        ``size``.
+    """
     try:
-        filesize = humanize.naturalsize(os.path.getsize(target_file_path))
+        nbytes = os.path.getsize(target_file_path)
+        filesize = humanize.naturalsize(nbytes)
 
         today = datetime.datetime.now().strftime('%Y-%m-%d')
         bucket_filename = f"{today}--{os.path.basename(target_file_path)}"
+        object_name = f"{TARGET_BUCKET_SUBDIR}/{bucket_filename}"
 
         app.logger.info(f"Uploading to bucket: {bucket_filename}")
-        bucketname = re.sub('^gs://', '', TARGET_FILE_BUCKET)
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(bucketname)
-        blob = bucket.blob(f"{TARGET_BUCKET_SUBDIR}/{bucket_filename}")
-        blob.upload_from_filename(target_file_path)
-    except Exception:
-        app.logger.exception("Falling back to cmdline gsutil")
-        subprocess.run(["gsutil", "cp", source_file_path,
-                        f'{TARGET_FILE_BUCKET}/{bucket_filename}'])
+        progress.report(message="Uploading")
+        try:
+            with metrics.phase('upload'):
+                uploaded = upload.upload_file(
+                    _target_bucket(), target_file_path, object_name)
+        except Exception:
+            metrics.record_upload_failure()
+            if not TARGET_FILE_BUCKET.startswith('gs://'):
+                raise
+            app.logger.exception("Falling back to cmdline gsutil")
+            with metrics.phase('upload'):
+                subprocess.run(["gsutil", "cp", target_file_path,
+                                f'{TARGET_FILE_BUCKET}/{object_name}'],
+                               check=True)
+            metrics.record_upload(nbytes)
+        else:
+            metrics.record_upload(nbytes)
+            progress.report(
+                message="Uploaded",
+                upload_bytes_per_second=uploaded['bytes_per_second'])
     finally:
         app.logger.info(f"Deleting local file {target_file_path}")
         os.remove(target_file_path)
 
     downloadable_raster_path = f"{TARGET_DOWNLOAD_URL}/{bucket_filename}"
-    app.logger.info("Returning URL: %s", downloadable_raster_path)
-    return jsonify({'url': downloadable_raster_path,
-                    'size': filesize})
+    return {'url': downloadable_raster_path,
+            'object_name': object_name,
+            'nbytes': nbytes,
+            'size': filesize}
 
 
-@app.route("/start")
-def submit():
-    for i in range(10):
-        time.sleep(1)
-        print(f"logging progress {i*10}%")
-        SOURCE_LOGGER.info(f"Progress: {i*10}%")
-    SOURCE_LOGGER.info("Done!")
-    return 'Done!'
+class ClipTooLarge(Exception):
+    """Raised when a clip's estimated cost is over the configured limits."""
 
+    def __init__(self, estimate, reasons):
+        super().__init__(' '.join(reasons))
+        self.estimate = estimate
+        self.reasons = reasons
 
-@app.route('/status')
-def status():
-    def _generator():
+
+def _estimate_clip(plan):
+    """Estimate the output of a clip.
+
+    Args:
+        plan (dict): the clip, as returned by ``_prepare_clip``.
+
+    Returns:
+        A dict of ``n_bytes`` and ``n_pixels`` (rasters) or ``n_features``
+        (vectors), see estimate.py.
+    """
+    if plan['source_file_type'] == RASTER:
+        return estimate.estimate_raster(
+            plan['source_file_info'], plan['target_bbox'],
+            plan['target_cellsize'])
+    return estimate.estimate_vector(
+        plan['source_file_path'], plan['target_bbox'])
+
+
+def _admit_clip(plan):
+    """Decide whether a clip may run.
+
+    Args:
+        plan (dict): the clip, as returned by ``_prepare_clip``.
+
+    Returns:
+        The clip's estimate, as returned by ``_estimate_clip``, or ``None``
+        if it couldn't be estimated.
+
+    Raises:
+        ClipTooLarge: if the clip is over the configured limits.
+    """
+    try:
+        with metrics.phase('estimate', plan['source_file_type']):
+            clip_estimate = _estimate_clip(plan)
+    except Exception:
+        # Don't turn clips away just because they couldn't be estimated.
+        app.logger.warning("Failed to estimate clip of %s",
+                           plan['source_file_path'], exc_info=True)
+        return None
+
+    app.logger.info("Estimated clip of %s: %s", plan['source_file_path'],
+                    clip_estimate)
+    reasons = estimate.check_limits(clip_estimate)
+    if reasons:
+        raise ClipTooLarge(clip_estimate, reasons)
+    return clip_estimate
+
+
+@contextlib.contextmanager
+def _large_clip_slot():
+    """Wait for one of the slots that large clips run in."""
+    start = time.perf_counter()
+    acquired = LARGE_CLIP_SLOTS.acquire(timeout=LARGE_CLIP_WAIT)
+    metrics.record_queue_wait('large_clip', time.perf_counter() - start)
+    if not acquired:
+        raise jobs.QueueFull(
+            "Too many large clips are running; try again later.")
+    try:
+        yield
+    finally:
+        LARGE_CLIP_SLOTS.release()
+
+
+def _admit_and_execute_clip(plan):
+    """Clip a layer into a local file if it is within the limits.
+
+    Large clips wait for a free slot first.  The clip runs with the
+    options of the GDAL profile; see gdal_profile.py.
+
+    Args:
+        plan (dict): the clip, as returned by ``_prepare_clip``.
+
+    Returns:
+        The path to the clipped file in ``WORKSPACE_DIR``.
+
+    Raises:
+        ClipTooLarge: if the clip is over the configured limits.
+    """
+    with gdal_profile.config_options():
+        clip_estimate = _admit_clip(plan)
+        if clip_estimate is not None and estimate.is_large(clip_estimate):
+            app.logger.info("Waiting for a large clip slot")
+            progress.report(message="Waiting for other large clips to finish")
+            with _large_clip_slot():
+                return _execute_clip(plan, clip_estimate)
+        return _execute_clip(plan, clip_estimate)
+
+
+def _aoi_digest(plan):
+    """Get a digest of a clip's area of interest for its cache key."""
+    if plan['target_aoi'] is None:
+        return None
+    return hashlib.sha256(shapely.to_wkb(plan['target_aoi'])).hexdigest()
+
+
+def _clip(parameters, inline=False):
+    """Clip a layer and upload the result to the bucket.
+
+    Identical clips of an unchanged source file are answered from the result
+    cache, and identical clips requested at the same time are only done
+    once.  Clips are estimated first: those over the limits are rejected,
+    and large ones wait for a free slot.
+
+    Args:
+        parameters (dict): the clip request parameters.  ``file_url``,
+            ``layer_type`` and ``target_bbox`` or ``target_aoi`` are
+            required; ``target_epsg``, ``target_cellsize``,
+            ``output_format``, ``compression`` and ``compression_level`` are
+            optional; see output_format.py for the last three.
+            ``target_aoi`` is a GeoJSON polygon or multipolygon in the same
+            coordinates as ``target_bbox``; the clip is masked to it.
+            Vector clips may also keep only a list of ``fields`` and
+            simplify geometries to a ``simplify_tolerance`` in the units of
+            the target projection.
+        inline=False (bool): if true, a clip of at most ``INLINE_MAX_BYTES``
+            is kept as a local file rather than uploaded.
+
+    Returns:
+        A dict with the ``url`` of the clipped file and its human-readable
+        ``size``; or for a clip kept inline, the ``path`` of the local file
+        and the ``download_name`` to offer it as.
+    """
+    with metrics.trace(parameters.get('layer_type'),
+                       file_url=parameters.get('file_url')):
+        plan = _prepare_clip(parameters)
+        source_version = remote.object_version(plan['source_file_path'])
+        clip_key = result_cache.clip_key(
+            plan['source_file_path'], source_version, plan['source_file_type'],
+            plan['target_bbox'], parameters.get('target_epsg'),
+            plan['target_cellsize'], target_aoi=_aoi_digest(plan),
+            fields=plan['fields'],
+            simplify_tolerance=plan['simplify_tolerance'],
+            output=plan['output'])
+
+        cache = _result_cache()
+        if cache is not None and source_version is not None:
+            cached = cache.get(clip_key)
+            metrics.record_cache_lookup('result', cached is not None)
+            if cached is not None:
+                app.logger.info("Returning cached URL: %s", cached['url'])
+                return {'url': cached['url'],
+                        'size': cached['size']}
+
+        inline_paths = []
+
+        def _clip_and_upload():
+            target_file_path = _admit_and_execute_clip(plan)
+            if (inline and
+                    os.path.getsize(target_file_path) <= INLINE_MAX_BYTES):
+                inline_paths.append(target_file_path)
+                # Streamed rather than uploaded, so there is no URL to share
+                # with identical clips waiting on this one.
+                return {'inline': True}
+            uploaded = _upload_clip(target_file_path)
+            if cache is not None and source_version is not None:
+                cache.put(clip_key, **uploaded)
+            return {'url': uploaded['url'],
+                    'size': uploaded['size']}
+
+        def _on_identical_clip():
+            metrics.record(coalesced=True)
+            progress.report(message="Waiting for an identical clip to finish")
+
+        # Identical clips requested at the same time share one computation.
+        result = SINGLE_FLIGHT.run(
+            clip_key, _clip_and_upload, on_wait=_on_identical_clip)
+        if 'url' not in result and not inline_paths:
+            # The identical clip was streamed inline; do this one too.
+            result = _clip_and_upload()
+        if inline_paths:
+            return {'path': inline_paths[0],
+                    'download_name': plan['target_basename']}
+        app.logger.info("Returning URL: %s", result['url'])
+        return result
+
+
+def _validate_batch_parameters(parameters):
+    """Check that batch clip parameters are safe to act on.
+
+    Raises:
+        ValueError: if the parameters are not valid.
+    """
+    layers = parameters['layers']
+    if not layers:
+        raise ValueError("No layers to clip.")
+    if len(layers) > BATCH_CLIP_MAX_LAYERS:
+        raise ValueError(
+            f"At most {BATCH_CLIP_MAX_LAYERS} layers may be clipped at once.")
+    for layer in layers:
+        _validate_clip_parameters(_layer_parameters(parameters, layer))
+
+
+def _layer_parameters(parameters, layer):
+    """Get the clip parameters of one layer of a batch."""
+    layer_parameters = {
+        key: value for key, value in parameters.items()
+        if key not in {'layers', 'name'}}
+    layer_parameters['file_url'] = layer['file_url']
+    layer_parameters['layer_type'] = layer['layer_type']
+    return layer_parameters
+
+
+def _clip_batch(parameters):
+    """Clip several layers of a dataset into one ZIP archive.
+
+    The layers are clipped concurrently and each clipped file is added to
+    the archive as soon as it is ready.  The archive is uploaded once.
+
+    Args:
+        parameters (dict): ``layers`` is a list of dicts with the
+            ``file_url`` and ``layer_type`` of each layer, e.g. from the
+            dataset's ``mappreview`` extra.  ``target_bbox``, ``target_epsg``
+            and ``target_cellsize`` apply to every layer, as for ``_clip``.
+            ``name`` optionally names the archive.
+
+    Returns:
+        A dict with the ``url`` of the archive and its human-readable
+        ``size``.
+    """
+    with metrics.trace('batch', n_layers=len(parameters['layers'])):
+        _validate_batch_parameters(parameters)
+        layers = parameters['layers']
+        archive_name = re.sub(
+            r'[^\w.-]+', '-', parameters.get('name') or 'clipped-layers')
+        archive_path = os.path.join(
+            WORKSPACE_DIR, f'{archive_name}--{uuid.uuid4()}.zip')
+
+        def _clip_layer(layer):
+            # Each layer is traced on its own thread.
+            with metrics.trace(layer['layer_type'],
+                               file_url=layer['file_url']):
+                plan = _prepare_clip(_layer_parameters(parameters, layer))
+                return _admit_and_execute_clip(plan)
+
+        arcnames = set()
+        futures = []
         try:
-            logging_queue = queue.Queue()
-            handler = logging.handlers.QueueHandler(logging_queue)
-            SOURCE_LOGGER.addHandler(handler)
-            while True:
-                record = logging_queue.get(block=True)
-                if record.msg == 'Done!':
-                    break
-                yield json.dumps(record.__dict__)
-        finally:
-            SOURCE_LOGGER.removeHandler(handler)
-    return flask.stream_with_context(_generator())
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=min(len(layers), BATCH_CLIP_WORKERS),
+                    thread_name_prefix='clip-batch') as pool, \
+                    zipfile.ZipFile(archive_path, 'w') as archive:
+                futures.extend(
+                    pool.submit(_clip_layer, layer) for layer in layers)
+                try:
+                    for n_done, future in enumerate(
+                            concurrent.futures.as_completed(futures), start=1):
+                        target_file_path = future.result()
+                        # Drop the --<uuid> suffix, keeping names unique.
+                        basename, extension = os.path.splitext(
+                            os.path.basename(target_file_path))
+                        arcname = f"{basename.rsplit('--', 1)[0]}{extension}"
+                        while arcname in arcnames:
+                            arcname = (f"{os.path.splitext(arcname)[0]}"
+                                       f"_{n_done}{extension}")
+                        arcnames.add(arcname)
+
+                        # Clipped GeoTIFFs and GeoParquet files are already
+                        # compressed.
+                        compression = (
+                            zipfile.ZIP_STORED
+                            if extension in {'.tif', '.parquet'}
+                            else zipfile.ZIP_DEFLATED)
+                        archive.write(target_file_path, arcname,
+                                      compress_type=compression)
+                        os.remove(target_file_path)
+                        progress.report(
+                            fraction=n_done / len(futures),
+                            message=(f"Clipped {n_done} of {len(futures)} "
+                                     "layers"))
+                except Exception:
+                    # Layers already clipping finish as the pool shuts down.
+                    for future in futures:
+                        future.cancel()
+                    raise
+        except Exception:
+            app.logger.exception("Failed to clip batch; aborting")
+            # Every layer has finished by now; remove the clips that weren't
+            # added to the archive.
+            for future in futures:
+                if (not future.cancelled() and future.exception() is None and
+                        os.path.exists(future.result())):
+                    os.remove(future.result())
+            if os.path.exists(archive_path):
+                os.remove(archive_path)
+            raise
+
+        uploaded = _upload_clip(archive_path)
+        app.logger.info("Returning URL: %s", uploaded['url'])
+        return {'url': uploaded['url'],
+                'size': uploaded['size']}
+
+
+@app.errorhandler(ClipTooLarge)
+def clip_too_large(error):
+    return jsonify({
+        'status': 'failure',
+        'error': str(error),
+        'estimate': error.estimate,
+    }), 413
+
+
+@app.errorhandler(preview.PreviewTimeout)
+def preview_timeout(error):
+    return jsonify({
+        'status': 'failure',
+        'error': str(error),
+    }), 504
+
+
+@app.errorhandler(jobs.QueueFull)
+def queue_full(error):
+    return jsonify({
+        'status': 'failure',
+        'error': str(error),
+    }), 503, {'Retry-After': '30'}
+
+
+@app.route("/clip/estimate", methods=['POST'])
+def clip_estimate():
+    """Estimate the output of a clip without doing it.
+
+    Takes the same parameters as ``POST /clip``.
+    """
+    parameters = request.get_json()
+    try:
+        _validate_clip_parameters(parameters)
+    except (KeyError, ValueError) as error:
+        return _invalid_parameters(error)
+    plan = _prepare_clip(parameters)
+    clip_estimate = _estimate_clip(plan)
+    reasons = estimate.check_limits(clip_estimate)
+    return jsonify({
+        'status': 'success',
+        'layer_type': plan['source_file_type'],
+        'estimate': dict(
+            clip_estimate, size=humanize.naturalsize(clip_estimate['n_bytes'])),
+        'within_limits': not reasons,
+        'reasons': reasons,
+        'large': estimate.is_large(clip_estimate),
+    })
+
+
+def _render_preview(plan, size, deadline):
+    """Render a preview of a clip; see preview.py.
+
+    Returns:
+        A tuple of the PNG (bytes) and whether it is complete.
+    """
+    read_path = remote.gdal_path(plan['source_file_path'])
+    if plan['source_file_type'] == RASTER:
+        return preview.render_raster(
+            read_path, plan['source_file_info'], plan['source_bbox'],
+            plan['target_bbox'], plan['target_projection_wkt'],
+            mask_geometry=plan['target_aoi'], size=size, deadline=deadline)
+    return preview.render_vector(
+        read_path, plan['target_bbox'],
+        plan['source_file_info']['projection_wkt'],
+        plan['target_projection_wkt'], mask_geometry=plan['target_aoi'],
+        size=size, deadline=deadline)
+
+
+@app.route("/clip/preview", methods=['POST'])
+def clip_preview():
+    """Render a quicklook PNG of a clip without doing it.
+
+    Takes the same parameters as ``POST /clip``, and optionally a
+    ``preview_size``: the width or height of the PNG, whichever is larger.
+    Previews are rendered within ``preview.PREVIEW_TIME_BUDGET`` seconds and
+    cached by clip key.  Vector previews that ran out of time show only
+    some of the features, have an ``X-Preview-Complete: false`` header and
+    are not cached.
+    """
+    deadline = time.monotonic() + preview.PREVIEW_TIME_BUDGET
+    parameters = request.get_json()
+    try:
+        _validate_clip_parameters(parameters)
+        size = _parse_preview_size(parameters)
+    except (KeyError, ValueError) as error:
+        return _invalid_parameters(error)
+
+    with metrics.trace(parameters.get('layer_type'),
+                       file_url=parameters.get('file_url'), preview=True):
+        plan = _prepare_clip(parameters)
+        source_version = remote.object_version(plan['source_file_path'])
+        preview_key = result_cache.clip_key(
+            plan['source_file_path'], source_version, plan['source_file_type'],
+            plan['target_bbox'], parameters.get('target_epsg'),
+            target_aoi=_aoi_digest(plan), preview_size=size)
+
+        png = None
+        if source_version is not None:
+            png = PREVIEW_CACHE.get(preview_key)
+            metrics.record_cache_lookup('preview', png is not None)
+        complete = True
+        if png is None:
+            with metrics.phase('preview'), gdal_profile.config_options():
+                png, complete = _render_preview(plan, size, deadline)
+            if complete and source_version is not None:
+                PREVIEW_CACHE.put(preview_key, png)
+        metrics.record(preview_complete=complete)
+
+    return flask.Response(png, mimetype='image/png', headers={
+        'X-Preview-Complete': 'true' if complete else 'false',
+    })
+
+
+def _stream_clip(target_file_path, download_name):
+    """Stream a clipped file as the response, deleting it afterwards.
+
+    Args:
+        target_file_path (str): path to the clipped file.
+        download_name (str): the file name offered to the user, without an
+            extension.
+
+    Returns:
+        A ``flask.Response`` with the file as an attachment.
+    """
+    extension = os.path.splitext(target_file_path)[1]
+    nbytes = os.path.getsize(target_file_path)
+    source_file = open(target_file_path, 'rb')
+    # The open file keeps the data around until the response is done.
+    os.remove(target_file_path)
+
+    def _chunks():
+        with source_file:
+            while chunk := source_file.read(INLINE_CHUNK_SIZE):
+                yield chunk
+
+    download_name = re.sub(r'[^\w.-]+', '-', download_name) + extension
+    return flask.Response(_chunks(), mimetype=INLINE_MIMETYPES.get(
+        extension, 'application/octet-stream'), headers={
+            'Content-Length': str(nbytes),
+            'Content-Disposition': f'attachment; filename="{download_name}"',
+        })
+
+
+@app.route("/clip", methods=['POST'])
+def clip():
+    """Clip a layer.
+
+    Responds with JSON with the ``url`` and ``size`` of the uploaded clip.
+    With ``"inline": true`` in the parameters, a clip of at most
+    ``INLINE_MAX_BYTES`` is instead returned as the body of the response,
+    skipping the bucket; larger clips, and clips already in the result
+    cache, are answered with their URL as usual.
+    """
+    parameters = request.get_json()
+    app.logger.info(parameters)
+    try:
+        _validate_clip_parameters(parameters)
+    except (KeyError, ValueError) as error:
+        return _invalid_parameters(error)
+    if not parameters.get('inline'):
+        return jsonify(_clip(parameters))
+
+    with metrics.trace(parameters.get('layer_type'),
+                       file_url=parameters.get('file_url'), inline=True):
+        result = _clip(parameters, inline=True)
+        if 'path' in result:
+            app.logger.info("Returning %s inline", result['path'])
+            return _stream_clip(result['path'], result['download_name'])
+    return jsonify(result)
+
+
+@app.route("/clip/batch", methods=['POST'])
+def clip_batch():
+    parameters = request.get_json()
+    app.logger.info(parameters)
+    try:
+        _validate_batch_parameters(parameters)
+    except (KeyError, ValueError) as error:
+        return _invalid_parameters(error)
+    return jsonify(_clip_batch(parameters))
+
+
+@app.route("/clip/jobs", methods=['POST'])
+def submit_clip_job():
+    """Queue a clip.
+
+    Takes the parameters of either ``POST /clip`` or, when ``layers`` is
+    given, ``POST /clip/batch``.
+    """
+    parameters = request.get_json()
+    app.logger.info(parameters)
+    try:
+        if 'layers' in parameters:
+            _validate_batch_parameters(parameters)
+        else:
+            _validate_clip_parameters(parameters)
+    except (KeyError, ValueError) as error:
+        return _invalid_parameters(error)
+
+    # Turn away clips that are too large before they take a place in the
+    # queue.
+    if 'layers' in parameters:
+        for layer in parameters['layers']:
+            _admit_clip(_prepare_clip(_layer_parameters(parameters, layer)))
+        job = JOB_QUEUE.submit(_clip_batch, parameters)
+    else:
+        _admit_clip(_prepare_clip(parameters))
+        job = JOB_QUEUE.submit(_clip, parameters)
+
+    app.logger.info("Queued clip job %s", job['job_id'])
+    return jsonify({
+        'status': job['status'],
+        'job_id': job['job_id'],
+        'job_url': flask.url_for('clip_job', job_id=job['job_id']),
+    }), 202
+
+
+@app.route("/clip/jobs/<job_id>", methods=['GET'])
+def clip_job(job_id):
+    job = JOB_QUEUE.store.get(job_id)
+    if job is None:
+        return jsonify({
+            'status': 'failure',
+            'error': f"No such job: {job_id}",
+        }), 404
+    return jsonify(job)
+
+
+@app.route("/clip/jobs/<job_id>/events", methods=['GET'])
+def clip_job_events(job_id):
+    """Stream the progress of a clip job as Server-Sent Events.
+
+    A ``progress`` event is sent for each progress update and a final
+    ``done`` event carries the finished job record.  The stream ends when the
+    job ends.
+    """
+    if JOB_QUEUE.store.get(job_id) is None:
+        return jsonify({
+            'status': 'failure',
+            'error': f"No such job: {job_id}",
+        }), 404
+
+    def _generator():
+        last_progress = None
+        while True:
+            channel = progress.get_channel(job_id)
+            if channel is not None:
+                # The job is running in this process; stream every event.
+                listener = channel.subscribe()
+                try:
+                    while True:
+                        try:
+                            event = listener.get(
+                                timeout=SSE_KEEPALIVE_PERIOD)
+                        except queue.Empty:
+                            yield ': keepalive\n\n'
+                            continue
+                        if event is None:
+                            break
+                        yield progress.format_sse(
+                            json.dumps(event), event='progress')
+                finally:
+                    channel.unsubscribe(listener)
+
+            # The job is queued, just ended, or runs in another worker;
+            # follow the progress saved in the job store.
+            job = JOB_QUEUE.store.get(job_id)
+            if job is None or job['status'] in jobs.FINISHED_STATES:
+                break
+            if job['progress'] != last_progress:
+                last_progress = job['progress']
+                yield progress.format_sse(
+                    json.dumps(last_progress), event='progress')
+            else:
+                yield ': keepalive\n\n'
+            time.sleep(jobs.PROGRESS_SAVE_PERIOD)
+        yield progress.format_sse(json.dumps(job), event='done')
+
+    return flask.Response(
+        flask.stream_with_context(_generator()),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            # Tell nginx not to buffer the stream.
+            'X-Accel-Buffering': 'no',
+        })
 
 
 if __name__ == '__main__':
-    import uvicorn
-    uvicorn.run(
-        'app:app',
+    # For development only; see asgi.py for serving this app with uvicorn.
+    app.run(
         host=os.environ.get('HOST', '127.0.0.1'),
         port=int(os.environ.get('PORT', 8000)),
-        log_level='info'
-    )
+        threaded=True)
@@ -0,0 +1,257 @@
+"""ASGI version of the clipping service.
+
+app/asgi.py
+
+The lightweight endpoints, ``/metadata``, ``/info``, ``/info/batch``,
+``/epsg_info`` and the progress stream of clip jobs, are served
+asynchronously: they wait on the network with a pooled ``httpx`` client, and
+``gdal.Info`` runs in a pool of ``INFO_THREADS`` threads, so waiting on them
+doesn't hold a worker.  Everything else, including every clip, is the Flask
+app of app.py, mounted through ``a2wsgi``, which runs its requests in a pool
+of ``CLIP_THREADS`` threads.  One worker can then serve many concurrent
+metadata and info calls next to a few heavy clips.
+
+Run it with ``uvicorn asgi:app``, or in the container with::
+
+    GUNICORN_CMD_ARGS="--timeout=300 -k uvicorn.workers.UvicornWorker"
+
+and ``asgi:app`` as the command.
+"""
+import asyncio
+import concurrent.futures
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import queue
+import re
+
+import httpx
+from a2wsgi import WSGIMiddleware
+from fastapi import FastAPI
+from fastapi import Request
+from fastapi.responses import JSONResponse
+from fastapi.responses import PlainTextResponse
+from fastapi.responses import Response
+from fastapi.responses import StreamingResponse
+from starlette.middleware.cors import CORSMiddleware
+
+import app as wsgi
+import jobs
+import progress
+import remote
+
+LOGGER = logging.getLogger(__name__)
+
+# Threads that run the Flask app, and so the clips.
+CLIP_THREADS = int(os.environ.get('CLIP_THREADS', 8))
+
+# Threads that run gdal.Info for /info and /info/batch.
+INFO_THREADS = int(os.environ.get('INFO_THREADS', 32))
+INFO_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=INFO_THREADS, thread_name_prefix='info')
+
+# The connection pool of the HTTP client.
+HTTP_MAX_CONNECTIONS = int(os.environ.get('HTTP_MAX_CONNECTIONS', 100))
+
+# Seconds between checks for progress events of a job in this process.
+SSE_POLL_PERIOD = 0.25
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    async with httpx.AsyncClient(
+            follow_redirects=True,
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_CONNECTIONS)) as client:
+        app.state.http_client = client
+        yield
+
+
+app = FastAPI(
+    title="Clipping service", lifespan=lifespan, docs_url=None,
+    redoc_url=None, openapi_url=None)
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origin_regex='|'.join(
+        re.escape(origin).replace(r'\*', '.*')
+        for origin in wsgi.cors_origins),
+    allow_methods=['*'],
+    allow_headers=['*'])
+
+
+def _failure(error, status_code):
+    return JSONResponse({
+        'status': 'failure',
+        'error': error,
+    }, status_code=status_code)
+
+
+def _cacheable_json(request, payload):
+    """Make a JSON response that browsers and nginx may cache.
+
+    See ``app._cacheable_json``.
+    """
+    digest = hashlib.sha256(
+        json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+    etag = f'"{digest}"'
+    headers = {
+        'ETag': etag,
+        'Cache-Control': f'public, max-age={wsgi.INFO_CACHE_CONTROL_MAX_AGE}',
+    }
+    if_none_match = request.headers.get('If-None-Match', '')
+    if etag in [tag.strip().removeprefix('W/')
+                for tag in if_none_match.split(',')]:
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(payload, headers=headers)
+
+
+async def _gdal_info(client, file_url):
+    """Get the ``gdalinfo -json`` output of a remote file; see app.py."""
+    version = await remote.async_object_version(
+        f'/vsicurl/{file_url}', client)
+    return await asyncio.get_running_loop().run_in_executor(
+        INFO_EXECUTOR, wsgi._read_gdal_info, file_url, version)
+
+
+@app.get('/epsg_info')
+async def epsg_info(request: Request):
+    return wsgi._epsg_info(request.query_params.get('epsg_code'))
+
+
+@app.get('/metadata')
+async def metadata(request: Request):
+    file_url = request.query_params.get('file_url')
+    try:
+        yaml_data = await wsgi.METADATA_CACHE.get_async(
+            f'{file_url}.yml', request.app.state.http_client)
+    except httpx.HTTPError as error:
+        LOGGER.exception("Failed to fetch metadata for %s", file_url)
+        return _failure(str(error), 502)
+    return yaml_data
+
+
+@app.get('/info')
+async def info(request: Request):
+    file_url = request.query_params.get('file_url')
+    if not file_url:
+        return _failure("Missing parameter: file_url", 400)
+    result = await _gdal_info(request.app.state.http_client, file_url)
+
+    return _cacheable_json(request, {
+        'status': 'success',
+        'info': result,
+    })
+
+
+@app.api_route('/info/batch', methods=['GET', 'POST'])
+async def info_batch(request: Request):
+    """Get the info of several files in one round trip; see app.py."""
+    if request.method == 'POST':
+        file_urls = (await request.json()).get('file_urls', [])
+    else:
+        file_urls = request.query_params.getlist('file_url')
+    if not file_urls:
+        return _failure("Missing parameter: file_url", 400)
+    if len(file_urls) > wsgi.INFO_BATCH_MAX_FILES:
+        return _failure(
+            f"At most {wsgi.INFO_BATCH_MAX_FILES} files may be requested at "
+            "once", 400)
+
+    async def _info_or_none(file_url):
+        try:
+            return await _gdal_info(request.app.state.http_client, file_url)
+        except Exception:
+            LOGGER.exception("Failed to read info for %s", file_url)
+            return None
+
+    results = await asyncio.gather(
+        *[_info_or_none(file_url) for file_url in file_urls])
+
+    return _cacheable_json(request, {
+        'status': 'success',
+        'info': dict(zip(file_urls, results)),
+    })
+
+
+@app.get('/hello', response_class=PlainTextResponse)
+async def hello_world():
+    return 'Hello, World!'
+
+
+@app.get('/clip/jobs/{job_id}/events')
+async def clip_job_events(job_id: str):
+    """Stream the progress of a clip job as Server-Sent Events.
+
+    See ``app.clip_job_events``; this version doesn't hold a thread per
+    stream.
+    """
+    if await asyncio.to_thread(wsgi.JOB_QUEUE.store.get, job_id) is None:
+        return _failure(f"No such job: {job_id}", 404)
+
+    async def _generator():
+        last_progress = None
+        while True:
+            channel = progress.get_channel(job_id)
+            if channel is not None:
+                # The job is running in this process; stream every event.
+                listener = channel.subscribe()
+                try:
+                    idle = 0
+                    while True:
+                        try:
+                            event = listener.get_nowait()
+                        except queue.Empty:
+                            await asyncio.sleep(SSE_POLL_PERIOD)
+                            idle += SSE_POLL_PERIOD
+                            if idle >= wsgi.SSE_KEEPALIVE_PERIOD:
+                                idle = 0
+                                yield ': keepalive\n\n'
+                            continue
+                        if event is None:
+                            break
+                        idle = 0
+                        yield progress.format_sse(
+                            json.dumps(event), event='progress')
+                finally:
+                    channel.unsubscribe(listener)
+
+            # The job is queued, just ended, or runs in another worker;
+            # follow the progress saved in the job store.
+            job = await asyncio.to_thread(wsgi.JOB_QUEUE.store.get, job_id)
+            if job is None or job['status'] in jobs.FINISHED_STATES:
+                break
+            if job['progress'] != last_progress:
+                last_progress = job['progress']
+                yield progress.format_sse(
+                    json.dumps(last_progress), event='progress')
+            else:
+                yield ': keepalive\n\n'
+            await asyncio.sleep(jobs.PROGRESS_SAVE_PERIOD)
+        yield progress.format_sse(json.dumps(job), event='done')
+
+    return StreamingResponse(
+        _generator(),
+        media_type='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            # Tell nginx not to buffer the stream.
+            'X-Accel-Buffering': 'no',
+        })
+
+
+# Everything else is served by the Flask app, in its own threads.
+app.mount('/', WSGIMiddleware(wsgi.app, workers=CLIP_THREADS))
+
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(
+        'asgi:app',
+        host=os.environ.get('HOST', '127.0.0.1'),
+        port=int(os.environ.get('PORT', 8000)),
+        log_level='info'
+    )
@@ -0,0 +1,107 @@
+"""Estimate the cost of a clip before doing it.
+
+app/estimate.py
+
+Raster estimates come from the cached raster info: the number of output
+pixels follows from the bounding box and cell size.  Vector estimates read
+the FlatGeobuf header and a level of its spatial index, see flatgeobuf.py.
+Byte sizes are uncompressed upper bounds for rasters and proportional to the
+source file for vectors.
+"""
+import math
+import os
+
+from osgeo import gdal
+
+import flatgeobuf
+
+# Clips above any of these limits are rejected.
+MAX_PIXELS = int(os.environ.get('CLIP_MAX_PIXELS', 4 * 10**9))
+MAX_FEATURES = int(os.environ.get('CLIP_MAX_FEATURES', 20 * 10**6))
+MAX_BYTES = int(os.environ.get('CLIP_MAX_BYTES', 16 * 1024**3))
+
+# Clips above this size are "large"; only a few of them run at once.
+LARGE_CLIP_BYTES = int(os.environ.get('CLIP_LARGE_BYTES', 1024**3))
+
+
+def estimate_raster(raster_info, target_bbox, target_cellsize):
+    """Estimate the output of a raster clip.
+
+    Args:
+        raster_info (dict): the pygeoprocessing info of the source raster.
+        target_bbox (list): the bounding box of the output, in the target
+            projection.
+        target_cellsize (list): the cell size of the output.
+
+    Returns:
+        A dict of ``width``, ``height``, ``n_pixels`` and ``n_bytes``.
+    """
+    width = math.ceil(
+        abs((target_bbox[2] - target_bbox[0]) / float(target_cellsize[0])))
+    height = math.ceil(
+        abs((target_bbox[3] - target_bbox[1]) / float(target_cellsize[1])))
+    n_pixels = width * height
+    bytes_per_pixel = gdal.GetDataTypeSize(raster_info['datatype']) // 8
+    return {
+        'width': width,
+        'height': height,
+        'n_pixels': n_pixels,
+        'n_bytes': n_pixels * raster_info['n_bands'] * bytes_per_pixel,
+    }
+
+
+def estimate_vector(vsi_file_path, target_bbox):
+    """Estimate the output of a vector clip.
+
+    Args:
+        vsi_file_path (str): the ``/vsicurl/`` path of the source FlatGeobuf.
+        target_bbox (list): the bounding box of the clip, in the projection
+            of the source.
+
+    Returns:
+        A dict of ``n_features`` and ``n_bytes``.
+    """
+    header = flatgeobuf.read_header(vsi_file_path)
+    n_features = flatgeobuf.estimate_feature_count(
+        vsi_file_path, target_bbox, header)
+    bytes_per_feature = 0
+    if header['features_count']:
+        bytes_per_feature = (
+            (header['file_size'] - header['features_offset']) /
+            header['features_count'])
+    return {
+        'n_features': n_features,
+        'n_bytes': int(n_features * bytes_per_feature),
+    }
+
+
+def check_limits(estimate):
+    """Check an estimate against the configured limits.
+
+    Args:
+        estimate (dict): as returned by ``estimate_raster`` or
+            ``estimate_vector``.
+
+    Returns:
+        A list of human-readable reasons the clip is over the limits; empty
+        if it is within them.
+    """
+    reasons = []
+    if estimate.get('n_pixels', 0) > MAX_PIXELS:
+        reasons.append(
+            f"The clip would have {estimate['n_pixels']} pixels; the limit "
+            f"is {MAX_PIXELS}.")
+    if estimate.get('n_features', 0) > MAX_FEATURES:
+        reasons.append(
+            f"The clip would have about {estimate['n_features']} features; "
+            f"the limit is {MAX_FEATURES}.")
+    if estimate['n_bytes'] > MAX_BYTES:
+        reasons.append(
+            f"The clip would be about {estimate['n_bytes']} bytes; the limit "
+            f"is {MAX_BYTES}.")
+    return reasons
+
+
+def is_large(estimate):
+    """Whether a clip counts as large for admission control."""
+    return estimate['n_bytes'] > LARGE_CLIP_BYTES
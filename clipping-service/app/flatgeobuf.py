@@ -0,0 +1,197 @@
+"""Read the header and spatial index of a remote FlatGeobuf.
+
+app/flatgeobuf.py
+
+A FlatGeobuf starts with a magic number, a FlatBuffers header and a packed
+Hilbert R-tree of feature bounding boxes.  Reading these with a few HTTP
+range requests is enough to estimate how many features fall in a bounding
+box, without reading any features.
+
+See https://github.com/flatgeobuf/flatgeobuf/blob/master/src/fbs/header.fbs
+for the layout of the header.
+"""
+import math
+import os
+import struct
+
+import numpy
+
+import remote
+
+MAGIC_SIZE = 8
+NODE_ITEM_SIZE = 40  # minx, miny, maxx, maxy (float64) and offset (uint64)
+
+# Field indices in the FlatBuffers header table.
+_ENVELOPE_FIELD = 1
+_FEATURES_COUNT_FIELD = 8
+_INDEX_NODE_SIZE_FIELD = 9
+_DEFAULT_INDEX_NODE_SIZE = 16
+
+# The largest index level (in nodes) that is read to estimate a count.
+MAX_LEVEL_NODES = 65536
+
+# Seconds to wait for a range request.
+REQUEST_TIMEOUT = 30
+
+
+def _read_range(url, start, length):
+    """Read ``length`` bytes at ``start``.
+
+    Returns:
+        A tuple of the bytes and the total size of the object.
+    """
+    if not url.startswith(('http://', 'https://')):
+        # A local file, e.g. in the benchmarks.
+        with open(url, 'rb') as local_file:
+            local_file.seek(start)
+            data = local_file.read(length)
+            return data, os.fstat(local_file.fileno()).st_size
+    response = remote.SESSION.get(
+        url, headers={'Range': f'bytes={start}-{start + length - 1}'},
+        timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    total_size = int(response.headers['Content-Range'].split('/')[-1])
+    return response.content, total_size
+
+
+def _table_field(buffer, table_pos, field_index):
+    """Get the position of a field of a FlatBuffers table, or ``None``."""
+    (vtable_offset,) = struct.unpack_from('<i', buffer, table_pos)
+    vtable_pos = table_pos - vtable_offset
+    (vtable_size,) = struct.unpack_from('<H', buffer, vtable_pos)
+    entry_pos = 4 + 2 * field_index
+    if entry_pos >= vtable_size:
+        return None
+    (field_offset,) = struct.unpack_from('<H', buffer, vtable_pos + entry_pos)
+    if field_offset == 0:
+        return None
+    return table_pos + field_offset
+
+
+def read_header(url):
+    """Read the header of a remote FlatGeobuf.
+
+    Args:
+        url (str): an http(s) URL, a ``/vsicurl/`` path or a local path.
+
+    Returns:
+        A dict of ``features_count``, ``index_node_size``, ``envelope``
+        (``[minx, miny, maxx, maxy]`` or ``None``), ``index_offset`` (the
+        byte offset of the index), ``features_offset`` (the byte offset of
+        the first feature) and ``file_size``.
+    """
+    url = remote.strip_vsi_prefix(url)
+    data, file_size = _read_range(url, 0, 65536)
+    (header_size,) = struct.unpack_from('<I', data, MAGIC_SIZE)
+    header_start = MAGIC_SIZE + 4
+    if header_start + header_size > len(data):
+        data, _ = _read_range(url, 0, header_start + header_size)
+    buffer = data[header_start:header_start + header_size]
+
+    (table_pos,) = struct.unpack_from('<I', buffer, 0)
+
+    features_count = 0
+    pos = _table_field(buffer, table_pos, _FEATURES_COUNT_FIELD)
+    if pos is not None:
+        (features_count,) = struct.unpack_from('<Q', buffer, pos)
+
+    index_node_size = _DEFAULT_INDEX_NODE_SIZE
+    pos = _table_field(buffer, table_pos, _INDEX_NODE_SIZE_FIELD)
+    if pos is not None:
+        (index_node_size,) = struct.unpack_from('<H', buffer, pos)
+
+    envelope = None
+    pos = _table_field(buffer, table_pos, _ENVELOPE_FIELD)
+    if pos is not None:
+        (vector_offset,) = struct.unpack_from('<I', buffer, pos)
+        vector_pos = pos + vector_offset
+        (length,) = struct.unpack_from('<I', buffer, vector_pos)
+        if length >= 4:
+            envelope = list(struct.unpack_from('<4d', buffer, vector_pos + 4))
+
+    index_offset = header_start + header_size
+    index_size = 0
+    if index_node_size > 0 and features_count > 0:
+        index_size = _num_nodes(features_count, index_node_size) * \
+            NODE_ITEM_SIZE
+
+    return {
+        'features_count': features_count,
+        'index_node_size': index_node_size,
+        'envelope': envelope,
+        'index_offset': index_offset,
+        'features_offset': index_offset + index_size,
+        'file_size': file_size,
+    }
+
+
+def _level_num_nodes(num_items, node_size):
+    """Get the number of nodes per level, from the leaves up to the root."""
+    n = num_items
+    level_num_nodes = [n]
+    while n != 1:
+        n = math.ceil(n / node_size)
+        level_num_nodes.append(n)
+    return level_num_nodes
+
+
+def _num_nodes(num_items, node_size):
+    return sum(_level_num_nodes(num_items, node_size))
+
+
+def estimate_feature_count(url, bbox, header=None):
+    """Estimate the number of features that intersect a bounding box.
+
+    Reads a single level of the spatial index, the lowest one with at most
+    ``MAX_LEVEL_NODES`` nodes, and counts the features under the nodes that
+    intersect the bounding box.  The estimate is an upper bound, which is
+    exact when the leaves themselves are read.
+
+    Args:
+        url (str): an http(s) URL, a ``/vsicurl/`` path or a local path.
+        bbox (list): list of the form [xmin, ymin, xmax, ymax], in the
+            projection of the FlatGeobuf.
+        header=None (dict): the header, as returned by ``read_header``.
+
+    Returns:
+        The estimated number of features (int).
+    """
+    url = remote.strip_vsi_prefix(url)
+    if header is None:
+        header = read_header(url)
+    features_count = header['features_count']
+    node_size = header['index_node_size']
+
+    if node_size == 0 or features_count == 0:
+        # No index; assume the features are spread evenly over the envelope.
+        envelope = header['envelope']
+        if envelope is None or features_count == 0:
+            return features_count
+        envelope_area = (envelope[2] - envelope[0]) * (envelope[3] - envelope[1])
+        if envelope_area <= 0:
+            return features_count
+        overlap_area = (
+            max(0, min(envelope[2], bbox[2]) - max(envelope[0], bbox[0])) *
+            max(0, min(envelope[3], bbox[3]) - max(envelope[1], bbox[1])))
+        return int(features_count * overlap_area / envelope_area)
+
+    # Nodes are stored from the root down, so the leaves are last.
+    level_num_nodes = _level_num_nodes(features_count, node_size)
+    num_nodes = sum(level_num_nodes)
+    level = 0
+    while level_num_nodes[level] > MAX_LEVEL_NODES:
+        level += 1
+    level_offset = num_nodes - sum(level_num_nodes[:level + 1])
+
+    data, _ = _read_range(
+        url, header['index_offset'] + level_offset * NODE_ITEM_SIZE,
+        level_num_nodes[level] * NODE_ITEM_SIZE)
+    nodes = numpy.frombuffer(data, dtype=numpy.dtype([
+        ('minx', '<f8'), ('miny', '<f8'), ('maxx', '<f8'), ('maxy', '<f8'),
+        ('offset', '<u8')]))
+    intersecting = (
+        (nodes['maxx'] >= bbox[0]) & (nodes['minx'] <= bbox[2]) &
+        (nodes['maxy'] >= bbox[1]) & (nodes['miny'] <= bbox[3]))
+    items_per_node = node_size ** level
+    return int(min(numpy.count_nonzero(intersecting) * items_per_node,
+                   features_count))
@@ -0,0 +1,102 @@
+"""GDAL performance profiles.
+
+app/gdal_profile.py
+
+A profile is a set of GDAL configuration options and a number of warp
+threads.  Clips run with the profile named by ``GDAL_PROFILE``:
+
+    * ``remote-cog`` (the default) is tuned for COGs and FlatGeobufs read
+      over HTTP, where clips wait on range requests: adjacent ranges are
+      merged into one request, several ranges are fetched per request,
+      directory listings are never requested, and the block and ``/vsicurl/``
+      caches are large enough that blocks aren't read twice.
+    * ``low-memory`` reads the same way with small caches and fewer warp
+      threads, for small containers.
+    * ``gdal-defaults`` sets nothing, to compare against GDAL's own defaults.
+
+The options are scoped to the clip with ``gdal.config_options``, which only
+sets them on the current thread, so code that runs GDAL on other threads
+must enter ``config_options()`` there too.  ``GDAL_CACHEMAX`` and
+``CPL_VSIL_CURL_CACHE_SIZE`` size caches shared by the whole process and are
+only read once, so they are also set for the process when this module is
+imported.
+
+The profile is reported in each clip's trace and as a label of the clip
+duration metric; see metrics.py.
+"""
+import contextlib
+import logging
+import os
+
+from osgeo import gdal
+
+LOGGER = logging.getLogger(__name__)
+
+_HTTP_OPTIONS = {
+    'GDAL_HTTP_MULTIRANGE': 'YES',
+    'GDAL_HTTP_MERGE_CONSECUTIVE_RANGES': 'YES',
+    'GDAL_DISABLE_READDIR_ON_OPEN': 'EMPTY_DIR',
+}
+
+PROFILES = {
+    'remote-cog': {
+        'warp_threads': os.cpu_count() or 1,
+        'config_options': {
+            **_HTTP_OPTIONS,
+            # In MB.
+            'GDAL_CACHEMAX': '512',
+            # In bytes.
+            'CPL_VSIL_CURL_CACHE_SIZE': str(256 * 1024**2),
+        },
+    },
+    'low-memory': {
+        'warp_threads': 2,
+        'config_options': {
+            **_HTTP_OPTIONS,
+            'GDAL_CACHEMAX': '64',
+            'CPL_VSIL_CURL_CACHE_SIZE': str(16 * 1024**2),
+        },
+    },
+    'gdal-defaults': {
+        'warp_threads': 1,
+        'config_options': {},
+    },
+}
+
+# Options that size process-wide caches.
+_PROCESS_OPTIONS = ('GDAL_CACHEMAX', 'CPL_VSIL_CURL_CACHE_SIZE')
+
+NAME = os.environ.get('GDAL_PROFILE', 'remote-cog')
+if NAME not in PROFILES:
+    raise ValueError(
+        f"Unknown GDAL_PROFILE: {NAME}; expected one of "
+        f"{', '.join(sorted(PROFILES))}")
+PROFILE = PROFILES[NAME]
+
+# The number of threads each warp uses.  Defaults to the profile's.
+WARP_THREADS = int(
+    os.environ.get('GDAL_WARP_THREADS', PROFILE['warp_threads']))
+
+
+def _apply_process_options():
+    """Size the process-wide caches for the profile."""
+    for key in _PROCESS_OPTIONS:
+        value = PROFILE['config_options'].get(key)
+        if value is None:
+            continue
+        gdal.SetConfigOption(key, value)
+        if key == 'GDAL_CACHEMAX':
+            # The block cache may already have read its size.
+            gdal.SetCacheMax(int(value) * 1024**2)
+    LOGGER.info("Using the %s GDAL profile with %s warp threads", NAME,
+                WARP_THREADS)
+
+
+_apply_process_options()
+
+
+@contextlib.contextmanager
+def config_options():
+    """Set the profile's GDAL configuration options on this thread."""
+    with gdal.config_options(PROFILE['config_options']):
+        yield
@@ -0,0 +1,34 @@
+"""gunicorn settings.
+
+app/gunicorn.conf.py
+
+gunicorn reads this file from its working directory (``/opt`` in the
+container), on top of ``GUNICORN_CMD_ARGS``.
+
+When ``PROMETHEUS_MULTIPROC_DIR`` is set (see metrics.py), the directory is
+emptied when gunicorn starts, so that the metrics of workers from a previous
+run of the container aren't added up again, and the files of each worker
+that exits are marked dead, so that its gauges stop being reported.
+"""
+import os
+
+
+def on_starting(server):
+    """Empty the Prometheus multiprocess directory."""
+    multiproc_dir = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if not multiproc_dir:
+        return
+    os.makedirs(multiproc_dir, exist_ok=True)
+    for entry in os.scandir(multiproc_dir):
+        if entry.is_file():
+            os.remove(entry.path)
+    server.log.info("Emptied %s", multiproc_dir)
+
+
+def child_exit(server, worker):
+    """Mark the metrics of an exited worker as dead."""
+    if not os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        return
+    # Imported here so that gunicorn starts without prometheus_client.
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,244 @@
+"""Asynchronous clip jobs.
+
+app/jobs.py
+
+A clip job is submitted, gets an ID right away and is then executed by a
+bounded pool of worker threads.  The state of every job is kept in a job
+store so that clients can poll for the result.  Two stores are available:
+
+    * ``InMemoryJobStore`` keeps jobs in the memory of the current process.
+      This is fine for a single worker, but a client polling a different
+      gunicorn worker (or Cloud Run instance) will not find its job.
+    * ``RedisJobStore`` keeps jobs in Redis so that any worker can answer a
+      status request.
+
+The store is selected with the ``JOB_STORE_URL`` environment variable, e.g.
+``memory://`` (the default) or ``redis://localhost:6379/0``.
+"""
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+import progress
+
+LOGGER = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCESS = 'success'
+FAILURE = 'failure'
+FINISHED_STATES = (SUCCESS, FAILURE)
+
+# How long to keep a job record around after it has been created.
+JOB_TTL = int(os.environ.get('JOB_TTL', 24 * 60 * 60))
+
+# The minimum number of seconds between saves of a job's progress.
+PROGRESS_SAVE_PERIOD = 1.0
+
+
+class QueueFull(Exception):
+    """Raised when a job is submitted to a queue that has no room left."""
+
+
+class JobStore:
+    """Interface for a store of job records.
+
+    A job record is a JSON-serializable dict with (at least) the keys
+    ``job_id``, ``status``, ``created``, ``started``, ``finished``,
+    ``progress``, ``result`` and ``error``.
+    """
+
+    def create(self, parameters):
+        """Create a new queued job.
+
+        Args:
+            parameters (dict): the clip parameters of the job.
+
+        Returns:
+            The new job record (dict).
+        """
+        job = {
+            'job_id': uuid.uuid4().hex,
+            'status': QUEUED,
+            'parameters': parameters,
+            'created': time.time(),
+            'started': None,
+            'finished': None,
+            'progress': None,
+            'result': None,
+            'error': None,
+        }
+        self._put(job)
+        return job
+
+    def get(self, job_id):
+        """Get a job record by ID, or ``None`` if there is no such job."""
+        raise NotImplementedError
+
+    def update(self, job_id, **fields):
+        """Update fields of an existing job record."""
+        raise NotImplementedError
+
+    def _put(self, job):
+        raise NotImplementedError
+
+
+class InMemoryJobStore(JobStore):
+    """Job store backed by a dict in the memory of this process.
+
+    Args:
+        ttl (int): number of seconds to keep a job record.
+    """
+
+    def __init__(self, ttl=JOB_TTL):
+        self.ttl = ttl
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def _expire(self):
+        # Caller must hold self._lock
+        cutoff = time.time() - self.ttl
+        for job_id in [job_id for job_id, job in self._jobs.items()
+                       if job['created'] < cutoff]:
+            del self._jobs[job_id]
+
+    def _put(self, job):
+        with self._lock:
+            self._expire()
+            self._jobs[job['job_id']] = job
+
+    def get(self, job_id):
+        with self._lock:
+            try:
+                return dict(self._jobs[job_id])
+            except KeyError:
+                return None
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            self._jobs[job_id].update(fields)
+
+
+class RedisJobStore(JobStore):
+    """Job store backed by Redis, shared by all workers.
+
+    Args:
+        url (str): the redis URL, e.g. ``redis://localhost:6379/0``.
+        ttl (int): number of seconds to keep a job record.
+    """
+
+    def __init__(self, url, ttl=JOB_TTL):
+        # Imported here so that redis is only needed when it's used.
+        import redis
+        self.ttl = ttl
+        self._redis = redis.Redis.from_url(url)
+
+    @staticmethod
+    def _key(job_id):
+        return f'clipping-service:job:{job_id}'
+
+    def _put(self, job):
+        self._redis.set(self._key(job['job_id']), json.dumps(job), ex=self.ttl)
+
+    def get(self, job_id):
+        value = self._redis.get(self._key(job_id))
+        if value is None:
+            return None
+        return json.loads(value)
+
+    def update(self, job_id, **fields):
+        # Only the thread running a job updates it, so a read-modify-write
+        # is safe here.
+        job = self.get(job_id)
+        job.update(fields)
+        self._redis.set(self._key(job_id), json.dumps(job), keepttl=True)
+
+
+def get_job_store(url=None):
+    """Create the job store named by a URL.
+
+    Args:
+        url=None (str): ``memory://`` or a ``redis://`` URL.  If ``None``,
+            the ``JOB_STORE_URL`` environment variable is used.
+
+    Returns:
+        A ``JobStore`` instance.
+    """
+    if url is None:
+        url = os.environ.get('JOB_STORE_URL', 'memory://')
+    if url.startswith('memory://'):
+        return InMemoryJobStore()
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisJobStore(url)
+    raise ValueError(f"Unsupported job store: {url}")
+
+
+class JobQueue:
+    """A bounded pool of threads executing jobs from a job store.
+
+    Args:
+        store (JobStore): where job records are kept.
+        max_workers (int): the number of jobs that may run at once.
+        max_pending (int): the number of jobs that may wait for a worker.
+            Submitting a job when the queue is full raises ``QueueFull``.
+    """
+
+    def __init__(self, store, max_workers, max_pending):
+        self.store = store
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='clip-job')
+        self._slots = threading.BoundedSemaphore(max_workers + max_pending)
+
+    def submit(self, func, parameters):
+        """Submit a job.
+
+        Args:
+            func (callable): called as ``func(parameters)`` in a worker
+                thread.  The return value must be JSON-serializable and is
+                stored as the job's result.
+            parameters (dict): the job parameters.
+
+        Returns:
+            The new job record (dict).
+
+        Raises:
+            QueueFull: if there is no room for another job.
+        """
+        if not self._slots.acquire(blocking=False):
+            raise QueueFull("The clip queue is full; try again later.")
+        try:
+            job = self.store.create(parameters)
+            self._executor.submit(
+                self._run, job['job_id'], func, parameters, job['created'])
+        except Exception:
+            self._slots.release()
+            raise
+        return job
+
+    def _run(self, job_id, func, parameters, created):
+        # Save progress to the store so that workers other than this one can
+        # report on the job, but don't write to the store on every event.
+        save_progress = progress.Throttle(
+            lambda event: self.store.update(job_id, progress=event),
+            PROGRESS_SAVE_PERIOD)
+        try:
+            started = time.time()
+            metrics.record_queue_wait('job', started - created)
+            self.store.update(job_id, status=RUNNING, started=started)
+            try:
+                with progress.job_context(job_id, on_update=save_progress):
+                    result = func(parameters)
+            except Exception as error:
+                LOGGER.exception("Job %s failed", job_id)
+                self.store.update(job_id, status=FAILURE, error=str(error),
+                                  finished=time.time())
+            else:
+                self.store.update(job_id, status=SUCCESS, result=result,
+                                  finished=time.time())
+        finally:
+            self._slots.release()
@@ -0,0 +1,176 @@
+"""Cache of parsed metadata documents.
+
+app/metadata_cache.py
+
+The mappreview clip dialog asks for the same few ``.yml`` metadata documents
+over and over.  Parsed documents are kept in memory; once an entry is older
+than ``fresh_ttl`` it is still served, but revalidated in the background with
+a conditional request (``If-None-Match``/``If-Modified-Since``) so an
+unchanged document costs a ``304`` and no parsing.  Entries older than
+``stale_ttl`` are revalidated before they are served, though a stale copy is
+still served if the host can't be reached.
+"""
+import collections
+import concurrent.futures
+import logging
+import threading
+import time
+
+import requests
+import yaml
+
+import remote
+
+try:
+    import httpx
+except ImportError:
+    # Only needed by the ASGI app; see asgi.py.
+    httpx = None
+
+LOGGER = logging.getLogger(__name__)
+
+# Use the C-accelerated loader when libyaml is available.
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# Seconds to wait for a metadata document.
+REQUEST_TIMEOUT = 10
+
+
+class MetadataCache:
+    """An in-memory LRU cache of parsed YAML documents keyed by URL.
+
+    Args:
+        fresh_ttl (float): seconds during which an entry is served without
+            revalidation.
+        stale_ttl (float): seconds during which an entry may be served while
+            it is revalidated in the background.
+        max_entries (int): the maximum number of documents to keep.
+    """
+
+    def __init__(self, fresh_ttl, stale_ttl, max_entries):
+        self.fresh_ttl = fresh_ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._revalidating = set()
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=2, thread_name_prefix='metadata-revalidate')
+
+    def get(self, url):
+        """Get the parsed document at ``url``.
+
+        Raises:
+            requests.RequestException: if the document could not be fetched
+                and there is no usable cached copy.
+        """
+        entry = self._lookup(url)
+        if entry is not None and self._servable(url, entry):
+            return entry['data']
+
+        try:
+            return self._fetch(url, entry)['data']
+        except requests.RequestException:
+            if entry is None:
+                raise
+            LOGGER.warning("Serving a stale copy of %s", url, exc_info=True)
+            return entry['data']
+
+    async def get_async(self, url, client):
+        """Get the parsed document at ``url`` without blocking.
+
+        Like ``get``, but documents are fetched with an
+        ``httpx.AsyncClient``.  Background revalidation still uses threads.
+
+        Raises:
+            httpx.HTTPError: if the document could not be fetched and there
+                is no usable cached copy.
+        """
+        entry = self._lookup(url)
+        if entry is not None and self._servable(url, entry):
+            return entry['data']
+
+        try:
+            response = await client.get(
+                url, headers=self._conditional_headers(entry),
+                timeout=REQUEST_TIMEOUT)
+            return self._store(url, entry, response)['data']
+        except httpx.HTTPError:
+            if entry is None:
+                raise
+            LOGGER.warning("Serving a stale copy of %s", url, exc_info=True)
+            return entry['data']
+
+    def _lookup(self, url):
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None:
+                self._entries.move_to_end(url)
+        return entry
+
+    def _servable(self, url, entry):
+        """Whether an entry may be served now, revalidating it if stale."""
+        age = time.time() - entry['fetched']
+        if age < self.fresh_ttl:
+            return True
+        if age < self.stale_ttl:
+            self._revalidate_in_background(url)
+            return True
+        return False
+
+    def _revalidate_in_background(self, url):
+        with self._lock:
+            if url in self._revalidating:
+                return
+            self._revalidating.add(url)
+
+        def _revalidate():
+            try:
+                with self._lock:
+                    entry = self._entries.get(url)
+                self._fetch(url, entry)
+            except Exception:
+                LOGGER.warning("Failed to revalidate %s", url, exc_info=True)
+            finally:
+                with self._lock:
+                    self._revalidating.discard(url)
+
+        self._executor.submit(_revalidate)
+
+    def _fetch(self, url, entry):
+        """Fetch a document, conditionally if there is a cached entry."""
+        response = remote.SESSION.get(
+            url, headers=self._conditional_headers(entry),
+            timeout=REQUEST_TIMEOUT)
+        return self._store(url, entry, response)
+
+    @staticmethod
+    def _conditional_headers(entry):
+        headers = {}
+        if entry is not None:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def _store(self, url, entry, response):
+        """Cache the document of a ``requests`` or ``httpx`` response."""
+        if response.status_code == 304 and entry is not None:
+            LOGGER.debug("%s is unchanged", url)
+            new_entry = dict(entry, fetched=time.time())
+        else:
+            response.raise_for_status()
+            new_entry = {
+                'data': yaml.load(response.content, Loader=YAML_LOADER),
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'fetched': time.time(),
+            }
+
+        with self._lock:
+            self._entries[url] = new_entry
+            self._entries.move_to_end(url)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return new_entry
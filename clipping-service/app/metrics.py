@@ -0,0 +1,261 @@
+"""Metrics and per-clip timing.
+
+app/metrics.py
+
+Metrics are served at ``/metrics`` in the Prometheus text format.  gunicorn
+runs several worker processes, so set ``PROMETHEUS_MULTIPROC_DIR`` to an
+empty directory that every worker can write to, and ``/metrics`` adds up the
+metrics of all of them.  Without it, each scrape only sees the worker that
+served it.  gunicorn.conf.py empties the directory when gunicorn starts and
+marks the metrics of exited workers as dead.
+
+Each clip is also traced.  ``trace()`` starts a trace on the current thread,
+``phase()`` times a phase of the clip (reading the source's info,
+transforming the bounding box, warping, uploading...) and ``record()`` adds
+fields such as feature counts or the output size.  When the clip ends, its
+trace is logged as one JSON line and its phases and fields are added to the
+metrics.
+
+Clip durations are labelled with the deployment's GDAL profile (see
+gdal_profile.py), and each trace includes it, to compare profiles.
+
+Bytes read through ``/vsicurl/`` come from GDAL's network statistics, which
+are counted for the whole process: when clips run concurrently, each one's
+trace includes what the others read meanwhile.  The metrics total is exact.
+"""
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+
+import prometheus_client
+import prometheus_client.multiprocess
+from osgeo import gdal
+
+import gdal_profile
+
+LOGGER = logging.getLogger(__name__)
+
+CONTENT_TYPE = prometheus_client.CONTENT_TYPE_LATEST
+
+# Buckets for timings from milliseconds to a long clip.
+_SECONDS_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120,
+    300, 600, 1800)
+# Buckets for sizes from 1 KiB to 16 GiB.
+_BYTES_BUCKETS = tuple(4**exponent * 1024 for exponent in range(13))
+
+CLIPS = prometheus_client.Counter(
+    'clip_requests', "Clips, by layer type and outcome.",
+    ['layer_type', 'outcome'])
+CLIP_SECONDS = prometheus_client.Histogram(
+    'clip_duration_seconds', "Time to serve a clip.",
+    ['layer_type', 'gdal_profile'], buckets=_SECONDS_BUCKETS)
+PHASE_SECONDS = prometheus_client.Histogram(
+    'clip_phase_duration_seconds', "Time spent in each phase of a clip.",
+    ['layer_type', 'phase'], buckets=_SECONDS_BUCKETS)
+OUTPUT_BYTES = prometheus_client.Histogram(
+    'clip_output_bytes', "Size of clipped files.", ['layer_type'],
+    buckets=_BYTES_BUCKETS)
+NETWORK_BYTES = prometheus_client.Counter(
+    'clip_vsicurl_read_bytes', "Bytes downloaded by GDAL through /vsicurl/.")
+NETWORK_REQUESTS = prometheus_client.Counter(
+    'clip_vsicurl_requests', "HTTP requests made by GDAL through /vsicurl/.")
+FEATURES = prometheus_client.Counter(
+    'clip_features', "Features of vector clips, by state.", ['state'])
+CACHE_LOOKUPS = prometheus_client.Counter(
+    'clip_cache_lookups', "Cache lookups, by cache and result.",
+    ['cache', 'result'])
+QUEUE_SECONDS = prometheus_client.Histogram(
+    'clip_queue_wait_seconds', "Time clips wait in a queue before running.",
+    ['queue'], buckets=_SECONDS_BUCKETS)
+UPLOAD_BYTES = prometheus_client.Counter(
+    'clip_upload_bytes', "Bytes uploaded to the storage target.")
+UPLOAD_FAILURES = prometheus_client.Counter(
+    'clip_upload_failures', "Uploads that failed after every retry.")
+
+# Network statistics are only counted once enabled.
+gdal.SetConfigOption('CPL_VSIL_NETWORK_STATS_ENABLED', 'YES')
+
+_LOCAL = threading.local()
+_NETWORK_LOCK = threading.Lock()
+_network_totals = {'bytes': 0, 'requests': 0}
+
+
+def _network_stats():
+    """Get the bytes downloaded and requests made by GDAL so far.
+
+    Returns:
+        A tuple of the number of bytes and requests, or ``None`` if this GDAL
+        doesn't count them.
+    """
+    if not hasattr(gdal, 'NetworkStatsGetAsSerializedJSON'):
+        return None
+    stats = json.loads(gdal.NetworkStatsGetAsSerializedJSON() or '{}')
+    methods = stats.get('methods', {}).values()
+    return (sum(method.get('downloaded_bytes', 0) for method in methods),
+            sum(method.get('count', 0) for method in methods))
+
+
+def _update_network_metrics():
+    """Add what GDAL read since the last update to the metrics."""
+    stats = _network_stats()
+    if stats is None:
+        return
+    with _NETWORK_LOCK:
+        nbytes, nrequests = stats
+        NETWORK_BYTES.inc(max(0, nbytes - _network_totals['bytes']))
+        NETWORK_REQUESTS.inc(max(0, nrequests - _network_totals['requests']))
+        _network_totals.update(bytes=nbytes, requests=nrequests)
+
+
+class Trace:
+    """The phases and fields of one clip.
+
+    Args:
+        layer_type (str): ``raster``, ``vector`` or ``batch``.
+        **fields: fields to log with the trace, e.g. the ``file_url``.
+    """
+
+    def __init__(self, layer_type, **fields):
+        self.layer_type = layer_type
+        self.fields = fields
+        self.phases = {}
+        self.start = time.perf_counter()
+        self.network_start = _network_stats()
+
+    def add_phase(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def finish(self, outcome):
+        """Log the trace and add its clip to the metrics."""
+        seconds = time.perf_counter() - self.start
+        CLIPS.labels(self.layer_type, outcome).inc()
+        CLIP_SECONDS.labels(
+            self.layer_type, gdal_profile.NAME).observe(seconds)
+        _update_network_metrics()
+
+        entry = {
+            'layer_type': self.layer_type,
+            'outcome': outcome,
+            'seconds': round(seconds, 3),
+            'gdal_profile': gdal_profile.NAME,
+            'phases': {name: round(phase_seconds, 3)
+                       for name, phase_seconds in self.phases.items()},
+            **self.fields,
+        }
+        network_end = _network_stats()
+        if self.network_start is not None and network_end is not None:
+            entry['vsicurl_bytes'] = network_end[0] - self.network_start[0]
+            entry['vsicurl_requests'] = network_end[1] - self.network_start[1]
+        LOGGER.info("Clip trace: %s", json.dumps(entry, default=str))
+
+
+def _current_trace():
+    return getattr(_LOCAL, 'trace', None)
+
+
+@contextlib.contextmanager
+def trace(layer_type, **fields):
+    """Trace a clip running on this thread.
+
+    Traces don't nest: within a trace, this does nothing.
+
+    Args:
+        layer_type (str): ``raster``, ``vector`` or ``batch``.
+        **fields: fields to log with the trace.
+
+    Yields:
+        The ``Trace``, or ``None`` if a trace is already running.
+    """
+    if _current_trace() is not None:
+        yield None
+        return
+    clip_trace = Trace(layer_type, **fields)
+    _LOCAL.trace = clip_trace
+    outcome = 'failure'
+    try:
+        yield clip_trace
+        outcome = 'success'
+    finally:
+        _LOCAL.trace = None
+        clip_trace.finish(outcome)
+
+
+@contextlib.contextmanager
+def phase(name, layer_type=None):
+    """Time a phase of the clip running on this thread.
+
+    Args:
+        name (str): the name of the phase, e.g. ``file_info`` or ``upload``.
+        layer_type=None (str): the layer type to count the phase under.
+            Defaults to that of the current trace.
+    """
+    clip_trace = _current_trace()
+    if layer_type is None:
+        layer_type = clip_trace.layer_type if clip_trace else 'unknown'
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        PHASE_SECONDS.labels(layer_type, name).observe(seconds)
+        if clip_trace is not None:
+            clip_trace.add_phase(name, seconds)
+
+
+def record(**fields):
+    """Add fields to the trace of the clip running on this thread."""
+    clip_trace = _current_trace()
+    if clip_trace is not None:
+        clip_trace.fields.update(fields)
+
+
+def record_output(layer_type, nbytes):
+    """Count the size of a clipped file."""
+    OUTPUT_BYTES.labels(layer_type).observe(nbytes)
+    record(output_bytes=nbytes)
+
+
+def record_features(n_processed, n_kept, n_invalid):
+    """Count the features of a vector clip."""
+    FEATURES.labels('processed').inc(n_processed)
+    FEATURES.labels('kept').inc(n_kept)
+    FEATURES.labels('invalid').inc(n_invalid)
+    record(features_processed=n_processed, features_kept=n_kept,
+           features_invalid=n_invalid)
+
+
+def record_cache_lookup(cache, hit):
+    """Count a lookup in one of the caches."""
+    CACHE_LOOKUPS.labels(cache, 'hit' if hit else 'miss').inc()
+    record(**{f'{cache}_cache': 'hit' if hit else 'miss'})
+
+
+def record_queue_wait(queue_name, seconds):
+    """Count the time a clip waited in a queue before it could run."""
+    QUEUE_SECONDS.labels(queue_name).observe(seconds)
+    clip_trace = _current_trace()
+    if clip_trace is not None:
+        clip_trace.add_phase(f'{queue_name}_wait', seconds)
+
+
+def record_upload(nbytes):
+    UPLOAD_BYTES.inc(nbytes)
+
+
+def record_upload_failure():
+    UPLOAD_FAILURES.inc()
+
+
+def render():
+    """Get the metrics in the Prometheus text format (bytes)."""
+    _update_network_metrics()
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = prometheus_client.CollectorRegistry()
+        prometheus_client.multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    return prometheus_client.generate_latest(registry)
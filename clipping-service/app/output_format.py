@@ -0,0 +1,254 @@
+"""Output formats of clips.
+
+app/output_format.py
+
+Raster clips may be written as:
+
+    * ``gtiff``, a tiled GeoTIFF, or
+    * ``cog``, a Cloud Optimized GeoTIFF with internal overviews.
+
+Vector clips may be written as:
+
+    * ``fgb``, a FlatGeobuf,
+    * ``gpkg``, a GeoPackage, or
+    * ``parquet``, a GeoParquet file.
+
+Rasters and GeoParquet files are compressed with ``compression`` at
+``compression_level``, which default to ``CLIP_COMPRESSION`` and
+``CLIP_COMPRESSION_LEVEL``.  Rasters also get a predictor suited to their
+data type, which usually makes them much smaller.  FlatGeobufs and
+GeoPackages aren't compressed, so asking for a compression or level other
+than ``NONE`` for them is an error, as is asking for a level of a
+compression without levels.
+
+A clip without any output option is left as the clipping engines write it:
+an LZW-compressed COG (see ``raster_clip.default_output_spec``) or a
+FlatGeobuf.  Once any option is given, the format defaults to ``cog`` or
+``fgb``.
+"""
+import os
+
+from osgeo import gdal
+
+RASTER = 'raster'
+VECTOR = 'vector'
+
+# Format name: (GDAL driver, file extension)
+RASTER_FORMATS = {
+    'gtiff': ('GTiff', '.tif'),
+    'cog': ('COG', '.tif'),
+}
+VECTOR_FORMATS = {
+    'fgb': ('FlatGeobuf', '.fgb'),
+    'gpkg': ('GPKG', '.gpkg'),
+    'parquet': ('Parquet', '.parquet'),
+}
+DEFAULT_FORMATS = {RASTER: 'cog', VECTOR: 'fgb'}
+
+# Compression: the range of its levels, or None if it has no levels.
+COMPRESSION_LEVELS = {
+    'DEFLATE': (1, 12),
+    'ZSTD': (1, 22),
+    'LZW': None,
+    'NONE': None,
+}
+DEFAULT_COMPRESSION = os.environ.get('CLIP_COMPRESSION', 'DEFLATE').upper()
+DEFAULT_COMPRESSION_LEVEL = (
+    int(os.environ['CLIP_COMPRESSION_LEVEL'])
+    if os.environ.get('CLIP_COMPRESSION_LEVEL') else None)
+
+# GeoParquet is only compressed with these.
+_PARQUET_COMPRESSIONS = {'ZSTD', 'NONE'}
+
+# Formats that aren't compressed.
+_UNCOMPRESSED_FORMATS = {'fgb', 'gpkg'}
+
+# The GTiff driver's creation option for the level of each compression with
+# levels; the COG driver takes LEVEL for all of them.
+_GTIFF_LEVEL_OPTIONS = {
+    'DEFLATE': 'ZLEVEL',
+    'ZSTD': 'ZSTD_LEVEL',
+}
+
+
+def parse(layer_type, output_format=None, compression=None,
+          compression_level=None):
+    """Check and complete the output options of a clip.
+
+    Args:
+        layer_type (str): ``raster`` or ``vector``.
+        output_format=None (str): one of the formats of the layer type, or
+            ``None`` for the default.
+        compression=None (str): one of ``COMPRESSION_LEVELS``, or ``None``
+            for the default.
+        compression_level=None (int): the compression level, or ``None`` for
+            the default.
+
+    Returns:
+        A dict of the ``format``, its GDAL ``driver`` and file
+        ``extension``, the ``compression`` and the ``compression_level``
+        (``None`` for formats that aren't compressed); or ``None`` if no
+        option is given, in which case the clip is left as the clipping
+        engines write it.
+
+    Raises:
+        ValueError: if an option is not valid.
+    """
+    if output_format is compression is compression_level is None:
+        return None
+
+    formats = RASTER_FORMATS if layer_type == RASTER else VECTOR_FORMATS
+    if output_format is None:
+        output_format = DEFAULT_FORMATS[layer_type]
+    output_format = str(output_format).lower()
+    if output_format not in formats:
+        raise ValueError(
+            f"Invalid output_format for a {layer_type}: {output_format}. "
+            f"Choose one of {', '.join(formats)}.")
+    driver, extension = formats[output_format]
+
+    if output_format in _UNCOMPRESSED_FORMATS:
+        if ((compression is not None and
+                str(compression).upper() != 'NONE') or
+                compression_level is not None):
+            raise ValueError(
+                f"{output_format} outputs can't be compressed; leave out "
+                "compression and compression_level.")
+        return {
+            'format': output_format,
+            'driver': driver,
+            'extension': extension,
+            'compression': None,
+            'compression_level': None,
+        }
+
+    if compression is None:
+        compression = DEFAULT_COMPRESSION
+        if output_format == 'parquet':
+            compression = 'ZSTD'
+    compression = str(compression).upper()
+    if compression not in COMPRESSION_LEVELS:
+        raise ValueError(
+            f"Invalid compression: {compression}. Choose one of "
+            f"{', '.join(COMPRESSION_LEVELS)}.")
+    if output_format == 'parquet' and compression not in _PARQUET_COMPRESSIONS:
+        raise ValueError(
+            "GeoParquet outputs may only be compressed with ZSTD or NONE.")
+
+    level_range = COMPRESSION_LEVELS[compression]
+    if compression_level is None:
+        compression_level = DEFAULT_COMPRESSION_LEVEL
+        if level_range is None:
+            # The default level may be meant for another compression.
+            compression_level = None
+    if compression_level is not None:
+        if level_range is None:
+            raise ValueError(f"{compression} has no compression levels.")
+        try:
+            compression_level = int(compression_level)
+        except (TypeError, ValueError):
+            raise ValueError(
+                f"Invalid compression_level: {compression_level}")
+        if not level_range[0] <= compression_level <= level_range[1]:
+            raise ValueError(
+                f"compression_level must be from {level_range[0]} to "
+                f"{level_range[1]} for {compression}.")
+
+    return {
+        'format': output_format,
+        'driver': driver,
+        'extension': extension,
+        'compression': compression,
+        'compression_level': compression_level,
+    }
+
+
+def raster_creation_options(spec, datatype, n_threads=1):
+    """Get the creation options of a raster output.
+
+    Args:
+        spec (dict): as returned by ``parse``.
+        datatype (int): the GDAL data type of the raster.
+        n_threads=1 (int): the number of threads to compress with.
+
+    Returns:
+        A list of creation options.
+    """
+    options = [f"COMPRESS={spec['compression']}", 'BIGTIFF=IF_SAFER',
+               f'NUM_THREADS={n_threads}']
+    if spec['compression'] != 'NONE':
+        # Floating point predictor for floats, horizontal differencing
+        # otherwise.
+        is_float = gdal.GetDataTypeName(datatype).startswith(
+            ('Float', 'CFloat'))
+        options.append(f"PREDICTOR={3 if is_float else 2}")
+    if spec['compression_level'] is not None:
+        if spec['driver'] == 'COG':
+            level_option = 'LEVEL'
+        else:
+            level_option = _GTIFF_LEVEL_OPTIONS[spec['compression']]
+        options.append(f"{level_option}={spec['compression_level']}")
+    if spec['driver'] == 'COG':
+        options.append('OVERVIEWS=AUTO')
+    else:
+        options.append('TILED=YES')
+    return options
+
+
+def vector_layer_options(spec):
+    """Get the layer creation options of a vector output."""
+    if spec['driver'] == 'Parquet':
+        options = [f"COMPRESSION={spec['compression']}",
+                   'GEOMETRY_ENCODING=WKB']
+        if spec['compression_level'] is not None:
+            options.append(f"COMPRESSION_LEVEL={spec['compression_level']}")
+        return options
+    if spec['driver'] == 'FlatGeobuf':
+        return ['SPATIAL_INDEX=YES']
+    return []
+
+
+def convert_raster(source_path, target_path, spec, n_threads=1):
+    """Write a raster in an output format.
+
+    Args:
+        source_path (str): the raster, or a VRT, to convert.
+        target_path (str): where to write the output.
+        spec (dict): as returned by ``parse``.
+        n_threads=1 (int): the number of threads to compress with.
+
+    Returns:
+        None
+    """
+    source = gdal.OpenEx(source_path, gdal.OF_RASTER)
+    datatype = source.GetRasterBand(1).DataType
+    options = gdal.TranslateOptions(
+        format=spec['driver'],
+        creationOptions=raster_creation_options(spec, datatype, n_threads))
+    target = gdal.Translate(target_path, source, options=options)
+    if target is None:
+        raise RuntimeError(
+            f"Failed to write {target_path}: {gdal.GetLastErrorMsg()}")
+    target = None
+    source = None
+
+
+def convert_vector(source_path, target_path, spec):
+    """Write a vector in an output format.
+
+    Args:
+        source_path (str): the vector to convert.
+        target_path (str): where to write the output.
+        spec (dict): as returned by ``parse``.
+
+    Returns:
+        None
+    """
+    target = gdal.VectorTranslate(
+        target_path, source_path, options=gdal.VectorTranslateOptions(
+            format=spec['driver'],
+            layerCreationOptions=vector_layer_options(spec)))
+    if target is None:
+        raise RuntimeError(
+            f"Failed to write {target_path}: {gdal.GetLastErrorMsg()}")
+    target = None
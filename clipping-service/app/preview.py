@@ -0,0 +1,377 @@
+"""Quicklook previews of clips.
+
+app/preview.py
+
+A preview is a small RGBA PNG of a clip's bounding box in its target
+projection, at most ``PREVIEW_MAX_SIZE`` pixels wide or high, rendered
+without doing the clip:
+
+    * rasters are warped from the COG overview closest to the preview's
+      resolution (see ``raster_clip.choose_overview_level``), so only a few
+      blocks are read.  Single band rasters are drawn through their color
+      table if they have one and stretched to grayscale otherwise; byte
+      rasters of three or more bands are drawn as RGB.  Nodata is
+      transparent.
+    * vectors are read decimated: the bounding box is split into a grid of
+      ``PREVIEW_GRID`` by ``PREVIEW_GRID`` cells, and at most
+      ``PREVIEW_MAX_FEATURES`` features are read, spread evenly over the
+      cells.  Attributes are not read.  The features are drawn in a single
+      color.
+
+Previews are rendered within a time budget.  A raster preview that runs out
+of time raises ``PreviewTimeout``; a vector preview draws the features read
+so far and is marked incomplete.  The area of interest of a clip, if any,
+masks the preview as it would the clip.
+"""
+import itertools
+import logging
+import math
+import os
+import time
+import uuid
+
+import numpy
+import pygeoprocessing
+import shapely
+from osgeo import gdal
+from osgeo import ogr
+
+import raster_clip
+import vector_clip
+
+LOGGER = logging.getLogger(__name__)
+
+# Seconds a preview may take, including reading the source's info.
+PREVIEW_TIME_BUDGET = float(os.environ.get('CLIP_PREVIEW_TIME_BUDGET', 5))
+
+# The width or height of a preview, whichever is larger, in pixels.
+PREVIEW_DEFAULT_SIZE = 512
+PREVIEW_MAX_SIZE = 1024
+
+# Vector previews draw at most this many features.
+PREVIEW_MAX_FEATURES = int(
+    os.environ.get('CLIP_PREVIEW_MAX_FEATURES', 20000))
+PREVIEW_GRID = 8
+
+# The RGBA color features are drawn in.
+_FEATURE_COLOR = (31, 119, 180, 200)
+
+# Percentiles single band rasters are stretched between.
+_STRETCH_PERCENTILES = (2, 98)
+
+
+class PreviewTimeout(Exception):
+    """Raised when a preview can't be rendered within its time budget."""
+
+
+def _grid(bbox, size):
+    """Fit a grid of at most ``size`` pixels a side to a bounding box.
+
+    Returns:
+        A tuple of the geotransform and the number of columns and rows.
+    """
+    width = bbox[2] - bbox[0]
+    height = bbox[3] - bbox[1]
+    if width >= height:
+        n_cols = size
+        n_rows = max(1, round(size * height / width))
+    else:
+        n_rows = size
+        n_cols = max(1, round(size * width / height))
+    geotransform = (
+        bbox[0], width / n_cols, 0, bbox[3], 0, -height / n_rows)
+    return geotransform, n_cols, n_rows
+
+
+def _to_projection(geometries, source_projection_wkt, target_projection_wkt):
+    """Reproject Shapely geometries, densifying them first.
+
+    Args:
+        geometries (numpy.ndarray): the geometries to reproject.
+        source_projection_wkt (str): their projection.
+        target_projection_wkt (str): the projection to reproject to, or
+            ``None`` to keep them as they are.
+
+    Returns:
+        An array of geometries.
+    """
+    if target_projection_wkt is None or len(geometries) == 0:
+        return geometries
+    xmin, ymin, xmax, ymax = shapely.total_bounds(geometries)
+    geometries = shapely.segmentize(
+        geometries, max(xmax - xmin, ymax - ymin) / 256)
+    return vector_clip._reproject(
+        geometries, vector_clip._cached_transformer(
+            source_projection_wkt, target_projection_wkt))
+
+
+def _rasterize(geometries, geotransform, n_cols, n_rows):
+    """Get the pixels of a grid that geometries touch.
+
+    Returns:
+        A boolean array of shape ``(n_rows, n_cols)``.
+    """
+    raster = gdal.GetDriverByName('MEM').Create(
+        '', n_cols, n_rows, 1, gdal.GDT_Byte)
+    raster.SetGeoTransform(geotransform)
+    vector = ogr.GetDriverByName('Memory').CreateDataSource('')
+    layer = vector.CreateLayer('geometries', None, ogr.wkbUnknown)
+    for geometry in geometries:
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetGeometry(ogr.CreateGeometryFromWkb(
+            shapely.to_wkb(geometry)))
+        layer.CreateFeature(feature)
+    gdal.RasterizeLayer(
+        raster, [1], layer, burn_values=[1], options=['ALL_TOUCHED=TRUE'])
+    return raster.GetRasterBand(1).ReadAsArray() > 0
+
+
+def _encode_png(rgba):
+    """Encode an RGBA image as a PNG.
+
+    Args:
+        rgba (numpy.ndarray): a uint8 array of shape ``(4, n_rows, n_cols)``.
+
+    Returns:
+        The PNG (bytes).
+    """
+    n_rows, n_cols = rgba.shape[1:]
+    raster = gdal.GetDriverByName('MEM').Create(
+        '', n_cols, n_rows, 4, gdal.GDT_Byte)
+    for index in range(4):
+        raster.GetRasterBand(index + 1).WriteArray(rgba[index])
+    png_path = f'/vsimem/preview-{uuid.uuid4()}.png'
+    gdal.GetDriverByName('PNG').CreateCopy(png_path, raster)
+    try:
+        png_file = gdal.VSIFOpenL(png_path, 'rb')
+        try:
+            nbytes = gdal.VSIStatL(png_path).size
+            return bytes(gdal.VSIFReadL(1, nbytes, png_file))
+        finally:
+            gdal.VSIFCloseL(png_file)
+    finally:
+        gdal.Unlink(png_path)
+
+
+def _http_timeout(deadline):
+    """Get GDAL options that stop HTTP requests at a deadline."""
+    remaining = max(1, math.ceil(deadline - time.monotonic()))
+    return {'GDAL_HTTP_TIMEOUT': str(remaining),
+            'GDAL_HTTP_MAX_RETRY': '0'}
+
+
+def _stretch(array, valid):
+    """Stretch a band to bytes between percentiles of its valid pixels."""
+    values = array[valid]
+    if values.size == 0:
+        return numpy.zeros(array.shape, dtype=numpy.uint8)
+    low, high = numpy.percentile(values, _STRETCH_PERCENTILES)
+    if high <= low:
+        high = low + 1
+    return numpy.clip(
+        (array - low) / (high - low) * 255, 0, 255).astype(numpy.uint8)
+
+
+def _raster_rgba(warped, source_band):
+    """Color a warped raster whose last band is an alpha band.
+
+    Args:
+        warped (gdal.Dataset): the warped preview.
+        source_band (gdal.Band): the first band of the source, for its color
+            table.
+
+    Returns:
+        A uint8 array of shape ``(4, n_rows, n_cols)``.
+    """
+    n_bands = warped.RasterCount - 1
+    alpha = warped.GetRasterBand(warped.RasterCount).ReadAsArray()
+    first_band = warped.GetRasterBand(1)
+    color_table = source_band.GetColorTable()
+    if n_bands >= 3 and first_band.DataType == gdal.GDT_Byte:
+        rgb = [warped.GetRasterBand(index).ReadAsArray()
+               for index in range(1, 4)]
+    elif color_table is not None:
+        lookup = numpy.zeros((max(color_table.GetCount(), 256), 4),
+                             dtype=numpy.uint8)
+        for index in range(color_table.GetCount()):
+            lookup[index] = color_table.GetColorEntry(index)
+        colors = lookup[numpy.clip(
+            first_band.ReadAsArray().astype(numpy.int64), 0,
+            len(lookup) - 1)]
+        rgb = [colors[..., index] for index in range(3)]
+        alpha = numpy.minimum(alpha, colors[..., 3])
+    else:
+        gray = _stretch(
+            first_band.ReadAsArray().astype(numpy.float64), alpha > 0)
+        rgb = [gray, gray, gray]
+    return numpy.stack(rgb + [alpha]).astype(numpy.uint8)
+
+
+def render_raster(source_raster_path, raster_info, source_bbox, target_bbox,
+                  target_projection_wkt=None, mask_geometry=None,
+                  size=PREVIEW_DEFAULT_SIZE, deadline=None):
+    """Render a preview of a raster clip.
+
+    Args:
+        source_raster_path (str): path to the raster, e.g. a ``/vsicurl/``
+            path.
+        raster_info (dict): the info of the raster, with its
+            ``overview_pixel_sizes``; see app.py's ``cached_file_info``.
+        source_bbox (list): the clip's bounding box in the source
+            projection.
+        target_bbox (list): the clip's bounding box in the target projection.
+        target_projection_wkt=None (str): the target projection, or ``None``
+            to keep the source's.
+        mask_geometry=None (shapely.Geometry): a polygon in the source
+            projection to mask the preview with.
+        size=PREVIEW_DEFAULT_SIZE (int): the width or height of the preview,
+            whichever is larger.
+        deadline=None (float): the ``time.monotonic()`` by which the preview
+            must be rendered.  Defaults to ``PREVIEW_TIME_BUDGET`` from now.
+
+    Returns:
+        A tuple of the PNG (bytes) and whether it is complete, which is
+        always ``True`` for rasters.
+
+    Raises:
+        PreviewTimeout: if the preview can't be rendered by the deadline.
+    """
+    if deadline is None:
+        deadline = time.monotonic() + PREVIEW_TIME_BUDGET
+    geotransform, n_cols, n_rows = _grid(target_bbox, size)
+    overview_level = raster_clip.choose_overview_level(
+        raster_info, source_bbox, target_bbox,
+        [geotransform[1], geotransform[5]])
+
+    def _callback(complete, message, data):
+        # Returning 0 interrupts the warp.
+        return 0 if time.monotonic() > deadline else 1
+
+    options = gdal.WarpOptions(
+        format='MEM',
+        outputBounds=target_bbox,
+        width=n_cols,
+        height=n_rows,
+        dstSRS=target_projection_wkt,
+        resampleAlg='near',
+        overviewLevel=('NONE' if overview_level == raster_clip.BASE_LEVEL
+                       else overview_level),
+        dstAlpha=True,
+        callback=_callback)
+    source_raster = None
+    try:
+        with gdal.config_options(_http_timeout(deadline)):
+            source_raster = gdal.OpenEx(source_raster_path, gdal.OF_RASTER)
+            warped = gdal.Warp('', source_raster, options=options)
+    except RuntimeError:
+        warped = None
+    if warped is None:
+        if time.monotonic() > deadline:
+            raise PreviewTimeout(
+                f"The preview took longer than {PREVIEW_TIME_BUDGET} "
+                "seconds.")
+        raise RuntimeError(
+            f"Failed to render a preview of {source_raster_path}: "
+            f"{gdal.GetLastErrorMsg()}")
+
+    rgba = _raster_rgba(warped, source_raster.GetRasterBand(1))
+    if mask_geometry is not None:
+        mask = _to_projection(
+            numpy.array([mask_geometry]), raster_info['projection_wkt'],
+            target_projection_wkt)
+        rgba[3][~_rasterize(mask, geotransform, n_cols, n_rows)] = 0
+    warped = None
+    source_raster = None
+    return _encode_png(rgba), True
+
+
+def _read_decimated(source_vector_path, source_bbox, deadline):
+    """Read a sample of the geometries of a vector spread over a bbox.
+
+    Returns:
+        A tuple of an array of Shapely geometries and whether the reading
+        finished by the deadline.
+    """
+    cell_width = (source_bbox[2] - source_bbox[0]) / PREVIEW_GRID
+    cell_height = (source_bbox[3] - source_bbox[1]) / PREVIEW_GRID
+    features_per_cell = max(1, PREVIEW_MAX_FEATURES // PREVIEW_GRID**2)
+
+    with gdal.config_options(_http_timeout(deadline)):
+        vector = gdal.OpenEx(source_vector_path, gdal.OF_VECTOR)
+        layer = vector.GetLayer()
+        layer_defn = layer.GetLayerDefn()
+        layer.SetIgnoredFields([
+            layer_defn.GetFieldDefn(index).GetName()
+            for index in range(layer_defn.GetFieldCount())])
+
+        wkbs = {}
+        for row, col in itertools.product(range(PREVIEW_GRID), repeat=2):
+            if time.monotonic() > deadline:
+                break
+            xmin = source_bbox[0] + col * cell_width
+            ymin = source_bbox[1] + row * cell_height
+            layer.SetSpatialFilterRect(
+                xmin, ymin, xmin + cell_width, ymin + cell_height)
+            for n_read, feature in enumerate(layer, start=1):
+                geometry = feature.GetGeometryRef()
+                # Features spanning cells are read once per cell.
+                if geometry is not None:
+                    wkbs[feature.GetFID()] = bytes(geometry.ExportToWkb())
+                if (n_read >= features_per_cell or
+                        time.monotonic() > deadline):
+                    break
+        complete = time.monotonic() <= deadline
+        layer = None
+        vector = None
+    return shapely.from_wkb(list(wkbs.values())), complete
+
+
+def render_vector(source_vector_path, source_bbox, source_projection_wkt,
+                  target_projection_wkt=None, mask_geometry=None,
+                  size=PREVIEW_DEFAULT_SIZE, deadline=None):
+    """Render a preview of a vector clip.
+
+    Args:
+        source_vector_path (str): path to the vector, e.g. a ``/vsicurl/``
+            path.
+        source_bbox (list): the clip's bounding box in the source
+            projection.
+        source_projection_wkt (str): the projection of the vector.
+        target_projection_wkt=None (str): the target projection, or ``None``
+            to keep the source's.
+        mask_geometry=None (shapely.Geometry): a polygon in the source
+            projection to mask the preview with.
+        size=PREVIEW_DEFAULT_SIZE (int): the width or height of the preview,
+            whichever is larger.
+        deadline=None (float): the ``time.monotonic()`` by which the preview
+            must be rendered.  Defaults to ``PREVIEW_TIME_BUDGET`` from now.
+
+    Returns:
+        A tuple of the PNG (bytes) and whether it is complete, i.e. whether
+        every sampled feature was read by the deadline.
+    """
+    if deadline is None:
+        deadline = time.monotonic() + PREVIEW_TIME_BUDGET
+    geometries, complete = _read_decimated(
+        source_vector_path, source_bbox, deadline)
+    if not complete:
+        LOGGER.info("Drawing %s features of %s read by the deadline",
+                    len(geometries), source_vector_path)
+    if mask_geometry is not None:
+        geometries = shapely.intersection(geometries, mask_geometry)
+        geometries = geometries[~shapely.is_empty(geometries)]
+
+    target_bbox = source_bbox
+    if target_projection_wkt is not None:
+        target_bbox = pygeoprocessing.transform_bounding_box(
+            list(source_bbox), source_projection_wkt, target_projection_wkt)
+    geotransform, n_cols, n_rows = _grid(target_bbox, size)
+    covered = _rasterize(
+        _to_projection(geometries, source_projection_wkt,
+                       target_projection_wkt),
+        geotransform, n_cols, n_rows)
+
+    rgba = numpy.zeros((4, n_rows, n_cols), dtype=numpy.uint8)
+    for index, value in enumerate(_FEATURE_COLOR):
+        rgba[index][covered] = value
+    return _encode_png(rgba), complete
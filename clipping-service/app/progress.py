@@ -0,0 +1,216 @@
+"""Per-job progress reporting.
+
+app/progress.py
+
+Progress events are routed to the job that is running on the current
+thread, so concurrent clips never see each other's progress.  Each job has a
+``ProgressChannel`` while it runs; listeners subscribe to the channel and get
+their own bounded queue of events.  When a listener falls behind, the oldest
+events are dropped since only the latest progress matters.
+
+Clipping code reports progress with ``report()``.  Raster warps report
+through ``ProgressLogHandler``, which turns the percent-complete messages that
+pygeoprocessing logs into progress events.
+"""
+import contextlib
+import logging
+import os
+import queue
+import re
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+# The maximum number of events buffered for a single listener.
+MAX_QUEUED_EVENTS = 100
+
+# pygeoprocessing logs messages like "Warp 35.2% complete"
+_PERCENT_PATTERN = re.compile(r'([0-9]+(?:\.[0-9]+)?)%')
+
+_CHANNELS = {}
+_CHANNELS_LOCK = threading.Lock()
+_LOCAL = threading.local()
+
+
+class ProgressChannel:
+    """Fan out the progress events of a single job to its listeners.
+
+    Args:
+        job_id (str): the job this channel reports on.
+        on_update=None (callable): called with each new progress snapshot.
+    """
+
+    def __init__(self, job_id, on_update=None):
+        self.job_id = job_id
+        self.snapshot = {}
+        self.closed = False
+        self.target_path = None
+        self._on_update = on_update
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    def subscribe(self):
+        """Create a queue that receives the events of this channel.
+
+        The current snapshot, if any, is queued right away so that a new
+        listener doesn't have to wait for the next event.
+        """
+        listener = queue.Queue(maxsize=MAX_QUEUED_EVENTS)
+        with self._lock:
+            if self.snapshot:
+                listener.put(dict(self.snapshot))
+            if self.closed:
+                listener.put(None)
+            else:
+                self._listeners.append(listener)
+        return listener
+
+    def unsubscribe(self, listener):
+        with self._lock:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+
+    def publish(self, **fields):
+        """Merge fields into the snapshot and send it to every listener."""
+        if self.target_path and os.path.exists(self.target_path):
+            fields.setdefault(
+                'bytes_written', os.path.getsize(self.target_path))
+        with self._lock:
+            self.snapshot.update(fields, time=time.time())
+            event = dict(self.snapshot)
+            for listener in self._listeners:
+                self._put(listener, event)
+        if self._on_update is not None:
+            self._on_update(event)
+
+    def close(self):
+        """Signal the end of the stream to every listener."""
+        with self._lock:
+            self.closed = True
+            for listener in self._listeners:
+                self._put(listener, None)
+            self._listeners = []
+
+    @staticmethod
+    def _put(listener, event):
+        # Drop the oldest event rather than block the clipping thread.
+        while True:
+            try:
+                listener.put_nowait(event)
+                return
+            except queue.Full:
+                try:
+                    listener.get_nowait()
+                except queue.Empty:
+                    pass
+
+
+def get_channel(job_id):
+    """Get the channel of a job running in this process, or ``None``."""
+    with _CHANNELS_LOCK:
+        return _CHANNELS.get(job_id)
+
+
+@contextlib.contextmanager
+def job_context(job_id, on_update=None):
+    """Route progress reported on this thread to a job's channel.
+
+    Args:
+        job_id (str): the ID of the job running on this thread.
+        on_update=None (callable): called with each new progress snapshot,
+            e.g. to save it in the job store.
+
+    Yields:
+        The job's ``ProgressChannel``.
+    """
+    channel = ProgressChannel(job_id, on_update)
+    with _CHANNELS_LOCK:
+        _CHANNELS[job_id] = channel
+    _LOCAL.channel = channel
+    try:
+        yield channel
+    finally:
+        _LOCAL.channel = None
+        channel.close()
+        with _CHANNELS_LOCK:
+            del _CHANNELS[job_id]
+
+
+def _current_channel():
+    return getattr(_LOCAL, 'channel', None)
+
+
+def report(**fields):
+    """Report progress of the job running on this thread.
+
+    Does nothing when no job is running on this thread, e.g. for
+    synchronous clips.
+
+    Args:
+        **fields: progress fields such as ``fraction``,
+            ``features_processed`` or ``bytes_written``.
+    """
+    channel = _current_channel()
+    if channel is not None:
+        channel.publish(**fields)
+
+
+def watch_file(path):
+    """Report the size of ``path`` as ``bytes_written`` with each event."""
+    channel = _current_channel()
+    if channel is not None:
+        channel.target_path = path
+
+
+class ProgressLogHandler(logging.Handler):
+    """Turn percent-complete log messages into progress events."""
+
+    def emit(self, record):
+        if _current_channel() is None:
+            return
+        try:
+            match = _PERCENT_PATTERN.search(record.getMessage())
+        except Exception:
+            self.handleError(record)
+            return
+        if match:
+            report(fraction=min(float(match.group(1)) / 100, 1.0),
+                   message=record.getMessage())
+
+
+class Throttle:
+    """Call a function at most once per period, dropping the calls between.
+
+    Args:
+        func (callable): the function to call.
+        period (float): the minimum number of seconds between calls.
+    """
+
+    def __init__(self, func, period):
+        self.func = func
+        self.period = period
+        self._last_call = 0
+
+    def __call__(self, event):
+        now = time.time()
+        if now - self._last_call >= self.period:
+            self._last_call = now
+            self.func(event)
+
+
+def format_sse(data, event=None):
+    """Format a Server-Sent Events message.
+
+    Args:
+        data (str): the message data.
+        event=None (str): the event type.
+
+    Returns:
+        The message as a string.
+    """
+    lines = []
+    if event is not None:
+        lines.append(f'event: {event}')
+    lines.extend(f'data: {line}' for line in data.splitlines())
+    return '\n'.join(lines) + '\n\n'
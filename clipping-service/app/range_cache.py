@@ -0,0 +1,435 @@
+"""A caching HTTP proxy for byte-range reads of remote files.
+
+app/range_cache.py
+
+GDAL's ``/vsicurl/`` cache lives in the memory of each worker, so every
+worker, and every new worker, reads COG headers and popular byte ranges
+from the bucket again.  This proxy keeps the blocks it reads on local disk
+where every process on the host, the tileserver included, shares them:
+
+    $ python range_cache.py --port 8787 --cache-dir /var/cache/ranges
+
+and point readers at it with ``RANGE_CACHE_URL=http://127.0.0.1:8787``.  A
+request for ``http://127.0.0.1:8787/https://storage.googleapis.com/...`` is
+served from the cache, fetching missing blocks from the upstream URL.
+
+Objects are read in aligned blocks of ``RANGE_CACHE_BLOCK_SIZE`` bytes.  The
+blocks are files in the cache directory, indexed by a SQLite database, and
+the least recently used blocks are evicted once they take up more than
+``RANGE_CACHE_MAX_BYTES``.  Blocks are keyed by the object's version (see
+``remote.object_version``), which is rechecked every
+``RANGE_CACHE_METADATA_TTL`` seconds, so a replaced object is read again.
+
+Only URLs under the clipping service's trusted prefixes
+(``remote.TRUSTED_URL_PREFIXES``) are proxied.  Blocks are only cached from
+``206 Partial Content`` responses for exactly the range requested; anything
+else an upstream sends is passed through without being cached.
+
+The proxy is opt-in: nothing in docker-compose, the Dockerfile or the
+Makefile starts it.  Run it next to the services and set
+``RANGE_CACHE_URL`` for both the clipping service and the tileserver to use
+it; without ``RANGE_CACHE_URL`` they read from the hosts directly.
+"""
+import argparse
+import hashlib
+import http.server
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+
+import requests
+
+import remote
+
+LOGGER = logging.getLogger(__name__)
+
+BLOCK_SIZE = int(os.environ.get('RANGE_CACHE_BLOCK_SIZE', 512 * 1024))
+MAX_BYTES = int(os.environ.get('RANGE_CACHE_MAX_BYTES', 20 * 1024**3))
+METADATA_TTL = float(os.environ.get('RANGE_CACHE_METADATA_TTL', 60))
+
+# Blocks are evicted down to this fraction of MAX_BYTES, so that eviction
+# doesn't run on every write once the cache is full.
+_EVICT_TO = 0.9
+
+# Seconds to wait for an upstream range request.
+REQUEST_TIMEOUT = 60
+
+# Response headers passed on from upstream.
+_PASSED_HEADERS = ('Content-Type', 'ETag', 'Last-Modified',
+                   'x-goog-generation')
+
+_RANGE_PATTERN = re.compile(r'bytes=(\d*)-(\d*)$')
+_CONTENT_RANGE_PATTERN = re.compile(r'bytes (\d+)-(\d+)/(\d+|\*)$')
+
+
+def _fetched_range(response, start, end):
+    """Get the bytes of a range from an upstream response.
+
+    Args:
+        response (requests.Response): the response to a request for bytes
+            ``start`` to ``end``.
+        start (int): the first byte requested.
+        end (int): the last byte requested (inclusive).
+
+    Returns:
+        A tuple of the bytes and whether they may be cached, which they may
+        only be if the upstream answered with exactly the requested range.
+
+    Raises:
+        requests.RequestException: if the response doesn't hold the range.
+    """
+    data = response.content
+    length = end - start + 1
+    if response.status_code == 206:
+        match = _CONTENT_RANGE_PATTERN.match(
+            response.headers.get('Content-Range', ''))
+        if match is None:
+            raise requests.RequestException(
+                f"Upstream sent no valid Content-Range for {response.url}")
+        range_start, range_end = int(match[1]), int(match[2])
+        if (range_start, range_end) == (start, end) and len(data) == length:
+            return data, True
+        if (range_start <= start and end <= range_end and
+                len(data) == range_end - range_start + 1):
+            offset = start - range_start
+            return data[offset:offset + length], False
+    elif response.status_code == 200 and len(data) > end:
+        # The upstream ignored the Range header and sent the whole object.
+        return data[start:end + 1], False
+    raise requests.RequestException(
+        f"Upstream sent the wrong bytes for range {start}-{end} of "
+        f"{response.url}")
+
+
+class RangeCache:
+    """A disk cache of the blocks of remote objects.
+
+    Args:
+        cache_dir (str): where to keep the blocks and their index.  It is
+            created if needed.
+        max_bytes (int): the maximum total size of the blocks.
+        block_size (int): the size of a block.
+    """
+
+    def __init__(self, cache_dir, max_bytes=MAX_BYTES, block_size=BLOCK_SIZE):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        os.makedirs(os.path.join(cache_dir, 'blocks'), exist_ok=True)
+        self._metadata = {}
+        self._metadata_lock = threading.Lock()
+        with self._connect() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS blocks ('
+                'key TEXT PRIMARY KEY, size INTEGER, accessed REAL)')
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS blocks_accessed '
+                'ON blocks (accessed)')
+
+    def _connect(self):
+        return sqlite3.connect(
+            os.path.join(self.cache_dir, 'index.sqlite'), timeout=30)
+
+    def metadata(self, url):
+        """Get the size, version and headers of a remote object.
+
+        Looked up with a HEAD request at most every ``METADATA_TTL`` seconds.
+
+        Returns:
+            A dict of ``size`` (int), ``version`` (str or ``None``) and
+            ``headers`` (the upstream headers in ``_PASSED_HEADERS``).
+
+        Raises:
+            requests.HTTPError: if the object can't be found.
+        """
+        now = time.time()
+        with self._metadata_lock:
+            entry = self._metadata.get(url)
+            if entry is not None and entry['fetched'] > now - METADATA_TTL:
+                return entry
+
+        response = remote.SESSION.head(
+            url, allow_redirects=True, timeout=remote.HEAD_TIMEOUT)
+        response.raise_for_status()
+        entry = {
+            'size': int(response.headers['Content-Length']),
+            'version': remote.version_from_headers(response.headers),
+            'headers': {name: response.headers[name]
+                        for name in _PASSED_HEADERS
+                        if name in response.headers},
+            'fetched': now,
+        }
+        with self._metadata_lock:
+            self._metadata[url] = entry
+        return entry
+
+    def _block_key(self, url, version, index):
+        return hashlib.sha256(
+            f'{url}\n{version}\n{self.block_size}\n{index}'.encode(
+                'utf-8')).hexdigest()
+
+    def _block_path(self, key):
+        return os.path.join(self.cache_dir, 'blocks', key[:2], key)
+
+    def _read_block(self, key):
+        try:
+            with open(self._block_path(key), 'rb') as block_file:
+                data = block_file.read()
+        except FileNotFoundError:
+            return None
+        with self._connect() as connection:
+            connection.execute(
+                'UPDATE blocks SET accessed = ? WHERE key = ?',
+                (time.time(), key))
+        return data
+
+    def _write_block(self, key, data):
+        path = self._block_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary_path = f'{path}.{uuid.uuid4().hex}'
+        with open(temporary_path, 'wb') as block_file:
+            block_file.write(data)
+        os.replace(temporary_path, path)
+        with self._connect() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO blocks VALUES (?, ?, ?)',
+                (key, len(data), time.time()))
+            (total_bytes,) = connection.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM blocks').fetchone()
+            if total_bytes > self.max_bytes:
+                self._evict(connection, total_bytes)
+
+    def _evict(self, connection, total_bytes):
+        target_bytes = self.max_bytes * _EVICT_TO
+        evicted = []
+        for key, size in connection.execute(
+                'SELECT key, size FROM blocks ORDER BY accessed'):
+            if total_bytes <= target_bytes:
+                break
+            evicted.append(key)
+            total_bytes -= size
+        connection.executemany(
+            'DELETE FROM blocks WHERE key = ?', [(key,) for key in evicted])
+        for key in evicted:
+            try:
+                os.remove(self._block_path(key))
+            except FileNotFoundError:
+                pass
+        LOGGER.info("Evicted %s blocks", len(evicted))
+
+    def read(self, url, start, end):
+        """Read a byte range of a remote object through the cache.
+
+        Args:
+            url (str): the URL of the object.
+            start (int): the first byte to read.
+            end (int): the last byte to read (inclusive).
+
+        Returns:
+            The bytes.
+        """
+        metadata = self.metadata(url)
+        end = min(end, metadata['size'] - 1)
+        first_block = start // self.block_size
+        last_block = end // self.block_size
+
+        blocks = {}
+        missing = []
+        for index in range(first_block, last_block + 1):
+            key = self._block_key(url, metadata['version'], index)
+            data = self._read_block(key)
+            if data is None:
+                missing.append(index)
+            else:
+                blocks[index] = data
+
+        # Fetch each run of consecutive missing blocks with one request.
+        runs = []
+        for index in missing:
+            if runs and runs[-1][1] == index - 1:
+                runs[-1][1] = index
+            else:
+                runs.append([index, index])
+        for run_start, run_end in runs:
+            fetch_start = run_start * self.block_size
+            fetch_end = min((run_end + 1) * self.block_size,
+                            metadata['size']) - 1
+            response = remote.SESSION.get(
+                url, headers={'Range': f'bytes={fetch_start}-{fetch_end}'},
+                timeout=REQUEST_TIMEOUT)
+            response.raise_for_status()
+            data, cacheable = _fetched_range(response, fetch_start, fetch_end)
+            if not cacheable:
+                LOGGER.warning(
+                    "Not caching bytes %s-%s of %s: the upstream didn't "
+                    "answer with exactly that range (status %s)",
+                    fetch_start, fetch_end, url, response.status_code)
+            for index in range(run_start, run_end + 1):
+                offset = (index - run_start) * self.block_size
+                block = data[offset:offset + self.block_size]
+                blocks[index] = block
+                if cacheable:
+                    self._write_block(
+                        self._block_key(url, metadata['version'], index),
+                        block)
+
+        data = b''.join(blocks[index]
+                        for index in range(first_block, last_block + 1))
+        offset = start - first_block * self.block_size
+        return data[offset:offset + end - start + 1]
+
+    def stats(self):
+        """Get the number of cached ``blocks`` and their total ``bytes``."""
+        with self._connect() as connection:
+            n_blocks, n_bytes = connection.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blocks'
+            ).fetchone()
+        return {'blocks': n_blocks, 'bytes': n_bytes}
+
+
+class RangeCacheHandler(http.server.BaseHTTPRequestHandler):
+    """Serves ``GET`` and ``HEAD`` requests for ``/<upstream URL>``."""
+
+    # Keep connections open; GDAL makes many small requests.
+    protocol_version = 'HTTP/1.1'
+    cache = None
+
+    def log_message(self, format, *args):
+        LOGGER.debug(format, *args)
+
+    def _upstream_url(self):
+        url = self.path[1:]
+        if not remote.is_trusted_url(url):
+            self.send_error(403, "URL not allowed")
+            return None
+        return url
+
+    def _send_headers(self, status, metadata, length, extra=None):
+        self.send_response(status)
+        for name, value in metadata['headers'].items():
+            self.send_header(name, value)
+        for name, value in (extra or {}).items():
+            self.send_header(name, value)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(length))
+        self.end_headers()
+
+    def do_HEAD(self):
+        url = self._upstream_url()
+        if url is None:
+            return
+        try:
+            metadata = self.cache.metadata(url)
+        except requests.RequestException as error:
+            self._send_upstream_error(error)
+            return
+        self._send_headers(200, metadata, metadata['size'])
+
+    def do_GET(self):
+        url = self._upstream_url()
+        if url is None:
+            return
+        try:
+            metadata = self.cache.metadata(url)
+            match = _RANGE_PATTERN.match(self.headers.get('Range', ''))
+            if match is None:
+                self._proxy_uncached(url)
+                return
+
+            size = metadata['size']
+            first, last = match.groups()
+            if first:
+                start = int(first)
+                end = min(int(last), size - 1) if last else size - 1
+            elif last:
+                # A suffix range: the last ``last`` bytes.
+                start = max(0, size - int(last))
+                end = size - 1
+            else:
+                # ``bytes=-`` names no bytes at all.
+                start, end = size, size - 1
+            if start >= size or start > end:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            data = self.cache.read(url, start, end)
+        except requests.RequestException as error:
+            self._send_upstream_error(error)
+            return
+        self._send_headers(206, metadata, len(data), {
+            'Content-Range': f'bytes {start}-{end}/{size}'})
+        self.wfile.write(data)
+
+    def _proxy_uncached(self, url):
+        # Whole objects and multi-range requests aren't cached.
+        headers = {}
+        if 'Range' in self.headers:
+            headers['Range'] = self.headers['Range']
+        with remote.SESSION.get(url, headers=headers, stream=True,
+                                timeout=REQUEST_TIMEOUT) as response:
+            response.raise_for_status()
+            self.send_response(response.status_code)
+            for name in _PASSED_HEADERS + ('Content-Length', 'Content-Range'):
+                if name in response.headers:
+                    self.send_header(name, response.headers[name])
+            self.end_headers()
+            shutil.copyfileobj(response.raw, self.wfile)
+
+    def _send_upstream_error(self, error):
+        LOGGER.warning("Upstream request failed: %s", error)
+        status = 502
+        if getattr(error, 'response', None) is not None:
+            status = error.response.status_code
+        self.send_error(status)
+
+
+def serve(cache_dir, port, host='127.0.0.1', max_bytes=MAX_BYTES):
+    """Run the proxy until interrupted.
+
+    Args:
+        cache_dir (str): where to keep the cached blocks.
+        port (int): the port to listen on.
+        host='127.0.0.1' (str): the address to listen on.
+        max_bytes=MAX_BYTES (int): the maximum total size of the blocks.
+
+    Returns:
+        None
+    """
+    handler = type('Handler', (RangeCacheHandler,), {
+        'cache': RangeCache(cache_dir, max_bytes)})
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    LOGGER.info("Serving the range cache at http://%s:%s/", host, port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(__file__),
+        description="Run a caching proxy for byte-range reads.")
+    parser.add_argument('--cache-dir', default=os.path.join(
+        os.environ.get('WORKSPACE_DIR', '/tmp'), 'range-cache'))
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8787)
+    parser.add_argument('--max-bytes', type=int, default=MAX_BYTES)
+    args = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.INFO)
+    serve(args.cache_dir, args.port, args.host, args.max_bytes)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,466 @@
+"""Raster clipping engines.
+
+app/raster_clip.py
+
+When the target cell size is coarser than the source's, the clip reads the
+COG overview closest to (but not coarser than) the target resolution rather
+than the full resolution data, so only that overview's byte ranges are
+fetched over HTTP.  ``RASTER_USE_OVERVIEWS=0`` always reads the full
+resolution data.
+
+Two engines do the warping:
+
+    * ``single`` warps the whole clip with one ``warp_raster`` call.
+    * ``tiled`` splits the target grid into tiles of ``RASTER_TILE_SIZE``
+      pixels that are warped concurrently by ``RASTER_CLIP_WORKERS``
+      threads, each with its own GDAL dataset handle, so that several
+      ``/vsicurl/`` range reads are in flight at once.  The tiles are
+      mosaicked with a VRT.
+
+The engine is selected with the ``RASTER_CLIP_ENGINE`` environment variable.
+By default clips of at least ``RASTER_TILED_MIN_PIXELS`` pixels are tiled.
+Either way the bounding box is snapped to a whole number of target cells,
+and the warped raster is written out in the clip's output format (an
+LZW-compressed COG by default) with ``output_format.convert_raster``, so
+the output doesn't depend on the engine.
+
+Warps run with the GDAL options and warp threads of the deployment's GDAL
+profile (see gdal_profile.py).  The tiled engine splits the warp threads
+between the tiles warped at once.
+
+A clip may be masked by a polygon, which is used as a GDAL cutline: pixels
+outside it are set to nodata and source blocks outside it are not read.  The
+tiled engine also skips tiles that are entirely outside the polygon.
+"""
+import concurrent.futures
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy
+import pygeoprocessing
+import pyproj
+import shapely
+from osgeo import gdal
+from osgeo import ogr
+from osgeo import osr
+
+import gdal_profile
+import output_format
+import progress
+
+LOGGER = logging.getLogger(__name__)
+
+RASTER_USE_OVERVIEWS = os.environ.get('RASTER_USE_OVERVIEWS', '1') != '0'
+
+SINGLE = 'single'
+TILED = 'tiled'
+RASTER_CLIP_ENGINE = os.environ.get('RASTER_CLIP_ENGINE', None)
+
+# The width and height, in target pixels, of the tiles of the tiled engine.
+# Keep this a multiple of the COG block size (512) of the sources.
+RASTER_TILE_SIZE = int(os.environ.get('RASTER_TILE_SIZE', 2048))
+
+# The number of tiles warped at once.  Warping mostly waits on the network,
+# so this can exceed the number of CPUs.
+RASTER_CLIP_WORKERS = int(os.environ.get('RASTER_CLIP_WORKERS', 8))
+
+# Smaller clips are warped in one piece when no engine is configured.
+RASTER_TILED_MIN_PIXELS = int(
+    os.environ.get('RASTER_TILED_MIN_PIXELS', 4096 * 4096))
+
+# Creation options of the tiles, which are only read back once.
+_TILE_CREATION_OPTIONS = ['TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512']
+
+# ``warp_raster``'s overview level for the full resolution data.
+BASE_LEVEL = -1
+
+# How much finer than the target an overview may be, relative to the target
+# cell size, and still count as matching it.  This absorbs rounding in the
+# overview sizes.
+_RESOLUTION_TOLERANCE = 1e-3
+
+
+def overview_pixel_sizes(raster_path):
+    """Get the pixel size of each overview of a raster.
+
+    Args:
+        raster_path (str): path to the raster, e.g. a ``/vsicurl/`` path.
+
+    Returns:
+        A list of ``(x, y)`` pixel sizes (absolute values), one per overview
+        level of the first band, from the finest to the coarsest.
+    """
+    raster = gdal.OpenEx(raster_path, gdal.OF_RASTER)
+    try:
+        geotransform = raster.GetGeoTransform()
+        band = raster.GetRasterBand(1)
+        sizes = []
+        for index in range(band.GetOverviewCount()):
+            overview = band.GetOverview(index)
+            sizes.append((
+                abs(geotransform[1]) * raster.RasterXSize / overview.XSize,
+                abs(geotransform[5]) * raster.RasterYSize / overview.YSize))
+        return sizes
+    finally:
+        raster = None
+
+
+def choose_overview_level(raster_info, source_bbox, target_bbox,
+                          target_cellsize):
+    """Choose the overview level to read for a clip.
+
+    The target resolution is expressed in source units as the size of the
+    source bounding box over the number of target pixels, so this works
+    whether or not the clip is reprojected.
+
+    Args:
+        raster_info (dict): the info of the source raster, with the
+            ``overview_pixel_sizes`` from ``overview_pixel_sizes``.
+        source_bbox (list): the clip's bounding box in the source projection.
+        target_bbox (list): the clip's bounding box in the target projection.
+        target_cellsize (list): the target cell size.
+
+    Returns:
+        The index of the coarsest overview that is not coarser than the
+        target resolution, or ``BASE_LEVEL`` to read the full resolution
+        data.
+    """
+    overview_sizes = raster_info.get('overview_pixel_sizes')
+    if not RASTER_USE_OVERVIEWS or not overview_sizes:
+        return BASE_LEVEL
+
+    n_cols = abs((target_bbox[2] - target_bbox[0]) / target_cellsize[0])
+    n_rows = abs((target_bbox[3] - target_bbox[1]) / target_cellsize[1])
+    if n_cols < 1 or n_rows < 1:
+        return BASE_LEVEL
+    resolution = (
+        abs(source_bbox[2] - source_bbox[0]) / n_cols,
+        abs(source_bbox[3] - source_bbox[1]) / n_rows)
+
+    level = BASE_LEVEL
+    for index, (x_size, y_size) in enumerate(overview_sizes):
+        if (x_size <= resolution[0] * (1 + _RESOLUTION_TOLERANCE) and
+                y_size <= resolution[1] * (1 + _RESOLUTION_TOLERANCE)):
+            level = index
+        else:
+            break
+    return level
+
+
+def clip_raster(source_raster_path, target_cellsize, target_raster_path,
+                target_bounding_box, target_projection_wkt=None,
+                overview_level=BASE_LEVEL, engine=None, mask_geometry=None,
+                mask_projection_wkt=None, output_spec=None):
+    """Clip, and optionally reproject and resample, a raster.
+
+    Args:
+        source_raster_path (str): path to the raster to be clipped.
+        target_cellsize (list): the target cell size; the height is
+            negative.
+        target_raster_path (str): path to a ``.tif`` to store the clip.
+        target_bounding_box (list): the bounding box of the clip in the
+            target projection.
+        target_projection_wkt=None (str): target projection in wkt. Can be
+            none to indicate no reprojection is required.
+        overview_level=BASE_LEVEL (int): the overview level to read, as
+            returned by ``choose_overview_level``.
+        engine=None (str): ``single`` or ``tiled``.  Defaults to
+            ``RASTER_CLIP_ENGINE``, or if that is not set, to ``tiled`` for
+            clips of at least ``RASTER_TILED_MIN_PIXELS`` pixels.
+        mask_geometry=None (shapely.Geometry): a polygon to mask the clip
+            with.
+        mask_projection_wkt=None (str): the projection of ``mask_geometry``.
+        output_spec=None (dict): the output format and compression, as
+            returned by ``output_format.parse``; ``None`` for the default,
+            see ``default_output_spec``.
+
+    Returns:
+        None
+    """
+    if overview_level != BASE_LEVEL:
+        LOGGER.info("Reading overview level %s of %s", overview_level,
+                    source_raster_path)
+
+    n_cols, n_rows = _grid_size(target_bounding_box, target_cellsize)
+    target_bounding_box = _grid_bounds(target_bounding_box, target_cellsize)
+    if output_spec is None:
+        output_spec = default_output_spec()
+    if engine is None:
+        engine = RASTER_CLIP_ENGINE
+    if engine is None:
+        engine = (TILED if n_cols * n_rows >= RASTER_TILED_MIN_PIXELS
+                  else SINGLE)
+
+    if engine == TILED:
+        clip_function = _clip_tiled
+    elif engine == SINGLE:
+        clip_function = _clip_single
+    else:
+        raise ValueError(f"Unknown raster clip engine: {engine}")
+
+    cutline_path = None
+    if mask_geometry is not None:
+        cutline_path = f'{target_raster_path}.cutline.fgb'
+        _write_cutline(mask_geometry, mask_projection_wkt, cutline_path)
+    try:
+        clip_function(
+            source_raster_path, target_cellsize, target_raster_path,
+            target_bounding_box, target_projection_wkt, overview_level,
+            cutline_path, output_spec)
+    finally:
+        if cutline_path is not None:
+            gdal.GetDriverByName('FlatGeobuf').Delete(cutline_path)
+
+
+def default_output_spec():
+    """Get the output of a clip without output options.
+
+    Returns:
+        An LZW-compressed COG, or tiled GeoTIFF if GDAL has no COG driver,
+        as returned by ``output_format.parse``.
+    """
+    return output_format.parse(
+        output_format.RASTER,
+        'cog' if gdal.GetDriverByName('COG') is not None else 'gtiff',
+        'LZW')
+
+
+def _write_cutline(mask_geometry, mask_projection_wkt, cutline_path):
+    """Write a mask polygon to a FlatGeobuf for use as a cutline."""
+    srs = osr.SpatialReference()
+    srs.ImportFromWkt(mask_projection_wkt)
+    srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    vector = gdal.GetDriverByName('FlatGeobuf').Create(
+        cutline_path, 0, 0, 0, gdal.GDT_Unknown)
+    layer = vector.CreateLayer('mask', srs, ogr.wkbUnknown)
+    feature = ogr.Feature(layer.GetLayerDefn())
+    feature.SetGeometry(ogr.CreateGeometryFromWkb(
+        shapely.to_wkb(mask_geometry)))
+    layer.CreateFeature(feature)
+    layer = None
+    vector = None
+
+
+def _mask_in_target_projection(cutline_path, target_projection_wkt,
+                               target_cellsize):
+    """Get the cutline of a clip in the target projection.
+
+    The cutline is densified before it is reprojected, and grown by a pixel,
+    so that it covers at least the area GDAL masks with it.
+    """
+    vector = gdal.OpenEx(cutline_path, gdal.OF_VECTOR)
+    layer = vector.GetLayer()
+    mask = shapely.union_all([
+        shapely.from_wkb(bytes(feature.GetGeometryRef().ExportToWkb()))
+        for feature in layer])
+    source_projection_wkt = layer.GetSpatialRef().ExportToWkt()
+    layer = None
+    vector = None
+
+    if target_projection_wkt is not None:
+        xmin, ymin, xmax, ymax = mask.bounds
+        mask = shapely.segmentize(
+            mask, max(xmax - xmin, ymax - ymin) / 256)
+        transformer = pyproj.Transformer.from_crs(
+            pyproj.CRS.from_wkt(source_projection_wkt),
+            pyproj.CRS.from_wkt(target_projection_wkt), always_xy=True)
+        mask = shapely.transform(
+            mask, lambda coords: numpy.column_stack(
+                transformer.transform(*coords.T)))
+    return shapely.buffer(mask, max(map(abs, target_cellsize)))
+
+
+def _clip_single(source_raster_path, target_cellsize, target_raster_path,
+                 target_bounding_box, target_projection_wkt, overview_level,
+                 cutline_path=None, output_spec=None):
+    """Warp a whole clip with one ``warp_raster`` call.
+
+    See ``clip_raster`` for the arguments.  ``cutline_path`` is a vector of
+    the mask polygon, if any.
+    """
+    vector_mask_options = None
+    if cutline_path is not None:
+        vector_mask_options = {'mask_vector_path': cutline_path}
+
+    if output_spec is None:
+        output_spec = default_output_spec()
+    # warp_raster writes GeoTIFFs, which are then converted.
+    warped_path = f'{target_raster_path}.warped.tif'
+    try:
+        pygeoprocessing.warp_raster(
+            source_raster_path, target_cellsize, warped_path,
+            'near', target_bb=target_bounding_box,
+            target_projection_wkt=target_projection_wkt,
+            use_overview_level=overview_level,
+            n_threads=gdal_profile.WARP_THREADS,
+            vector_mask_options=vector_mask_options)
+        output_format.convert_raster(
+            warped_path, target_raster_path, output_spec,
+            gdal_profile.WARP_THREADS)
+    finally:
+        if os.path.exists(warped_path):
+            os.remove(warped_path)
+
+
+def _grid_size(target_bounding_box, target_cellsize):
+    """Get the number of columns and rows of the target grid."""
+    return (
+        max(1, round(abs((target_bounding_box[2] - target_bounding_box[0]) /
+                         target_cellsize[0]))),
+        max(1, round(abs((target_bounding_box[3] - target_bounding_box[1]) /
+                         target_cellsize[1]))))
+
+
+def _grid_bounds(target_bounding_box, target_cellsize):
+    """Snap a bounding box to a whole number of target cells.
+
+    The top left corner is kept, as it is by ``tile_grid``.
+    """
+    n_cols, n_rows = _grid_size(target_bounding_box, target_cellsize)
+    xmin = target_bounding_box[0]
+    ymax = target_bounding_box[3]
+    return [xmin, ymax - n_rows * abs(target_cellsize[1]),
+            xmin + n_cols * abs(target_cellsize[0]), ymax]
+
+
+def tile_grid(target_bounding_box, target_cellsize, tile_size):
+    """Split a target grid into tiles.
+
+    Tile edges fall on the target grid, so the tiles line up exactly when
+    they are mosaicked.
+
+    Args:
+        target_bounding_box (list): [xmin, ymin, xmax, ymax] of the target.
+        target_cellsize (list): the target cell size.
+        tile_size (int): the width and height of a tile, in pixels.
+
+    Returns:
+        A list of ``(bounding_box, n_cols, n_rows)`` tuples, one per tile,
+        row by row from the top left.
+    """
+    n_cols, n_rows = _grid_size(target_bounding_box, target_cellsize)
+    x_size = abs(target_cellsize[0])
+    y_size = abs(target_cellsize[1])
+    xmin = target_bounding_box[0]
+    ymax = target_bounding_box[3]
+
+    tiles = []
+    for row_offset in range(0, n_rows, tile_size):
+        tile_rows = min(tile_size, n_rows - row_offset)
+        for col_offset in range(0, n_cols, tile_size):
+            tile_cols = min(tile_size, n_cols - col_offset)
+            tiles.append(([
+                xmin + col_offset * x_size,
+                ymax - (row_offset + tile_rows) * y_size,
+                xmin + (col_offset + tile_cols) * x_size,
+                ymax - row_offset * y_size,
+            ], tile_cols, tile_rows))
+    return tiles
+
+
+def _warp_tile(source_raster_path, tile_path, bounding_box, n_cols, n_rows,
+               target_projection_wkt, overview_level, cutline_path=None,
+               n_threads=1):
+    """Warp one tile of a clip.
+
+    ``gdal.Warp`` opens its own handle on the source, so tiles can be warped
+    from several threads at once.  ``n_threads`` is the number of threads of
+    this warp.
+    """
+    options = gdal.WarpOptions(
+        format='GTiff',
+        outputBounds=bounding_box,
+        width=n_cols,
+        height=n_rows,
+        dstSRS=target_projection_wkt,
+        resampleAlg='near',
+        overviewLevel=('NONE' if overview_level == BASE_LEVEL
+                       else overview_level),
+        creationOptions=_TILE_CREATION_OPTIONS,
+        cutlineDSName=cutline_path,
+        multithread=n_threads > 1,
+        warpOptions=[f'NUM_THREADS={n_threads}'])
+    # The profile's options are set per thread.
+    with gdal_profile.config_options():
+        tile = gdal.Warp(tile_path, source_raster_path, options=options)
+    if tile is None:
+        raise RuntimeError(
+            f"Failed to warp a tile of {source_raster_path}: "
+            f"{gdal.GetLastErrorMsg()}")
+    tile = None
+
+
+def _clip_tiled(source_raster_path, target_cellsize, target_raster_path,
+                target_bounding_box, target_projection_wkt, overview_level,
+                cutline_path=None, output_spec=None, tile_size=None,
+                n_workers=None):
+    """Warp a clip tile by tile, concurrently, and mosaic it.
+
+    See ``clip_raster`` for the arguments.  ``cutline_path`` is a vector of
+    the mask polygon, if any.  ``tile_size`` and ``n_workers`` default to
+    ``RASTER_TILE_SIZE`` and ``RASTER_CLIP_WORKERS``.
+    """
+    if tile_size is None:
+        tile_size = RASTER_TILE_SIZE
+    if n_workers is None:
+        n_workers = RASTER_CLIP_WORKERS
+    tiles = tile_grid(target_bounding_box, target_cellsize, tile_size)
+    if cutline_path is not None:
+        mask = _mask_in_target_projection(
+            cutline_path, target_projection_wkt, target_cellsize)
+        shapely.prepare(mask)
+        tiles = [tile for tile in tiles
+                 if shapely.intersects(mask, shapely.box(*tile[0]))] or \
+            tiles[:1]
+    n_tile_workers = min(n_workers, len(tiles))
+    n_threads = max(1, gdal_profile.WARP_THREADS // n_tile_workers)
+    LOGGER.info("Warping %s tiles of %s with %s workers of %s threads",
+                len(tiles), source_raster_path, n_tile_workers, n_threads)
+
+    tile_dir = tempfile.mkdtemp(
+        prefix='tiles-', dir=os.path.dirname(os.path.abspath(
+            target_raster_path)))
+    try:
+        tile_paths = [os.path.join(tile_dir, f'{index}.tif')
+                      for index in range(len(tiles))]
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=n_tile_workers,
+                thread_name_prefix='raster-tile') as pool:
+            futures = [
+                pool.submit(_warp_tile, source_raster_path, tile_path,
+                            bounding_box, n_cols, n_rows,
+                            target_projection_wkt, overview_level,
+                            cutline_path, n_threads)
+                for tile_path, (bounding_box, n_cols, n_rows)
+                in zip(tile_paths, tiles)]
+            try:
+                for n_done, future in enumerate(
+                        concurrent.futures.as_completed(futures), start=1):
+                    future.result()
+                    progress.report(
+                        fraction=n_done / len(futures),
+                        message=f"Warped {n_done} of {len(futures)} tiles")
+            except Exception:
+                for future in futures:
+                    future.cancel()
+                raise
+
+        LOGGER.info("Mosaicking %s tiles into %s", len(tiles),
+                    target_raster_path)
+        vrt_path = os.path.join(tile_dir, 'mosaic.vrt')
+        # Tiles skipped outside the mask are left as nodata.
+        source_raster = gdal.OpenEx(source_raster_path, gdal.OF_RASTER)
+        nodata = source_raster.GetRasterBand(1).GetNoDataValue()
+        source_raster = None
+        gdal.BuildVRT(vrt_path, tile_paths, options=gdal.BuildVRTOptions(
+            outputBounds=_grid_bounds(target_bounding_box, target_cellsize),
+            xRes=abs(target_cellsize[0]), yRes=abs(target_cellsize[1]),
+            VRTNodata=nodata))
+        if output_spec is None:
+            output_spec = default_output_spec()
+        output_format.convert_raster(
+            vrt_path, target_raster_path, output_spec, n_workers)
+    finally:
+        shutil.rmtree(tile_dir, ignore_errors=True)
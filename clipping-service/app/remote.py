@@ -0,0 +1,173 @@
+"""Helpers for talking to the hosts that serve our source files.
+
+app/remote.py
+
+"""
+import logging
+import os
+import threading
+import time
+
+import requests
+
+try:
+    import httpx
+except ImportError:
+    # Only needed by the ASGI app; see asgi.py.
+    httpx = None
+
+LOGGER = logging.getLogger(__name__)
+
+# A pooled session so that repeated requests to the same host reuse
+# connections.
+SESSION = requests.Session()
+SESSION.mount('https://', requests.adapters.HTTPAdapter(
+    pool_connections=4, pool_maxsize=16))
+SESSION.mount('http://', requests.adapters.HTTPAdapter(
+    pool_connections=4, pool_maxsize=16))
+
+# The only URLs source files are read from.  Each prefix ends with a '/', so
+# that neither a longer host name nor a sibling bucket or directory matches.
+# The tileserver only reads these through the range cache, so keep
+# RANGE_CACHE_PREFIXES in tileserver/app/dependencies.py the same.
+TRUSTED_URL_PREFIXES = (
+    'https://storage.googleapis.com/natcap-data-cache/',
+    'https://data.naturalcapitalalliance.stanford.edu/download/',
+    'https://data.naturalcapitalproject.stanford.edu/download/',
+)
+
+# Seconds to wait for a HEAD request.
+HEAD_TIMEOUT = 10
+
+# The URL of a byte-range caching proxy (see range_cache.py) that GDAL reads
+# remote files through, e.g. http://127.0.0.1:8787.  Unset to read directly.
+RANGE_CACHE_URL = os.environ.get('RANGE_CACHE_URL', '').rstrip('/')
+
+# Object versions are remembered for a few seconds, so that the several
+# lookups made while handling one request need a single HEAD request.
+VERSION_MEMO_TTL = 5
+_VERSION_MEMO = {}
+_VERSION_MEMO_LOCK = threading.Lock()
+
+
+def is_trusted_url(url, prefixes=TRUSTED_URL_PREFIXES):
+    """Check that a URL is under one of the trusted prefixes."""
+    return isinstance(url, str) and url.startswith(prefixes)
+
+
+def strip_vsi_prefix(path):
+    """Get the URL of a ``/vsicurl/`` path."""
+    return path.removeprefix('/vsicurl/')
+
+
+def gdal_path(path):
+    """Get the path GDAL should read a ``/vsicurl/`` path through.
+
+    Reads go through the range cache when ``RANGE_CACHE_URL`` is set.  Keep
+    using the original path for cache keys and anything shown to users.
+    """
+    if not RANGE_CACHE_URL or not path.startswith('/vsicurl/'):
+        return path
+    return f'/vsicurl/{RANGE_CACHE_URL}/{strip_vsi_prefix(path)}'
+
+
+def object_version(url):
+    """Get a token that changes whenever the object at ``url`` changes.
+
+    The GCS object generation is used when available, since it changes even
+    when an object is replaced with identical content.  Otherwise the ETag,
+    or failing that the Last-Modified date and Content-Length, are used.
+
+    Args:
+        url (str): an http(s) URL, or a ``/vsicurl/`` path.
+
+    Returns:
+        The version token (str), or ``None`` if the object's version could
+        not be determined.
+    """
+    url = strip_vsi_prefix(url)
+    now = time.time()
+    memoized, version = _memoized_version(url, now)
+    if memoized:
+        return version
+
+    version = _head_version(url)
+    with _VERSION_MEMO_LOCK:
+        _VERSION_MEMO[url] = (now, version)
+    return version
+
+
+async def async_object_version(url, client):
+    """Get the version of the object at ``url`` without blocking.
+
+    See ``object_version``; versions are remembered the same way.
+
+    Args:
+        url (str): an http(s) URL, or a ``/vsicurl/`` path.
+        client (httpx.AsyncClient): the client to make the request with.
+
+    Returns:
+        The version token (str), or ``None``.
+    """
+    url = strip_vsi_prefix(url)
+    now = time.time()
+    memoized, version = _memoized_version(url, now)
+    if memoized:
+        return version
+
+    try:
+        response = await client.head(
+            url, follow_redirects=True, timeout=HEAD_TIMEOUT)
+        response.raise_for_status()
+    except httpx.HTTPError:
+        LOGGER.warning("Could not get the version of %s", url, exc_info=True)
+        version = None
+    else:
+        version = version_from_headers(response.headers)
+    with _VERSION_MEMO_LOCK:
+        _VERSION_MEMO[url] = (now, version)
+    return version
+
+
+def _memoized_version(url, now):
+    """Get a remembered version, dropping those that are too old.
+
+    Returns:
+        A tuple of whether a version of ``url`` is remembered, and the
+        version.
+    """
+    with _VERSION_MEMO_LOCK:
+        for memo_url in [memo_url for memo_url, (timestamp, _) in
+                         _VERSION_MEMO.items()
+                         if timestamp < now - VERSION_MEMO_TTL]:
+            del _VERSION_MEMO[memo_url]
+        if url in _VERSION_MEMO:
+            return True, _VERSION_MEMO[url][1]
+    return False, None
+
+
+def _head_version(url):
+    try:
+        response = SESSION.head(
+            url, allow_redirects=True, timeout=HEAD_TIMEOUT)
+        response.raise_for_status()
+    except requests.RequestException:
+        LOGGER.warning("Could not get the version of %s", url, exc_info=True)
+        return None
+
+    return version_from_headers(response.headers)
+
+
+def version_from_headers(headers):
+    """Get the version token of an object from its response headers.
+
+    See ``object_version``.
+    """
+    if 'x-goog-generation' in headers:
+        return f"generation:{headers['x-goog-generation']}"
+    if 'ETag' in headers:
+        return f"etag:{headers['ETag']}"
+    if 'Last-Modified' in headers:
+        return (f"modified:{headers['Last-Modified']}:"
+                f"{headers.get('Content-Length', '')}")
+    return None
@@ -0,0 +1,340 @@
+"""Content-addressed cache of clip results.
+
+app/result_cache.py
+
+Many users clip the same popular layers to the same regions.  A clip is
+identified by a key computed from its normalized parameters and the version
+of its source file, so an identical request can be answered with the object
+that is already in the bucket instead of warping and uploading it again.
+
+Two backends are available:
+
+    * ``LocalResultCache`` keeps its index in a SQLite database on local disk,
+      shared by the workers of one host.
+    * ``GCSResultCache`` keeps its index as small JSON objects in the bucket
+      next to the clipped files, shared by every host.
+
+Both take the bucket as an argument and only use ``bucket.blob()`` and
+``bucket.list_blobs()``, so they can be exercised against a fake GCS server
+(``STORAGE_EMULATOR_HOST``) or any object with the same interface; the tests
+use an ``upload.FilesystemBucket``.
+
+Entries are served while they are younger than ``max_age`` seconds and
+their clipped file still exists.  Entries are evicted when they are older
+than that, and the oldest entries are evicted when the clipped files in the
+cache add up to more than ``max_bytes``.  A download URL handed out stays
+valid for at least ``url_lifetime`` seconds, so evicting an entry only
+deletes its clipped file once no URL to it can be that recent.  The files of
+entries evicted for size before then are left to the bucket's lifecycle
+rules.
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+try:
+    from google.api_core.exceptions import NotFound
+except ImportError:
+    # Only the GCS backend needs it, and it comes with google-cloud-storage.
+    NotFound = None
+
+LOGGER = logging.getLogger(__name__)
+
+# Seconds between eviction passes.
+EVICTION_PERIOD = 10 * 60
+
+# Number of decimal places that bounding boxes are rounded to in cache keys,
+# so that floating-point noise doesn't produce different keys.
+BBOX_PRECISION = 9
+
+# Seconds a download URL stays valid after it is handed out, at least.
+URL_LIFETIME = 60 * 60
+
+# What a missing index entry raises.
+_NOT_FOUND_ERRORS = (FileNotFoundError,) + (
+    (NotFound,) if NotFound is not None else ())
+
+
+def clip_key(file_url, source_version, layer_type, bbox, target_epsg=None,
+             target_cellsize=None, **options):
+    """Compute the cache key of a clip.
+
+    Args:
+        file_url (str): the URL of the source file.
+        source_version (str): a token identifying the version of the source
+            file, e.g. its ETag or GCS generation.
+        layer_type (str): ``raster`` or ``vector``.
+        bbox (list): the grid-aligned bounding box of the clip.
+        target_epsg=None (int): the target EPSG code, if any.
+        target_cellsize=None (list): the target cell size, if any.
+        **options: any other option that affects the output.
+
+    Returns:
+        The key, a hex digest (str).
+    """
+    normalized = {
+        'file_url': file_url,
+        'source_version': source_version,
+        'layer_type': layer_type,
+        'bbox': [round(float(coord), BBOX_PRECISION) for coord in bbox],
+        'target_epsg': (int(target_epsg) if target_epsg not in (None, '')
+                        else None),
+        'target_cellsize': (
+            [round(abs(float(size)), BBOX_PRECISION)
+             for size in target_cellsize]
+            if target_cellsize is not None else None),
+        'options': options,
+    }
+    return hashlib.sha256(
+        json.dumps(normalized, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """Interface for a clip result cache.
+
+    A cache entry is a dict with the keys ``url`` (the download URL),
+    ``object_name`` (the name of the object in the bucket), ``nbytes``,
+    ``size`` (human-readable) and ``created`` (a timestamp).
+
+    Args:
+        bucket (google.cloud.storage.Bucket): the bucket holding the clipped
+            files.
+        max_age (float): the number of seconds to keep an entry.
+        max_bytes (int): the maximum total size of the cached files.
+        url_lifetime=URL_LIFETIME (float): the number of seconds a download
+            URL stays valid after it is handed out, at least.
+    """
+
+    def __init__(self, bucket, max_age, max_bytes, url_lifetime=URL_LIFETIME):
+        self.bucket = bucket
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.url_lifetime = url_lifetime
+        self._last_eviction = 0
+        self._eviction_lock = threading.Lock()
+
+    def get(self, key):
+        """Get the entry stored under ``key``, or ``None``."""
+        entry = self._get(key)
+        if entry is None:
+            return None
+        if entry['created'] < time.time() - self.max_age:
+            return None
+        # The clipped file may have been removed by lifecycle rules or by
+        # another worker's eviction.
+        if not self.bucket.blob(entry['object_name']).exists():
+            LOGGER.info("Dropping cached clip %s, which no longer exists",
+                        entry['object_name'])
+            self._delete(key)
+            return None
+        return entry
+
+    def put(self, key, url, object_name, nbytes, size):
+        """Store a clip result.
+
+        Args:
+            key (str): the clip key, see ``clip_key``.
+            url (str): the download URL of the clipped file.
+            object_name (str): the name of the clipped file in the bucket.
+            nbytes (int): the size of the clipped file in bytes.
+            size (str): the human-readable size of the clipped file.
+        """
+        self._put(key, {
+            'url': url,
+            'object_name': object_name,
+            'nbytes': nbytes,
+            'size': size,
+            'created': time.time(),
+        })
+        self.maybe_evict()
+
+    def maybe_evict(self):
+        """Evict old entries, unless that was done recently."""
+        if time.time() - self._last_eviction < EVICTION_PERIOD:
+            return
+        if not self._eviction_lock.acquire(blocking=False):
+            return
+        try:
+            self._last_eviction = time.time()
+            self.evict()
+        except Exception:
+            LOGGER.exception("Failed to evict clip results")
+        finally:
+            self._eviction_lock.release()
+
+    def evict(self):
+        """Evict entries that are too old or over the size limit.
+
+        Entries are only served while younger than ``max_age``, so the URL
+        of an entry older than ``max_age + url_lifetime`` can't have been
+        handed out within ``url_lifetime``, and its file can be deleted.
+        Younger entries over the size limit are only dropped from the index.
+        """
+        entries = sorted(self._entries(), key=lambda item: item[1]['created'],
+                         reverse=True)
+        now = time.time()
+        cutoff = now - self.max_age
+        unused_cutoff = cutoff - self.url_lifetime
+        total_bytes = 0
+        for key, entry in entries:
+            total_bytes += entry['nbytes']
+            if entry['created'] < unused_cutoff:
+                LOGGER.info("Evicting cached clip %s", entry['object_name'])
+                self._delete(key)
+                self._delete_object(entry['object_name'])
+            elif entry['created'] >= cutoff and total_bytes > self.max_bytes:
+                LOGGER.info("Dropping cached clip %s from the index; its URL "
+                            "may still be in use", entry['object_name'])
+                self._delete(key)
+            # Other entries are expired, and no longer served, but their
+            # files are kept until their URLs are unused.
+
+    def _delete_object(self, object_name):
+        try:
+            self.bucket.blob(object_name).delete()
+        except Exception:
+            # It may have been deleted by the bucket's lifecycle rules.
+            LOGGER.warning("Could not delete %s", object_name, exc_info=True)
+
+    def _get(self, key):
+        raise NotImplementedError
+
+    def _put(self, key, entry):
+        raise NotImplementedError
+
+    def _delete(self, key):
+        raise NotImplementedError
+
+    def _entries(self):
+        """Iterate over ``(key, entry)`` pairs."""
+        raise NotImplementedError
+
+
+class LocalResultCache(ResultCache):
+    """Result cache indexed by a SQLite database on local disk.
+
+    Args:
+        db_path (str): path to the SQLite database.
+        bucket, max_age, max_bytes, url_lifetime: see ``ResultCache``.
+    """
+
+    def __init__(self, db_path, bucket, max_age, max_bytes,
+                 url_lifetime=URL_LIFETIME):
+        super().__init__(bucket, max_age, max_bytes, url_lifetime)
+        self.db_path = db_path
+        with self._connect() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS results ('
+                'key TEXT PRIMARY KEY, entry TEXT, created REAL)')
+
+    def _connect(self):
+        # A connection per call; sqlite3 connections can't be shared between
+        # threads, and the database is shared between processes anyway.
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def _get(self, key):
+        with self._connect() as connection:
+            row = connection.execute(
+                'SELECT entry FROM results WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def _put(self, key, entry):
+        with self._connect() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO results VALUES (?, ?, ?)',
+                (key, json.dumps(entry), entry['created']))
+
+    def _delete(self, key):
+        with self._connect() as connection:
+            connection.execute('DELETE FROM results WHERE key = ?', (key,))
+
+    def _entries(self):
+        with self._connect() as connection:
+            rows = connection.execute(
+                'SELECT key, entry FROM results').fetchall()
+        return [(key, json.loads(entry)) for key, entry in rows]
+
+
+class GCSResultCache(ResultCache):
+    """Result cache indexed by JSON objects in the bucket.
+
+    Args:
+        prefix (str): the object name prefix of the index entries.
+        bucket, max_age, max_bytes, url_lifetime: see ``ResultCache``.
+    """
+
+    def __init__(self, prefix, bucket, max_age, max_bytes,
+                 url_lifetime=URL_LIFETIME):
+        super().__init__(bucket, max_age, max_bytes, url_lifetime)
+        self.prefix = prefix.rstrip('/')
+
+    def _entry_name(self, key):
+        return f'{self.prefix}/{key}.json'
+
+    def _get(self, key):
+        blob = self.bucket.blob(self._entry_name(key))
+        try:
+            return json.loads(blob.download_as_bytes())
+        except _NOT_FOUND_ERRORS:
+            return None
+        except Exception:
+            # Count it as a miss, but auth, network and quota errors need
+            # looking into.
+            LOGGER.exception("Failed to read cache entry %s", key)
+            return None
+
+    def _put(self, key, entry):
+        self.bucket.blob(self._entry_name(key)).upload_from_string(
+            json.dumps(entry), content_type='application/json')
+
+    def _delete(self, key):
+        try:
+            self.bucket.blob(self._entry_name(key)).delete()
+        except Exception:
+            LOGGER.warning("Could not delete cache entry %s", key,
+                           exc_info=True)
+
+    def _entries(self):
+        for blob in self.bucket.list_blobs(prefix=f'{self.prefix}/'):
+            key = os.path.splitext(os.path.basename(blob.name))[0]
+            try:
+                yield key, json.loads(blob.download_as_bytes())
+            except Exception:
+                LOGGER.warning("Skipping unreadable cache entry %s",
+                               blob.name, exc_info=True)
+
+
+def get_result_cache(backend, bucket, workspace_dir, prefix, max_age,
+                     max_bytes, url_lifetime=URL_LIFETIME):
+    """Create the result cache named by ``backend``.
+
+    Args:
+        backend (str): ``local``, ``gcs`` or ``none``.
+        bucket (google.cloud.storage.Bucket): the bucket holding the clipped
+            files.
+        workspace_dir (str): where the ``local`` backend keeps its database.
+        prefix (str): where the ``gcs`` backend keeps its index.
+        max_age (float): the number of seconds to keep an entry.
+        max_bytes (int): the maximum total size of the cached files.
+        url_lifetime=URL_LIFETIME (float): the number of seconds a download
+            URL stays valid after it is handed out, at least.
+
+    Returns:
+        A ``ResultCache``, or ``None`` if caching is disabled.
+    """
+    if backend == 'none':
+        return None
+    if backend == 'local':
+        return LocalResultCache(
+            os.path.join(workspace_dir, 'clip-results.sqlite'), bucket,
+            max_age, max_bytes, url_lifetime)
+    if backend == 'gcs':
+        return GCSResultCache(
+            prefix, bucket, max_age, max_bytes, url_lifetime)
+    raise ValueError(f"Unsupported result cache backend: {backend}")
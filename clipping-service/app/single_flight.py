@@ -0,0 +1,300 @@
+"""Coalescing of concurrent identical clips.
+
+app/single_flight.py
+
+When several requests for the same clip arrive at once, only the first
+("leader") does the work; the others wait for it and get the same result.
+The leader holds a lock named after the clip's key while it works, then
+stores the result for ``RESULT_TTL`` seconds for the waiters to pick up.  If
+the leader fails, a waiter takes over the lock and does the work itself.
+
+Two lock backends are available:
+
+    * ``FileLockSingleFlight`` uses ``fcntl`` locks on files in a local
+      directory, which covers every gunicorn worker on one host.  A lock is
+      released by the kernel if its holder dies.  Lock and result files
+      unused for ``RESULT_TTL`` seconds are swept from the directory.
+    * ``RedisSingleFlight`` uses Redis keys, which covers every host.  A lock
+      expires after ``LOCK_TTL`` seconds in case its holder dies.
+
+The backend is selected with the ``SINGLE_FLIGHT_URL`` environment variable,
+e.g. ``file://`` (the default), ``redis://localhost:6379/0`` or ``none://``
+to disable coalescing.
+"""
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import time
+import uuid
+
+LOGGER = logging.getLogger(__name__)
+
+# Seconds a leader's result is kept for the requests waiting on it.
+RESULT_TTL = int(os.environ.get('SINGLE_FLIGHT_RESULT_TTL', 60))
+
+# Seconds to wait for a leader before doing the work regardless.
+WAIT_TIMEOUT = float(os.environ.get('SINGLE_FLIGHT_WAIT', 10 * 60))
+
+# Seconds after which a Redis lock expires; longer than any clip should take.
+LOCK_TTL = int(os.environ.get('SINGLE_FLIGHT_LOCK_TTL', 30 * 60))
+
+# Seconds between checks on a leader.
+POLL_PERIOD = 0.25
+
+
+class SingleFlight:
+    """Interface for coalescing calls with the same key.
+
+    Results must be JSON-serializable.
+    """
+
+    def run(self, key, func, on_wait=None):
+        """Call ``func()``, unless an identical call is in flight.
+
+        Args:
+            key (str): identifies the call; calls with the same key are
+                coalesced.
+            func (callable): computes the result.
+            on_wait=None (callable): called with no arguments if this call
+                has to wait for another one.
+
+        Returns:
+            The result of ``func()``, or of the identical call in flight.
+        """
+        raise NotImplementedError
+
+
+class NoSingleFlight(SingleFlight):
+    """Doesn't coalesce anything."""
+
+    def run(self, key, func, on_wait=None):
+        return func()
+
+
+class FileLockSingleFlight(SingleFlight):
+    """Coalesces calls across the processes of one host with file locks.
+
+    Args:
+        lock_dir (str): the directory for the lock and result files.  It is
+            created if needed.
+        result_ttl (int): seconds to keep a result for waiting calls.
+    """
+
+    def __init__(self, lock_dir, result_ttl=RESULT_TTL):
+        self.lock_dir = lock_dir
+        self.result_ttl = result_ttl
+        self._last_sweep = 0
+        os.makedirs(lock_dir, exist_ok=True)
+
+    def _paths(self, key):
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        base_path = os.path.join(self.lock_dir, digest)
+        return f'{base_path}.lock', f'{base_path}.json'
+
+    def _read_result(self, result_path):
+        try:
+            if os.path.getmtime(result_path) < time.time() - self.result_ttl:
+                return None
+            with open(result_path) as result_file:
+                return json.load(result_file)
+        except (OSError, ValueError):
+            return None
+
+    def _sweep(self):
+        """Delete the lock and result files unused for ``result_ttl``.
+
+        A lock file is only deleted while locked, and ``run`` checks that
+        the file it locked is still in place, so a sweep can't let two
+        calls lead at once.
+        """
+        cutoff = time.time() - self.result_ttl
+        n_deleted = 0
+        for entry in os.scandir(self.lock_dir):
+            try:
+                if entry.stat().st_mtime >= cutoff:
+                    continue
+                if not entry.name.endswith('.lock'):
+                    # Results, and temporary files left by a crash.
+                    os.remove(entry.path)
+                    n_deleted += 1
+                    continue
+                with open(entry.path, 'a') as lock_file:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        continue
+                    # Check again: a call may have used it meanwhile.
+                    if os.stat(entry.path).st_mtime < cutoff:
+                        os.remove(entry.path)
+                        n_deleted += 1
+            except FileNotFoundError:
+                pass
+        LOGGER.debug("Swept %s single-flight files", n_deleted)
+
+    def _maybe_sweep(self):
+        now = time.time()
+        if now - self._last_sweep < self.result_ttl:
+            return
+        self._last_sweep = now
+        try:
+            self._sweep()
+        except OSError:
+            LOGGER.exception("Failed to sweep %s", self.lock_dir)
+
+    def _lock(self, lock_path, key, on_wait):
+        """Take the lock of a call, waiting for the leader if needed.
+
+        Returns:
+            A tuple of the locked file, or ``None`` if waiting timed out, and
+            whether this call waited.
+        """
+        deadline = time.time() + WAIT_TIMEOUT
+        waited = False
+        while True:
+            # A file object per attempt: fcntl.flock locks belong to an open
+            # file, so this excludes other threads of this process too.
+            lock_file = open(lock_path, 'a')
+            try:
+                while True:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        break
+                    except BlockingIOError:
+                        if not waited:
+                            waited = True
+                            LOGGER.info(
+                                "Waiting for an identical call: %s", key)
+                            if on_wait is not None:
+                                on_wait()
+                        if time.time() > deadline:
+                            LOGGER.warning(
+                                "Gave up waiting for an identical call: %s",
+                                key)
+                            lock_file.close()
+                            return None, waited
+                        time.sleep(POLL_PERIOD)
+                # A sweep may have deleted the file while we waited on it;
+                # then lock the file now in its place.
+                try:
+                    in_place = (os.stat(lock_path).st_ino ==
+                                os.fstat(lock_file.fileno()).st_ino)
+                except FileNotFoundError:
+                    in_place = False
+                if in_place:
+                    # Mark the lock as used, so it isn't swept.
+                    os.utime(lock_path)
+                    return lock_file, waited
+            except BaseException:
+                lock_file.close()
+                raise
+            lock_file.close()
+
+    def run(self, key, func, on_wait=None):
+        lock_path, result_path = self._paths(key)
+        self._maybe_sweep()
+        lock_file, waited = self._lock(lock_path, key, on_wait)
+        if lock_file is None:
+            return func()
+        with lock_file:
+            try:
+                if waited:
+                    # The leader has finished; use its result if it
+                    # succeeded.
+                    result = self._read_result(result_path)
+                    if result is not None:
+                        return result
+                result = func()
+                temporary_path = f'{result_path}.{uuid.uuid4().hex}'
+                with open(temporary_path, 'w') as result_file:
+                    json.dump(result, result_file)
+                os.replace(temporary_path, result_path)
+                return result
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class RedisSingleFlight(SingleFlight):
+    """Coalesces calls across hosts with Redis keys.
+
+    Args:
+        url (str): the redis URL, e.g. ``redis://localhost:6379/0``.
+        result_ttl (int): seconds to keep a result for waiting calls.
+        lock_ttl (int): seconds after which a lock expires.
+    """
+
+    # Deletes a lock only if it is still held by the given token.
+    _RELEASE_SCRIPT = (
+        "if redis.call('get', KEYS[1]) == ARGV[1] then "
+        "return redis.call('del', KEYS[1]) else return 0 end")
+
+    def __init__(self, url, result_ttl=RESULT_TTL, lock_ttl=LOCK_TTL):
+        # Imported here so that redis is only needed when it's used.
+        import redis
+        self.result_ttl = result_ttl
+        self.lock_ttl = lock_ttl
+        self._redis = redis.Redis.from_url(url)
+        self._release = self._redis.register_script(self._RELEASE_SCRIPT)
+
+    @staticmethod
+    def _keys(key):
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return (f'clipping-service:flight:{digest}:lock',
+                f'clipping-service:flight:{digest}:result')
+
+    def run(self, key, func, on_wait=None):
+        lock_key, result_key = self._keys(key)
+        token = uuid.uuid4().hex
+        deadline = time.time() + WAIT_TIMEOUT
+        waited = False
+        while not self._redis.set(lock_key, token, nx=True, ex=self.lock_ttl):
+            if not waited:
+                waited = True
+                LOGGER.info("Waiting for an identical call: %s", key)
+                if on_wait is not None:
+                    on_wait()
+            result = self._redis.get(result_key)
+            if result is not None:
+                return json.loads(result)
+            if time.time() > deadline:
+                LOGGER.warning(
+                    "Gave up waiting for an identical call: %s", key)
+                return func()
+            time.sleep(POLL_PERIOD)
+
+        try:
+            if waited:
+                # The leader may have finished between our last check and
+                # taking the lock.
+                result = self._redis.get(result_key)
+                if result is not None:
+                    return json.loads(result)
+            result = func()
+            self._redis.set(result_key, json.dumps(result),
+                            ex=self.result_ttl)
+            return result
+        finally:
+            self._release(keys=[lock_key], args=[token])
+
+
+def get_single_flight(url=None, lock_dir=None):
+    """Create the single-flight backend named by a URL.
+
+    Args:
+        url=None (str): ``file://``, a ``redis://`` URL or ``none://``.  If
+            ``None``, the ``SINGLE_FLIGHT_URL`` environment variable is used.
+        lock_dir=None (str): the directory of the ``file://`` backend.
+
+    Returns:
+        A ``SingleFlight`` instance.
+    """
+    if url is None:
+        url = os.environ.get('SINGLE_FLIGHT_URL', 'file://')
+    if url.startswith('none://'):
+        return NoSingleFlight()
+    if url.startswith('file://'):
+        return FileLockSingleFlight(url.removeprefix('file://') or lock_dir)
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisSingleFlight(url)
+    raise ValueError(f"Unsupported single-flight backend: {url}")
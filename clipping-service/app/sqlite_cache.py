@@ -0,0 +1,136 @@
+"""A bounded, persistent cache shared by the workers of one host.
+
+app/sqlite_cache.py
+
+Values are pickled into a SQLite database on local disk, so every gunicorn
+worker on the host shares one cache and it survives worker restarts.  Each
+cache is a namespace within the database with its own size bound and TTL.
+
+An entry may be stored with a version token (e.g. the ETag of the remote
+object it describes).  A lookup with a different version is a miss, so
+entries are invalidated when the remote object is replaced.
+
+Lookups only read the database, apart from moving an entry up the least
+recently used order at most once every ``TOUCH_PERIOD`` seconds.  Hits and
+misses are counted by the callers in the ``clip_cache_lookups`` metric (see
+metrics.py), which covers all workers.
+"""
+import logging
+import pickle
+import sqlite3
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+# Seconds by which an entry's last access time may lag.  Eviction is only
+# this precise about which entries were used least recently.
+TOUCH_PERIOD = 60
+
+
+class SQLiteCache:
+    """A namespace of a SQLite-backed cache.
+
+    Args:
+        db_path (str): path to the SQLite database.  It is created if needed.
+        namespace (str): the name of this cache within the database.
+        max_entries (int): the maximum number of entries.  The least recently
+            used entries are evicted beyond this.
+        ttl (float): the number of seconds an entry is valid for.
+    """
+
+    def __init__(self, db_path, namespace, max_entries, ttl):
+        self.db_path = db_path
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.ttl = ttl
+        with self._connect() as connection:
+            # Write-ahead logging lets readers in other processes work while
+            # one process writes.
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS entries ('
+                'namespace TEXT, key TEXT, version TEXT, value BLOB, '
+                'created REAL, accessed REAL, '
+                'PRIMARY KEY (namespace, key))')
+
+    def _connect(self):
+        # A connection per call; sqlite3 connections can't be shared between
+        # threads.
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def get(self, key, version=None):
+        """Look up a value.
+
+        Args:
+            key (str): the key of the entry.
+            version=None (str): the current version of the object the entry
+                describes.  If given, an entry stored with a different
+                version is a miss.
+
+        Returns:
+            The cached value, or ``None`` on a miss.
+        """
+        now = time.time()
+        with self._connect() as connection:
+            row = connection.execute(
+                'SELECT version, value, created, accessed FROM entries '
+                'WHERE namespace = ? AND key = ?',
+                (self.namespace, key)).fetchone()
+            hit = (
+                row is not None and
+                row[2] >= now - self.ttl and
+                (version is None or row[0] == version))
+            if not hit:
+                return None
+            if row[3] < now - TOUCH_PERIOD:
+                connection.execute(
+                    'UPDATE entries SET accessed = ? '
+                    'WHERE namespace = ? AND key = ?',
+                    (now, self.namespace, key))
+        try:
+            return pickle.loads(row[1])
+        except Exception:
+            LOGGER.warning("Dropping unreadable cache entry %s", key,
+                           exc_info=True)
+            self.delete(key)
+            return None
+
+    def put(self, key, value, version=None):
+        """Store a value.
+
+        Args:
+            key (str): the key of the entry.
+            value: the value to store; it must be picklable.
+            version=None (str): the version of the object the entry
+                describes.
+        """
+        now = time.time()
+        with self._connect() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)',
+                (self.namespace, key, version, pickle.dumps(value), now, now))
+            self._evict(connection, now)
+
+    def delete(self, key):
+        with self._connect() as connection:
+            connection.execute(
+                'DELETE FROM entries WHERE namespace = ? AND key = ?',
+                (self.namespace, key))
+
+    def _evict(self, connection, now):
+        connection.execute(
+            'DELETE FROM entries WHERE namespace = ? AND created < ?',
+            (self.namespace, now - self.ttl))
+        connection.execute(
+            'DELETE FROM entries WHERE namespace = ? AND key IN ('
+            '  SELECT key FROM entries WHERE namespace = ?'
+            '  ORDER BY accessed DESC LIMIT -1 OFFSET ?)',
+            (self.namespace, self.namespace, self.max_entries))
+
+    def stats(self):
+        """Get the number of ``entries``."""
+        with self._connect() as connection:
+            (entries,) = connection.execute(
+                'SELECT COUNT(*) FROM entries WHERE namespace = ?',
+                (self.namespace,)).fetchone()
+        return {'entries': entries}
@@ -296,44 +296,39 @@ async function getInfo() {
 }
 
 
-async function getData() {
-  await delay(5000);  // Give it 5s before checking status
-  const url = `${server_url}/status`;
-  try {
-    const response = await fetch(url);
-    if (!response.ok) {
-      throw new Error(`Response status: ${response.status}`);
-    }
-
-    // Calling text() would wait until the whole file downloads.
-    //const json = await response.text();
-    //console.log(json);
-
-    // Using TextDecoderStream to read the response stream as it arrives.
-    // https://developer.mozilla.org/en-US/docs/Web/API/Fetch_API/Using_Fetch#handling_the_response
-    const stream = response.body.pipeThrough(new TextDecoderStream());
-    for await (const value of stream) {
-      const logrecord = JSON.parse(value);
-
-      if (logrecord.name.startsWith('pygeoprocessing')) {
-        const percent_complete = logrecord.message.match(/[0-9]+.?[0-9]+%/g);
-        const progress_bar = document.getElementById('clipping-progress-bar');
-        if (percent_complete) {
-          progress_bar.style.width = percent_complete[0];
-          progress_bar.innerHTML = percent_complete[0];
-          if (percent_complete[0].match(/100.?0+%/g)) {
-            progress_bar.innerHTML = 'Finalizing upload';
-          }
-        }
+// Follow the progress of a clip job until it ends.
+//
+// Resolves with the finished job record.
+function watchJob(job_id) {
+  return new Promise((resolve, reject) => {
+    const events = new EventSource(`${server_url}/clip/jobs/${job_id}/events`);
+    const progress_bar = document.getElementById('clipping-progress-bar');
+
+    events.addEventListener('progress', (event) => {
+      const job_progress = JSON.parse(event.data);
+      if (job_progress === null) {
+        return;
       }
-    }
-  } catch (error) {
-    console.error(error.message);
-  }
-  let progress_bar = document.getElementById('clipping-progress-bar');
-  progress_bar.classList.remove('progress-bar-animated');
-  progress_bar.classList.add('bg-success');
+      if (job_progress.fraction !== undefined && job_progress.fraction !== null) {
+        const percent_complete = `${(job_progress.fraction * 100).toFixed(1)}%`;
+        progress_bar.style.width = percent_complete;
+        progress_bar.innerHTML = percent_complete;
+      }
+      if (job_progress.message === 'Uploading') {
+        progress_bar.innerHTML = 'Finalizing upload';
+      }
+    });
+
+    events.addEventListener('done', (event) => {
+      events.close();
+      resolve(JSON.parse(event.data));
+    });
 
+    events.onerror = (error) => {
+      events.close();
+      reject(new Error(`Lost the progress stream of clip job ${job_id}`));
+    };
+  });
 }
 
 async function clip_cog() {
@@ -359,7 +354,8 @@ async function clip_cog() {
     }
 
     var clip_body = {
-        cog_url: document.getElementById('cog-url').value,
+        file_url: document.getElementById('cog-url').value,
+        layer_type: 'raster',
         target_bbox: [bounds.getWest(), bounds.getSouth(), bounds.getEast(), bounds.getNorth()],
         target_epsg: epsg_code,
       }
@@ -370,14 +366,23 @@ async function clip_cog() {
                                    document.getElementById('targetResolutionY').value];
     }
 
-    const clip_response = await fetch(`${server_url}/clip`, {
+    const submit_response = await fetch(`${server_url}/clip/jobs`, {
       method: "POST",
       body: JSON.stringify(clip_body),
       headers: {
         "Content-Type": "application/json"
       }
     });
-    const clip_json = await clip_response.json();
+    const submit_json = await submit_response.json();
+    if (!submit_response.ok) {
+      throw new Error(submit_json.error);
+    }
+
+    const job = await watchJob(submit_json.job_id);
+    if (job.status !== 'success') {
+      throw new Error(`Clipping failed: ${job.error}`);
+    }
+    const clip_json = job.result;
     // By this point, we have the uploaded file on the cloud
     var download_button = document.getElementById('download');
     download_button.setAttribute('download_url', clip_json.url);
@@ -0,0 +1,450 @@
+"""Upload of clipped files to the storage target.
+
+app/upload.py
+
+Files smaller than ``UPLOAD_CHUNK_SIZE`` bytes are uploaded in one request,
+which is retried from the start, with backoff, if it fails.  Larger files
+are sent through a resumable upload session in chunks of
+``UPLOAD_CHUNK_SIZE`` bytes: when a chunk fails, the session is asked how
+many bytes it has committed and the upload resumes from there, with
+backoff.  Files of at least ``UPLOAD_PARALLEL_THRESHOLD`` bytes are split
+into parts that are uploaded concurrently, each through its own session,
+and then composed into one object.
+
+Object names are unique, so every upload is made with
+``if_generation_match=0`` and a retry can't overwrite anything.  If a
+one-request upload or a compose wrote the object but its response was lost,
+the retry fails that precondition; it then counts as done if the object has
+the expected size.  A session that completed without its response is
+reported as complete when queried, so resuming finishes it.
+
+The storage target is anything with the ``google.cloud.storage.Bucket``
+methods used here, and is named by a URL:
+
+    * ``gs://<bucket>`` is a GCS bucket.  Set ``STORAGE_EMULATOR_HOST`` to
+      use a fake GCS server instead.
+    * ``file:///<directory>`` is a ``FilesystemBucket``, a directory that
+      stands in for a bucket in local development and in the benchmarks
+      (see benchmarks/bench_suite.py).
+
+Uploaded bytes and failures are counted in the metrics; see metrics.py.
+"""
+import concurrent.futures
+import logging
+import math
+import os
+import shutil
+import time
+import uuid
+
+import requests
+
+try:
+    from google.api_core import exceptions as api_exceptions
+    from google.api_core.exceptions import PreconditionFailed
+except ImportError:
+    # Only GCS targets raise them, and they come with google-cloud-storage.
+    api_exceptions = None
+    PreconditionFailed = None
+
+LOGGER = logging.getLogger(__name__)
+
+# The size of the chunks of resumable uploads.  GCS needs a multiple of
+# 256 KiB.
+_CHUNK_ALIGNMENT = 256 * 1024
+CHUNK_SIZE = max(_CHUNK_ALIGNMENT, int(
+    os.environ.get('UPLOAD_CHUNK_SIZE', 16 * 1024**2)) // _CHUNK_ALIGNMENT *
+    _CHUNK_ALIGNMENT)
+
+# Files of at least this many bytes are uploaded in parallel parts.
+PARALLEL_THRESHOLD = int(
+    os.environ.get('UPLOAD_PARALLEL_THRESHOLD', 128 * 1024**2))
+
+# The number of parts uploaded at once.
+UPLOAD_WORKERS = int(os.environ.get('UPLOAD_WORKERS', 8))
+
+# The number of attempts at each upload, and the delay before the first
+# retry, which doubles with every retry.
+UPLOAD_ATTEMPTS = int(os.environ.get('UPLOAD_ATTEMPTS', 4))
+RETRY_DELAY = 1.0
+
+# GCS composes at most 32 objects at once.
+MAX_COMPOSE_COMPONENTS = 32
+
+# Seconds to wait for a request to a resumable upload session.
+SESSION_TIMEOUT = 60
+
+
+# What an upload made with if_generation_match=0 raises if the object
+# exists; FilesystemBlob raises FileExistsError.
+_PRECONDITION_ERRORS = (FileExistsError,) + (
+    (PreconditionFailed,) if PreconditionFailed is not None else ())
+
+
+def _has_size(blob, nbytes):
+    """Check whether an object exists with the given size."""
+    try:
+        blob.reload()
+    except Exception:
+        LOGGER.warning("Could not check %s", blob.name, exc_info=True)
+        return False
+    return blob.size == nbytes
+
+
+def _retry(func, blob, nbytes):
+    """Call ``func()`` to write ``blob``, retrying with backoff if it raises.
+
+    A retry that fails because the object exists means an earlier attempt
+    wrote it and only its response was lost, so it succeeds if the object
+    has the expected size.
+
+    Args:
+        func (callable): writes the object, with ``if_generation_match=0``.
+        blob: the object written.
+        nbytes (int): the size of the object once written.
+    """
+    for attempt in range(1, UPLOAD_ATTEMPTS + 1):
+        try:
+            return func()
+        except _PRECONDITION_ERRORS:
+            if attempt > 1 and _has_size(blob, nbytes):
+                LOGGER.info("%s was written by an earlier attempt",
+                            blob.name)
+                return None
+            raise
+        except Exception:
+            if attempt == UPLOAD_ATTEMPTS:
+                raise
+            _backoff(blob.name, attempt)
+
+
+def _backoff(name, attempt):
+    """Wait before retrying after failed attempt number ``attempt``."""
+    delay = RETRY_DELAY * 2 ** (attempt - 1)
+    LOGGER.warning("Failed to upload %s (attempt %s of %s); retrying in %ss",
+                   name, attempt, UPLOAD_ATTEMPTS, delay, exc_info=True)
+    time.sleep(delay)
+
+
+class _HTTPUploadSession:
+    """A GCS resumable upload session.
+
+    See https://cloud.google.com/storage/docs/performing-resumable-uploads.
+
+    Args:
+        url (str): the session URI, which authorizes the upload by itself.
+        nbytes (int): the size of the object.
+    """
+
+    def __init__(self, url, nbytes):
+        self.url = url
+        self.nbytes = nbytes
+
+    def _committed(self, response):
+        if response.status_code in (200, 201):
+            return self.nbytes
+        if response.status_code == 308:
+            # "Range: bytes=0-<last>", or none if nothing is committed.
+            committed_range = response.headers.get('Range')
+            if not committed_range:
+                return 0
+            return int(committed_range.rsplit('-', 1)[1]) + 1
+        if api_exceptions is not None:
+            raise api_exceptions.from_http_response(response)
+        response.raise_for_status()
+        raise requests.HTTPError(
+            f"Unexpected status {response.status_code}", response=response)
+
+    def send(self, data, offset):
+        """Send the bytes at ``offset`` and get the bytes committed."""
+        response = requests.put(self.url, data=data, headers={
+            'Content-Range':
+                f'bytes {offset}-{offset + len(data) - 1}/{self.nbytes}',
+        }, timeout=SESSION_TIMEOUT)
+        return self._committed(response)
+
+    def query(self):
+        """Get the number of bytes committed."""
+        response = requests.put(self.url, headers={
+            'Content-Range': f'bytes */{self.nbytes}',
+        }, timeout=SESSION_TIMEOUT)
+        return self._committed(response)
+
+
+def _upload_resumable(blob, local_path, offset, nbytes, content_type=None):
+    """Upload part of a file through a resumable session.
+
+    After a failure, the upload resumes from the bytes the session has
+    committed.
+
+    Args:
+        blob: the object to write.
+        local_path (str): the file to upload.
+        offset (int): where the bytes to upload start in the file.
+        nbytes (int): the number of bytes to upload.
+        content_type=None (str): the content type of the object.
+    """
+    session = blob.create_resumable_upload_session(
+        content_type=content_type, size=nbytes, if_generation_match=0)
+    if isinstance(session, str):
+        session = _HTTPUploadSession(session, nbytes)
+
+    committed = 0
+    n_failures = 0
+    with open(local_path, 'rb') as source:
+        while committed < nbytes:
+            try:
+                if n_failures:
+                    # The failed request may have committed some or all of
+                    # its bytes.
+                    committed = session.query()
+                    if committed >= nbytes:
+                        break
+                source.seek(offset + committed)
+                data = source.read(min(CHUNK_SIZE, nbytes - committed))
+                committed = session.send(data, committed)
+            except _PRECONDITION_ERRORS:
+                raise
+            except Exception:
+                n_failures += 1
+                if n_failures == UPLOAD_ATTEMPTS:
+                    raise
+                _backoff(blob.name, n_failures)
+    if n_failures:
+        LOGGER.info("Resumed the upload of %s %s times", blob.name,
+                    n_failures)
+
+
+def upload_file(bucket, local_path, object_name, content_type=None):
+    """Upload a file to the storage target.
+
+    Args:
+        bucket: the storage target, e.g. from ``get_bucket``.
+        local_path (str): the file to upload.
+        object_name (str): the name of the new object.
+        content_type=None (str): the content type of the object.
+
+    Returns:
+        A dict of the ``nbytes`` uploaded, the ``seconds`` it took, the
+        ``bytes_per_second`` and the number of ``parts``.
+    """
+    nbytes = os.path.getsize(local_path)
+    n_parts = 1
+    if nbytes >= PARALLEL_THRESHOLD and UPLOAD_WORKERS > 1:
+        n_parts = min(MAX_COMPOSE_COMPONENTS, math.ceil(nbytes / CHUNK_SIZE))
+
+    start = time.perf_counter()
+    if n_parts > 1:
+        _upload_composite(bucket, local_path, object_name, nbytes,
+                          n_parts, content_type)
+    elif nbytes >= CHUNK_SIZE:
+        _upload_resumable(bucket.blob(object_name), local_path, 0, nbytes,
+                          content_type)
+    else:
+        blob = bucket.blob(object_name)
+        _retry(lambda: blob.upload_from_filename(
+            local_path, content_type=content_type, if_generation_match=0),
+            blob, nbytes)
+    seconds = time.perf_counter() - start
+
+    bytes_per_second = nbytes / seconds if seconds else None
+    LOGGER.info("Uploaded %s bytes to %s in %.1fs (%s parts)", nbytes,
+                object_name, seconds, n_parts)
+    return {
+        'nbytes': nbytes,
+        'seconds': seconds,
+        'bytes_per_second': bytes_per_second,
+        'parts': n_parts,
+    }
+
+
+def _upload_composite(bucket, local_path, object_name, nbytes, n_parts,
+                      content_type):
+    """Upload a file in parts concurrently and compose them."""
+    part_size = math.ceil(nbytes / n_parts / _CHUNK_ALIGNMENT) * \
+        _CHUNK_ALIGNMENT
+    ranges = [(offset, min(part_size, nbytes - offset))
+              for offset in range(0, nbytes, part_size)]
+    part_names = [f'{object_name}.part{index:02d}'
+                  for index in range(len(ranges))]
+
+    def _upload_part(part_name, offset, length):
+        part_blob = bucket.blob(part_name)
+        _upload_resumable(part_blob, local_path, offset, length)
+        return part_blob
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=UPLOAD_WORKERS,
+                thread_name_prefix='upload') as pool:
+            parts = list(pool.map(
+                lambda args: _upload_part(*args),
+                [(part_name, offset, length) for part_name, (offset, length)
+                 in zip(part_names, ranges)]))
+
+        target_blob = bucket.blob(object_name)
+        target_blob.content_type = content_type
+        _retry(lambda: target_blob.compose(parts, if_generation_match=0),
+               target_blob, nbytes)
+    finally:
+        for part_name in part_names:
+            try:
+                bucket.blob(part_name).delete()
+            except Exception:
+                # Not uploaded, or already gone.
+                pass
+
+
+class _FilesystemUploadSession:
+    """A resumable upload session of a ``FilesystemBlob``.
+
+    Bytes are committed to a temporary file, which replaces the object once
+    complete.
+    """
+
+    def __init__(self, blob, nbytes, if_generation_match=None):
+        self.blob = blob
+        self.nbytes = nbytes
+        self.if_generation_match = if_generation_match
+        self.partial_path = f'{blob.path}.session-{uuid.uuid4().hex}'
+        self.complete = False
+        os.makedirs(os.path.dirname(self.partial_path), exist_ok=True)
+        open(self.partial_path, 'wb').close()
+
+    def send(self, data, offset):
+        if self.complete:
+            return self.nbytes
+        with open(self.partial_path, 'r+b') as partial:
+            partial.truncate(offset)
+            partial.seek(offset)
+            partial.write(data)
+        committed = offset + len(data)
+        if committed >= self.nbytes:
+            try:
+                self.blob._check_generation(self.if_generation_match)
+            except FileExistsError:
+                os.remove(self.partial_path)
+                raise
+            os.replace(self.partial_path, self.blob.path)
+            self.complete = True
+            return self.nbytes
+        return committed
+
+    def query(self):
+        if self.complete:
+            return self.nbytes
+        return os.path.getsize(self.partial_path)
+
+
+class FilesystemBlob:
+    """An object of a ``FilesystemBucket``."""
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.content_type = None
+
+    @property
+    def path(self):
+        return os.path.join(self.bucket.root, self.name)
+
+    @property
+    def size(self):
+        return os.path.getsize(self.path)
+
+    def _check_generation(self, if_generation_match):
+        if if_generation_match == 0 and os.path.exists(self.path):
+            raise FileExistsError(self.path)
+
+    def _open_for_writing(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        return open(self.path, 'wb')
+
+    def upload_from_filename(self, filename, content_type=None,
+                             if_generation_match=None, **kwargs):
+        self._check_generation(if_generation_match)
+        with open(filename, 'rb') as source, \
+                self._open_for_writing() as target:
+            shutil.copyfileobj(source, target)
+
+    def upload_from_file(self, file_obj, size=None, content_type=None,
+                         if_generation_match=None, **kwargs):
+        self._check_generation(if_generation_match)
+        with self._open_for_writing() as target:
+            if size is None:
+                shutil.copyfileobj(file_obj, target)
+            else:
+                target.write(file_obj.read(size))
+
+    def upload_from_string(self, data, content_type=None, **kwargs):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        with self._open_for_writing() as target:
+            target.write(data)
+
+    def download_as_bytes(self, **kwargs):
+        with open(self.path, 'rb') as source:
+            return source.read()
+
+    def create_resumable_upload_session(self, content_type=None, size=None,
+                                        if_generation_match=None, **kwargs):
+        return _FilesystemUploadSession(self, size, if_generation_match)
+
+    def compose(self, sources, if_generation_match=None, **kwargs):
+        self._check_generation(if_generation_match)
+        with self._open_for_writing() as target:
+            for source_blob in sources:
+                with open(source_blob.path, 'rb') as source:
+                    shutil.copyfileobj(source, target)
+
+    def exists(self, **kwargs):
+        return os.path.exists(self.path)
+
+    def reload(self, **kwargs):
+        if not self.exists():
+            raise FileNotFoundError(self.path)
+
+    def delete(self, **kwargs):
+        os.remove(self.path)
+
+
+class FilesystemBucket:
+    """A directory that stands in for a GCS bucket.
+
+    Args:
+        root (str): the directory.  It is created if needed.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def blob(self, name, chunk_size=None):
+        return FilesystemBlob(self, name)
+
+    def list_blobs(self, prefix=''):
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                name = os.path.relpath(
+                    os.path.join(dirpath, filename), self.root).replace(
+                        os.sep, '/')
+                if name.startswith(prefix):
+                    yield self.blob(name)
+
+
+def get_bucket(url):
+    """Get the storage target named by a URL.
+
+    Args:
+        url (str): ``gs://<bucket>`` or ``file:///<directory>``.
+
+    Returns:
+        A ``google.cloud.storage.Bucket`` or a ``FilesystemBucket``.
+    """
+    if url.startswith('gs://'):
+        # Imported here so that the filesystem target works without it.
+        from google.cloud import storage
+        return storage.Client().bucket(url.removeprefix('gs://'))
+    if url.startswith('file://'):
+        return FilesystemBucket(url.removeprefix('file://'))
+    raise ValueError(f"Unsupported storage target: {url}")
@@ -0,0 +1,690 @@
+"""Vector clipping engines.
+
+app/vector_clip.py
+
+Two engines clip a FlatGeobuf to a bounding box:
+
+    * ``per-feature`` loads and tests each feature with Shapely in turn.
+    * ``batched`` reads features in chunks through OGR's Arrow stream
+      interface and tests whole chunks at once with Shapely's vectorized
+      functions, writing the matching rows back in bulk.  It needs GDAL >= 3.8
+      and pyarrow, and is much faster on large vectors.  When
+      ``VECTOR_CLIP_PROCESSES`` is more than 1, large clips are split into
+      spatial partitions that are clipped by a pool of processes.
+
+The engine is selected with the ``VECTOR_CLIP_ENGINE`` environment variable.
+By default the batched engine is used when it is available.
+
+Both engines can keep a subset of the source's fields, which are then not
+read at all, and simplify the kept geometries in the target projection.
+"""
+import concurrent.futures
+import functools
+import logging
+import math
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+import numpy
+import pyproj
+import shapely
+import shapely.prepared
+import shapely.wkb
+from osgeo import gdal
+from osgeo import ogr
+from osgeo import osr
+
+import flatgeobuf
+import gdal_profile
+import progress
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+LOGGER = logging.getLogger(__name__)
+
+PER_FEATURE = 'per-feature'
+BATCHED = 'batched'
+VECTOR_CLIP_ENGINE = os.environ.get('VECTOR_CLIP_ENGINE', BATCHED)
+
+# The number of features read from the source per batch.
+BATCH_SIZE = int(os.environ.get('VECTOR_CLIP_BATCH_SIZE', 65536))
+
+# The number of processes that clip a large vector in parallel, by spatial
+# partitions.  Match this to the number of CPUs available to the container.
+VECTOR_CLIP_PROCESSES = int(os.environ.get('VECTOR_CLIP_PROCESSES', 1))
+
+# Partitioning only pays off for clips with at least this many features.
+PARTITION_MIN_FEATURES = int(
+    os.environ.get('VECTOR_PARTITION_MIN_FEATURES', 500000))
+
+# More partitions than processes keeps the processes busy when the features
+# are unevenly distributed.
+PARTITIONS_PER_PROCESS = 2
+
+
+def batched_engine_available():
+    """Whether GDAL and pyarrow support the batched engine."""
+    return pyarrow is not None and hasattr(ogr.Layer, 'WritePyArrow')
+
+
+def clip_vector_to_bounding_box(
+        source_vector_path, target_bounding_box, target_vector_path,
+        target_projection_wkt=None, engine=None, mask_geometry=None,
+        fields=None, simplify_tolerance=None, estimated_feature_count=None):
+    """Clip a vector to the intersection of a target bounding box.
+
+    Optionally also reproject the vector.  Features that intersect the
+    bounding box are kept whole; invalid features are skipped.
+
+    Args:
+        source_vector_path (str): path to a FlatGeobuf to be clipped.
+        target_bounding_box (list): list of the form [xmin, ymin, xmax, ymax]
+        target_vector_path (str): path to a FlatGeobuf to store the clipped
+            vector.
+        target_projection_wkt=None (str): target projection in wkt. Can be
+            none to indicate no reprojection is required.
+        engine=None (str): ``batched`` or ``per-feature``.  Defaults to
+            ``VECTOR_CLIP_ENGINE``, falling back to the per-feature engine
+            when the batched engine is not available.
+        mask_geometry=None (shapely.Geometry): a polygon in the projection of
+            the source.  If given, only features that also intersect it are
+            kept; ``target_bounding_box`` should be its envelope, which is
+            used to pre-filter features with the spatial index.
+        fields=None (list): the names of the fields to keep, or ``None`` to
+            keep every field.
+        simplify_tolerance=None (float): if given, kept geometries are
+            simplified to this tolerance, in the units of the target
+            projection, preserving their topology.
+        estimated_feature_count=None (int): the estimated number of features
+            in the bounding box, see estimate.py, which decides whether the
+            batched engine partitions the clip.  Estimated from the
+            FlatGeobuf's spatial index if not given.
+
+    Returns:
+        A dict of the number of features processed (``n_processed``), kept
+        (``n_kept``) and skipped because they were invalid (``n_invalid``).
+
+    Raises:
+        ValueError: if a field is not in the source vector.
+    """
+    if engine is None:
+        engine = VECTOR_CLIP_ENGINE
+    if engine == BATCHED and not batched_engine_available():
+        LOGGER.warning("The batched vector engine needs GDAL >= 3.8 and "
+                       "pyarrow; clipping feature by feature instead.")
+        engine = PER_FEATURE
+
+    if engine == BATCHED:
+        clip_function = functools.partial(
+            _clip_batched, estimated_feature_count=estimated_feature_count)
+    elif engine == PER_FEATURE:
+        clip_function = _clip_per_feature
+    else:
+        raise ValueError(f"Unknown vector clip engine: {engine}")
+    return clip_function(
+        source_vector_path, target_bounding_box, target_vector_path,
+        target_projection_wkt, mask_geometry, fields, simplify_tolerance)
+
+
+def _clip_per_feature(
+        source_vector_path, target_bounding_box, target_vector_path,
+        target_projection_wkt=None, mask_geometry=None, fields=None,
+        simplify_tolerance=None):
+    """Clip a vector one feature at a time.
+
+    See ``clip_vector_to_bounding_box`` for the arguments.
+    """
+    shapely_mask = shapely.prepared.prep(
+        _clip_mask(target_bounding_box, mask_geometry))
+
+    LOGGER.debug("Opening base vector...")
+    base_vector = gdal.OpenEx(source_vector_path, gdal.OF_VECTOR)
+    base_layer = base_vector.GetLayer()
+    base_layer.SetSpatialFilterRect(*target_bounding_box)
+    target_fields = _select_fields(base_layer, fields)
+
+    if target_projection_wkt is not None:
+        # Transform in (x, y) order, as the batched engine's pyproj
+        # transformer does, whatever the axis order of either projection.
+        base_srs = base_layer.GetSpatialRef().Clone()
+        base_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        target_srs = osr.SpatialReference()
+        target_srs.ImportFromWkt(target_projection_wkt)
+        target_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        coord_trans = osr.CreateCoordinateTransformation(
+            base_srs, target_srs)
+
+    LOGGER.debug("Setting up target...")
+    target_vector, target_layer = _create_target(
+        base_layer, target_vector_path, target_projection_wkt, target_fields)
+    target_layer_defn = target_layer.GetLayerDefn()
+
+    LOGGER.debug("Clipping vector...")
+    # Only count the features if the driver can do so cheaply; -1 otherwise.
+    n_features = base_layer.GetFeatureCount(force=0)
+    target_layer.StartTransaction()
+    invalid_feature_count = 0
+    n_processed = 0
+    n_kept = 0
+    last_log_msg_time = time.time()
+    for feature in base_layer:
+        now = time.time()
+        if now >= last_log_msg_time+2.0:
+            LOGGER.debug(f"Processed {n_processed} features so far")
+            progress.report(
+                features_processed=n_processed,
+                fraction=(n_processed / n_features if n_features > 0
+                          else None))
+            last_log_msg_time = now
+        n_processed += 1
+
+        invalid = False
+        geometry = feature.GetGeometryRef()
+        try:
+            shapely_geom = shapely.wkb.loads(bytes(geometry.ExportToWkb()))
+        # Catch invalid geometries that cannot be loaded by Shapely;
+        # e.g. polygons with too few points for their type
+        except shapely.errors.ShapelyError:
+            invalid = True
+        else:
+            if shapely_geom.is_valid:
+                # Check for intersection rather than use gdal.Layer.Clip()
+                # to preserve the shape of the polygons
+                if shapely_mask.intersects(shapely_geom):
+                    if fields is None:
+                        # This appears to use the network WAY less
+                        new_feature = ogr.Feature.Clone(feature)
+                    else:
+                        # Copy the selected fields, by name.
+                        new_feature = ogr.Feature(target_layer_defn)
+                        new_feature.SetFrom(feature)
+
+                    # If we need to, transform the geometry
+                    if target_projection_wkt is not None:
+                        geometry.Transform(coord_trans)
+                        new_feature.SetGeometry(geometry)
+                    if simplify_tolerance:
+                        new_feature.SetGeometry(
+                            geometry.SimplifyPreserveTopology(
+                                simplify_tolerance))
+
+                    target_layer.CreateFeature(new_feature)
+                    n_kept += 1
+            else:
+                invalid = True
+        finally:
+            if invalid:
+                invalid_feature_count += 1
+                LOGGER.warning(
+                    f"The geometry at feature {feature.GetFID()} is invalid "
+                    "and will be skipped.")
+
+    target_layer.CommitTransaction()
+
+    if invalid_feature_count:
+        LOGGER.warning(
+            f"{invalid_feature_count} features in {source_vector_path} "
+            "were found to be invalid during clipping and were skipped.")
+
+    base_layer = None
+    base_vector = None
+    # Closing the dataset flushes the FlatGeobuf before its size is read.
+    del target_layer, target_vector
+    progress.report(features_processed=n_processed, fraction=1.0,
+                    bytes_written=os.path.getsize(target_vector_path))
+    return {'n_processed': n_processed, 'n_kept': n_kept,
+            'n_invalid': invalid_feature_count}
+
+
+def _select_fields(base_layer, fields=None):
+    """Have a layer skip reading the fields that are not selected.
+
+    Args:
+        base_layer (ogr.Layer): the layer to read.
+        fields=None (list): the names of the fields to keep, or ``None`` to
+            keep every field.
+
+    Returns:
+        The names of the fields to keep, in the layer's order.
+
+    Raises:
+        ValueError: if a field is not in the layer.
+    """
+    layer_defn = base_layer.GetLayerDefn()
+    field_names = [layer_defn.GetFieldDefn(index).GetName()
+                   for index in range(layer_defn.GetFieldCount())]
+    if fields is None:
+        return field_names
+
+    unknown_fields = sorted(set(fields) - set(field_names))
+    if unknown_fields:
+        raise ValueError(
+            f"Unknown fields: {', '.join(unknown_fields)}. Choose from "
+            f"{', '.join(field_names)}.")
+    base_layer.SetIgnoredFields(
+        [name for name in field_names if name not in fields])
+    return [name for name in field_names if name in fields]
+
+
+def _create_target(base_layer, target_vector_path, target_projection_wkt,
+                   target_fields=None):
+    """Create a FlatGeobuf with the schema of ``base_layer``.
+
+    Args:
+        base_layer (ogr.Layer): the layer being clipped.
+        target_vector_path (str): the path of the FlatGeobuf.
+        target_projection_wkt (str): the target projection, or ``None`` to
+            keep the layer's.
+        target_fields=None (list): the names of the fields to create, or
+            ``None`` for every field of ``base_layer``.
+
+    Returns:
+        A tuple of the target dataset and layer.
+    """
+    if target_projection_wkt is not None:
+        target_srs = osr.SpatialReference()
+        target_srs.ImportFromWkt(target_projection_wkt)
+    else:
+        target_srs = base_layer.GetSpatialRef()
+
+    target_driver = gdal.GetDriverByName('FlatGeobuf')
+    target_vector = target_driver.Create(
+        target_vector_path, 0, 0, 0, gdal.GDT_Unknown)
+    target_layer = target_vector.CreateLayer(
+        base_layer.GetLayerDefn().GetName(), target_srs,
+        base_layer.GetGeomType())
+    target_layer.CreateFields([
+        field_defn for field_defn in base_layer.schema
+        if target_fields is None or field_defn.GetName() in target_fields])
+    return target_vector, target_layer
+
+
+def _clip_mask(target_bounding_box, mask_geometry=None):
+    """Get the geometry that kept features must intersect."""
+    bounding_box = shapely.box(*target_bounding_box)
+    if mask_geometry is None:
+        return bounding_box
+    return shapely.intersection(mask_geometry, bounding_box)
+
+
+@functools.lru_cache(maxsize=64)
+def _cached_transformer(source_projection_wkt, target_projection_wkt):
+    # pyproj transformers are thread-safe (pyproj >= 3.1), so one can be
+    # shared by every request for the same pair of projections.
+    return pyproj.Transformer.from_crs(
+        pyproj.CRS.from_wkt(source_projection_wkt),
+        pyproj.CRS.from_wkt(target_projection_wkt), always_xy=True)
+
+
+def _transformer(base_layer, target_projection_wkt):
+    """Get a transformer from a layer's projection to a target projection.
+
+    Returns:
+        A ``pyproj.Transformer``, or ``None`` if no reprojection is needed.
+    """
+    if target_projection_wkt is None:
+        return None
+    return _cached_transformer(
+        base_layer.GetSpatialRef().ExportToWkt(), target_projection_wkt)
+
+
+def _reproject(geometries, transformer):
+    """Reproject an array of Shapely geometries in one vectorized call.
+
+    Args:
+        geometries (numpy.ndarray): the geometries to reproject.
+        transformer (pyproj.Transformer): the transformation to apply, with
+            traditional GIS (x, y) axis order.
+
+    Returns:
+        A new array of reprojected geometries.
+    """
+    def _transform_coords(coords):
+        transformed = transformer.transform(*coords.T)
+        return numpy.column_stack(transformed)
+
+    has_z = shapely.has_z(geometries)
+    reprojected = numpy.empty_like(geometries)
+    reprojected[~has_z] = shapely.transform(
+        geometries[~has_z], _transform_coords)
+    if numpy.any(has_z):
+        reprojected[has_z] = shapely.transform(
+            geometries[has_z], _transform_coords, include_z=True)
+    return reprojected
+
+
+def _column_names(base_layer):
+    """Get the geometry and FID column names of a layer's Arrow stream."""
+    # These are the defaults of OGR's Arrow stream.
+    return (base_layer.GetGeometryColumn() or 'wkb_geometry',
+            base_layer.GetFIDColumn() or 'OGC_FID')
+
+
+def _read_clipped(source_vector_path, base_layer, mask, transformer, stats,
+                  simplify_tolerance=None):
+    """Read the features of a layer that intersect a mask.
+
+    The layer's spatial filter and ignored fields should already be set.
+    Invalid features are skipped and counted.
+
+    Args:
+        source_vector_path (str): the path of the layer, for logging.
+        base_layer (ogr.Layer): the layer to read.
+        mask (shapely.Geometry): the geometry to intersect, as returned by
+            ``_clip_mask``.  It is prepared here.
+        transformer (pyproj.Transformer): the transformation to the target
+            projection, or ``None``.
+        stats (dict): ``n_processed`` and ``n_invalid`` are incremented here.
+            If it has ``processed_fids`` and ``invalid_fids`` lists, the FIDs
+            of each batch are appended to them too.
+        simplify_tolerance=None (float): the tolerance to simplify the kept
+            geometries to after reprojecting them, or ``None``.
+
+    Yields:
+        A ``pyarrow.Table`` of the features to keep in each batch, including
+        their FID column.
+    """
+    # Preparing builds a spatial index of the mask's edges, which makes
+    # intersecting complex polygons such as countries much faster.
+    shapely.prepare(mask)
+    geometry_column, fid_column = _column_names(base_layer)
+
+    stream = base_layer.GetArrowStreamAsPyArrow(
+        [f'MAX_FEATURES_IN_BATCH={BATCH_SIZE}'])
+    for batch in stream:
+        wkb_geometries = batch.column(geometry_column).to_numpy(
+            zero_copy_only=False)
+        # Geometries that cannot be loaded by Shapely (e.g. polygons with too
+        # few points for their type) become None, which is not valid.
+        geometries = shapely.from_wkb(wkb_geometries, on_invalid='ignore')
+        valid = shapely.is_valid(geometries)
+        # Check for intersection rather than use gdal.Layer.Clip()
+        # to preserve the shape of the polygons
+        keep = valid & shapely.intersects(mask, geometries)
+
+        fids = batch.column(fid_column).to_numpy(zero_copy_only=False)
+        n_invalid = int(numpy.count_nonzero(~valid))
+        if n_invalid:
+            stats['n_invalid'] += n_invalid
+            invalid_fids = fids[~valid]
+            LOGGER.warning(
+                f"The geometries at features {invalid_fids.tolist()} of "
+                f"{source_vector_path} are invalid and will be skipped.")
+            if 'invalid_fids' in stats:
+                stats['invalid_fids'].append(invalid_fids)
+        stats['n_processed'] += batch.num_rows
+        if 'processed_fids' in stats:
+            stats['processed_fids'].append(fids)
+
+        if numpy.any(keep):
+            selected = pyarrow.Table.from_batches([batch]).filter(
+                pyarrow.array(keep))
+            if transformer is not None or simplify_tolerance:
+                # Reproject and simplify the whole batch at once rather than
+                # feature by feature, reusing the geometries loaded above.
+                target_geometries = geometries[keep]
+                if transformer is not None:
+                    target_geometries = _reproject(
+                        target_geometries, transformer)
+                if simplify_tolerance:
+                    target_geometries = shapely.simplify(
+                        target_geometries, simplify_tolerance,
+                        preserve_topology=True)
+                selected = selected.set_column(
+                    selected.schema.get_field_index(geometry_column),
+                    selected.schema.field(geometry_column),
+                    pyarrow.array(shapely.to_wkb(target_geometries),
+                                  type=pyarrow.binary()))
+            yield selected
+        else:
+            # Still yield so that callers can report progress.
+            yield None
+
+
+def _write_table(target_layer, table, geometry_column, fid_column):
+    """Write the features of a table, except their FIDs, to a layer."""
+    table = table.drop_columns([fid_column])
+    for record_batch in table.to_batches():
+        target_layer.WritePyArrow(
+            record_batch, options=[f'GEOMETRY_NAME={geometry_column}'])
+
+
+def _report_invalid(source_vector_path, invalid_feature_count):
+    if invalid_feature_count:
+        LOGGER.warning(
+            f"{invalid_feature_count} features in {source_vector_path} "
+            "were found to be invalid during clipping and were skipped.")
+
+
+def _clip_batched(source_vector_path, target_bounding_box, target_vector_path,
+                  target_projection_wkt=None, mask_geometry=None, fields=None,
+                  simplify_tolerance=None, estimated_feature_count=None):
+    """Clip a vector in batches of features.
+
+    Large clips are split into spatial partitions that are clipped in
+    parallel processes when ``VECTOR_CLIP_PROCESSES`` is more than 1.
+
+    See ``clip_vector_to_bounding_box`` for the arguments.
+    """
+    LOGGER.debug("Opening base vector...")
+    base_vector = gdal.OpenEx(source_vector_path, gdal.OF_VECTOR)
+    base_layer = base_vector.GetLayer()
+    # Checked before partitioning, so that unknown fields fail early.
+    target_fields = _select_fields(base_layer, fields)
+
+    if VECTOR_CLIP_PROCESSES > 1 and estimated_feature_count is None:
+        estimated_feature_count = flatgeobuf.estimate_feature_count(
+            source_vector_path, target_bounding_box)
+    if (VECTOR_CLIP_PROCESSES > 1 and
+            estimated_feature_count >= PARTITION_MIN_FEATURES):
+        base_layer = None
+        base_vector = None
+        return _clip_partitioned(
+            source_vector_path, target_bounding_box, target_vector_path,
+            target_projection_wkt, mask_geometry, fields, simplify_tolerance)
+
+    base_layer.SetSpatialFilterRect(*target_bounding_box)
+    n_features = base_layer.GetFeatureCount(force=0)
+    transformer = _transformer(base_layer, target_projection_wkt)
+    geometry_column, fid_column = _column_names(base_layer)
+
+    LOGGER.debug("Setting up target...")
+    target_vector, target_layer = _create_target(
+        base_layer, target_vector_path, target_projection_wkt, target_fields)
+
+    LOGGER.debug("Clipping vector...")
+    target_layer.StartTransaction()
+    stats = {'n_processed': 0, 'n_invalid': 0}
+    n_kept = 0
+    mask = _clip_mask(target_bounding_box, mask_geometry)
+    for table in _read_clipped(source_vector_path, base_layer, mask,
+                               transformer, stats, simplify_tolerance):
+        if table is not None:
+            _write_table(target_layer, table, geometry_column, fid_column)
+            n_kept += table.num_rows
+
+        n_processed = stats['n_processed']
+        LOGGER.debug(f"Processed {n_processed} features so far")
+        progress.report(
+            features_processed=n_processed,
+            fraction=(min(n_processed / n_features, 1.0) if n_features > 0
+                      else None))
+    target_layer.CommitTransaction()
+    _report_invalid(source_vector_path, stats['n_invalid'])
+
+    base_layer = None
+    base_vector = None
+    # Closing the dataset flushes the FlatGeobuf before its size is read.
+    del target_layer, target_vector
+    progress.report(features_processed=stats['n_processed'], fraction=1.0,
+                    bytes_written=os.path.getsize(target_vector_path))
+    return {'n_processed': stats['n_processed'], 'n_kept': n_kept,
+            'n_invalid': stats['n_invalid']}
+
+
+def _partition_bbox(bbox, n_partitions):
+    """Split a bounding box into a grid of about ``n_partitions`` cells."""
+    n_cols = math.ceil(math.sqrt(n_partitions))
+    n_rows = math.ceil(n_partitions / n_cols)
+    xs = numpy.linspace(bbox[0], bbox[2], n_cols + 1)
+    ys = numpy.linspace(bbox[1], bbox[3], n_rows + 1)
+    return [[float(xs[col]), float(ys[row]),
+             float(xs[col + 1]), float(ys[row + 1])]
+            for row in range(n_rows) for col in range(n_cols)]
+
+
+@functools.cache
+def _process_pool():
+    # Use spawn rather than fork, since the service forks from a process
+    # with threads (and GDAL state) that a child must not inherit.
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=VECTOR_CLIP_PROCESSES,
+        mp_context=multiprocessing.get_context('spawn'))
+
+
+def _clip_partition(source_vector_path, partition_bbox, mask,
+                    target_projection_wkt, partial_path, fields=None,
+                    simplify_tolerance=None):
+    """Clip the features of one partition into an Arrow IPC file.
+
+    Runs in a worker process.  Features are kept with their source FIDs so
+    that features read by more than one partition can be de-duplicated.
+
+    Returns:
+        A dict of the FIDs of the features processed (``processed_fids``)
+        and found invalid (``invalid_fids``), and whether anything was
+        ``written``.
+    """
+    # Worker processes don't inherit the caller's per-thread options.
+    with gdal_profile.config_options():
+        base_vector = gdal.OpenEx(source_vector_path, gdal.OF_VECTOR)
+        base_layer = base_vector.GetLayer()
+        base_layer.SetSpatialFilterRect(*partition_bbox)
+        _select_fields(base_layer, fields)
+        transformer = _transformer(base_layer, target_projection_wkt)
+
+        stats = {'n_processed': 0, 'n_invalid': 0,
+                 'processed_fids': [], 'invalid_fids': []}
+        writer = None
+        try:
+            for table in _read_clipped(source_vector_path, base_layer, mask,
+                                       transformer, stats, simplify_tolerance):
+                if table is None:
+                    continue
+                if writer is None:
+                    writer = pyarrow.ipc.new_file(partial_path, table.schema)
+                writer.write_table(table)
+        finally:
+            if writer is not None:
+                writer.close()
+        return {
+            'processed_fids': _concatenate_fids(stats['processed_fids']),
+            'invalid_fids': _concatenate_fids(stats['invalid_fids']),
+            'written': writer is not None,
+        }
+
+
+def _concatenate_fids(fid_arrays):
+    if not fid_arrays:
+        return numpy.empty(0, dtype=numpy.int64)
+    return numpy.concatenate(fid_arrays).astype(numpy.int64)
+
+
+def _clip_partitioned(source_vector_path, target_bounding_box,
+                      target_vector_path, target_projection_wkt=None,
+                      mask_geometry=None, fields=None,
+                      simplify_tolerance=None):
+    """Clip a vector by partitions in parallel processes.
+
+    The bounding box is split into a grid of partitions, each clipped by a
+    worker process with its own spatial filter.  A feature that crosses a
+    partition boundary is read by each of those partitions, so the partial
+    outputs are merged in order, keeping only the first copy of each FID,
+    and features are counted by their distinct FIDs.
+
+    See ``clip_vector_to_bounding_box`` for the arguments.
+    """
+    mask = _clip_mask(target_bounding_box, mask_geometry)
+    # Partitions of the bounding box outside a polygon mask have nothing to
+    # clip.
+    partitions = [
+        partition_bbox for partition_bbox in _partition_bbox(
+            target_bounding_box,
+            VECTOR_CLIP_PROCESSES * PARTITIONS_PER_PROCESS)
+        if shapely.intersects(mask, shapely.box(*partition_bbox))]
+    LOGGER.info(f"Clipping {source_vector_path} in {len(partitions)} "
+                f"partitions with {VECTOR_CLIP_PROCESSES} processes")
+
+    partial_dir = tempfile.mkdtemp(
+        prefix='partitions-', dir=os.path.dirname(target_vector_path))
+    try:
+        partial_paths = [
+            os.path.join(partial_dir, f'{index}.arrow')
+            for index in range(len(partitions))]
+        futures = [
+            _process_pool().submit(
+                _clip_partition, source_vector_path, partition_bbox,
+                mask, target_projection_wkt, partial_path, fields,
+                simplify_tolerance)
+            for partition_bbox, partial_path in zip(
+                partitions, partial_paths)]
+
+        processed_fids = numpy.empty(0, dtype=numpy.int64)
+        invalid_fids = numpy.empty(0, dtype=numpy.int64)
+        written = []
+        for n_done, future in enumerate(
+                concurrent.futures.as_completed(futures), start=1):
+            stats = future.result()
+            processed_fids = numpy.union1d(
+                processed_fids, stats['processed_fids'])
+            invalid_fids = numpy.union1d(invalid_fids, stats['invalid_fids'])
+            progress.report(features_processed=processed_fids.size,
+                            fraction=n_done / len(futures))
+        n_processed = processed_fids.size
+        n_invalid = invalid_fids.size
+        for future, partial_path in zip(futures, partial_paths):
+            if future.result()['written']:
+                written.append(partial_path)
+
+        LOGGER.debug("Merging partitions...")
+        base_vector = gdal.OpenEx(source_vector_path, gdal.OF_VECTOR)
+        base_layer = base_vector.GetLayer()
+        geometry_column, fid_column = _column_names(base_layer)
+        target_fields = _select_fields(base_layer, fields)
+        target_vector, target_layer = _create_target(
+            base_layer, target_vector_path, target_projection_wkt,
+            target_fields)
+
+        target_layer.StartTransaction()
+        n_kept = 0
+        seen_fids = numpy.empty(0, dtype=numpy.int64)
+        for partial_path in written:
+            with pyarrow.ipc.open_file(partial_path) as reader:
+                table = reader.read_all()
+            fids = table.column(fid_column).to_numpy()
+            new = ~numpy.isin(fids, seen_fids)
+            seen_fids = numpy.concatenate([seen_fids, fids[new]])
+            n_kept += int(numpy.count_nonzero(new))
+            if numpy.any(new):
+                _write_table(target_layer, table.filter(pyarrow.array(new)),
+                             geometry_column, fid_column)
+        target_layer.CommitTransaction()
+        _report_invalid(source_vector_path, n_invalid)
+
+        base_layer = None
+        base_vector = None
+        # Closing the dataset flushes the FlatGeobuf before its size is read.
+        del target_layer, target_vector
+    finally:
+        shutil.rmtree(partial_dir, ignore_errors=True)
+    progress.report(features_processed=n_processed, fraction=1.0,
+                    bytes_written=os.path.getsize(target_vector_path))
+    return {'n_processed': n_processed, 'n_kept': n_kept,
+            'n_invalid': n_invalid}
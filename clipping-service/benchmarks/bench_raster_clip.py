@@ -0,0 +1,118 @@
+"""Compare the throughput of the raster clipping engines.
+
+Creates a synthetic COG (unless one is given), serves it from a local HTTP
+range server and clips it through ``/vsicurl/`` with each engine, reporting
+the wall time and the number of output pixels per second.
+
+    $ python clipping-service/benchmarks/bench_raster_clip.py --size 16384
+
+Pass ``--latency`` to mimic a remote bucket, e.g. ``--latency 0.02``, and
+``--tile-size``/``--workers`` to tune the tiled engine.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from osgeo import gdal
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'app'))
+import range_server  # noqa: E402
+import raster_clip  # noqa: E402
+import synthetic  # noqa: E402
+
+gdal.UseExceptions()
+
+
+def benchmark(source_url, bbox, engines, cellsize=None, repeat=3):
+    """Clip the raster at ``source_url`` with each engine and print timings.
+
+    Args:
+        source_url (str): the http(s) URL of the COG to clip.
+        bbox (list): the bounding box to clip to.
+        engines (list): the names of the engines to run.
+        cellsize=None (list): the target cell size; the source's by default.
+        repeat=3 (int): the number of runs per engine; the best is reported.
+
+    Returns:
+        A dict mapping engine names to their best time in seconds.
+    """
+    source_path = f'/vsicurl/{source_url}'
+    source = gdal.Open(source_path)
+    geotransform = source.GetGeoTransform()
+    source = None
+    if cellsize is None:
+        cellsize = [geotransform[1], geotransform[5]]
+    n_cols, n_rows = raster_clip._grid_size(bbox, cellsize)
+    print(f"Clipping {n_cols} x {n_rows} pixels from {source_url}")
+
+    results = {}
+    with tempfile.TemporaryDirectory() as workspace:
+        for engine in engines:
+            timings = []
+            for run in range(repeat):
+                # Start each run cold, as a new source would be.
+                gdal.VSICurlClearCache()
+                target_path = os.path.join(workspace, f'{engine}-{run}.tif')
+                start = time.perf_counter()
+                raster_clip.clip_raster(
+                    source_path, cellsize, target_path, bbox, engine=engine)
+                timings.append(time.perf_counter() - start)
+            best = min(timings)
+            results[engine] = best
+            print(f"{engine:>8}: {best:8.3f} s  "
+                  f"{n_cols * n_rows / best:14.0f} pixels/s")
+
+    if len(results) > 1:
+        baseline = results[engines[0]]
+        for engine in engines[1:]:
+            print(f"{engine} is {baseline / results[engine]:.1f}x as fast as "
+                  f"{engines[0]}")
+    return results
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(__file__),
+        description="Benchmark the raster clipping engines.")
+    parser.add_argument('--source', default=None, help=(
+        "A COG to clip.  A synthetic one is created if not given."))
+    parser.add_argument('--size', type=int, default=8192, help=(
+        "The width and height of the synthetic COG, in pixels."))
+    parser.add_argument('--bbox', type=float, nargs=4,
+                        default=[-90, -45, 90, 45], help=(
+                            "The bounding box to clip to."))
+    parser.add_argument('--engines', nargs='+',
+                        default=[raster_clip.SINGLE, raster_clip.TILED],
+                        help="The engines to compare.")
+    parser.add_argument('--tile-size', type=int, default=None, help=(
+        "The tile size of the tiled engine, in pixels."))
+    parser.add_argument('--workers', type=int, default=None, help=(
+        "The number of tiles the tiled engine warps at once."))
+    parser.add_argument('--latency', type=float, default=0.0, help=(
+        "Seconds the range server adds to every request."))
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args(args)
+
+    if args.tile_size is not None:
+        raster_clip.RASTER_TILE_SIZE = args.tile_size
+    if args.workers is not None:
+        raster_clip.RASTER_CLIP_WORKERS = args.workers
+
+    with tempfile.TemporaryDirectory() as workspace:
+        if args.source is None:
+            print(f"Creating a {args.size} x {args.size} synthetic COG...")
+            synthetic.make_cog(os.path.join(workspace, 'synthetic.tif'),
+                               args.size)
+        else:
+            shutil.copy(args.source, os.path.join(workspace, 'synthetic.tif'))
+        with range_server.RangeServer(
+                workspace, latency=args.latency) as server:
+            benchmark(server.url('synthetic.tif'), args.bbox, args.engines,
+                      repeat=args.repeat)
+
+
+if __name__ == '__main__':
+    main()
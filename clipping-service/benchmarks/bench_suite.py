@@ -0,0 +1,286 @@
+"""End-to-end benchmarks of the clipping service.
+
+Runs raster and vector clip scenarios through the ``/clip`` endpoint of
+app.py, entirely offline:
+
+    * the sources are synthetic COGs and FlatGeobufs (see synthetic.py),
+      kept in ``--data-dir`` so that they are only generated once;
+    * they are served by a local range server (see range_server.py) that
+      stands in for storage.googleapis.com, optionally with added latency;
+    * clipped files are uploaded to a ``FilesystemBucket`` (see upload.py)
+      in a temporary directory.
+
+Each scenario runs in a new process, so that its peak memory can be measured
+and no caches carry over between engines.  For each scenario, the best wall
+time of ``--repeat`` runs, the throughput, the output size and the peak
+memory (max RSS) are reported, and ``--json`` saves them to compare runs.
+
+    $ python clipping-service/benchmarks/bench_suite.py --quick
+    $ python clipping-service/benchmarks/bench_suite.py \\
+        --raster-sizes 8192 32768 --vector-features 10000 1000000 10000000
+    $ python clipping-service/benchmarks/bench_suite.py \\
+        --gdal-profiles remote-cog gdal-defaults --latency 0.05
+"""
+import argparse
+import concurrent.futures
+import itertools
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from osgeo import gdal
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'app'))
+import range_server  # noqa: E402
+import synthetic  # noqa: E402
+
+gdal.UseExceptions()
+
+RASTER_ENGINES = ['single', 'tiled']
+VECTOR_ENGINES = ['per-feature', 'batched']
+
+# Clips are reprojected to this projection in the reprojected scenarios.
+REPROJECTED_EPSG = 3857
+# Roughly the number of meters in a degree, to size reprojected pixels.
+_METERS_PER_DEGREE = 111320
+
+
+def _source_path(data_dir, layer_type, size, geometry_type=None):
+    """Create a synthetic source unless it already exists.
+
+    Returns:
+        The name of the source file in ``data_dir``.
+    """
+    if layer_type == 'raster':
+        filename = f'raster-{size}.tif'
+    else:
+        filename = f'vector-{geometry_type}-{size}.fgb'
+    path = os.path.join(data_dir, filename)
+    if not os.path.exists(path):
+        print(f"Creating {filename}...", flush=True)
+        if layer_type == 'raster':
+            synthetic.make_cog(path, size)
+        else:
+            synthetic.make_flatgeobuf(path, size, geometry_type=geometry_type)
+    return filename
+
+
+def _scenarios(args):
+    """List the scenarios to run, creating their sources as needed."""
+    scenarios = []
+    # Only name the profile when comparing several.
+    profile_suffixes = {
+        profile: f' {profile}' if len(args.gdal_profiles) > 1 else ''
+        for profile in args.gdal_profiles}
+    for size, target_epsg, engine, profile in itertools.product(
+            args.raster_sizes, [None, REPROJECTED_EPSG], args.raster_engines,
+            args.gdal_profiles):
+        source = _source_path(args.data_dir, 'raster', size)
+        pixel_size = (synthetic.WORLD_BBOX[2] - synthetic.WORLD_BBOX[0]) / size
+        if target_epsg is not None:
+            pixel_size *= _METERS_PER_DEGREE
+        scenarios.append({
+            'name': f"raster {size}px {engine}"
+                    f"{' reprojected' if target_epsg else ''}"
+                    f"{profile_suffixes[profile]}",
+            'layer_type': 'raster',
+            'source': source,
+            'engine': engine,
+            'gdal_profile': profile,
+            'target_epsg': target_epsg,
+            'target_cellsize': [pixel_size, -pixel_size],
+        })
+    for geometry_type, n_features, target_epsg, engine, profile in \
+            itertools.product(
+                args.geometry_types, args.vector_features,
+                [None, REPROJECTED_EPSG], args.vector_engines,
+                args.gdal_profiles):
+        source = _source_path(
+            args.data_dir, 'vector', n_features, geometry_type)
+        scenarios.append({
+            'name': f"vector {n_features} {geometry_type}s {engine}"
+                    f"{' reprojected' if target_epsg else ''}"
+                    f"{profile_suffixes[profile]}",
+            'layer_type': 'vector',
+            'source': source,
+            'engine': engine,
+            'gdal_profile': profile,
+            'target_epsg': target_epsg,
+        })
+    return scenarios
+
+
+def _work_units(scenario, source_path, bbox):
+    """Get the number of output pixels, or of source features in the bbox."""
+    if scenario['layer_type'] == 'raster':
+        cellsize = scenario['target_cellsize']
+        if scenario['target_epsg'] is not None:
+            bbox = [coord * _METERS_PER_DEGREE for coord in bbox]
+        return int(abs((bbox[2] - bbox[0]) / cellsize[0]) *
+                   abs((bbox[3] - bbox[1]) / cellsize[1]))
+    vector = gdal.OpenEx(source_path, gdal.OF_VECTOR)
+    layer = vector.GetLayer()
+    layer.SetSpatialFilterRect(*bbox)
+    return layer.GetFeatureCount()
+
+
+def _run_scenario(scenario, server_url, bbox, repeat):
+    """Run a scenario's clips through app.py.  Runs in a new process.
+
+    Returns:
+        A dict of the best time in ``seconds``, the size of the clipped file
+        in ``output_bytes`` and the ``peak_rss_bytes`` of the process.
+    """
+    workspace = tempfile.mkdtemp(prefix='bench-')
+    bucket_dir = os.path.join(workspace, 'bucket')
+    # The service reads its configuration when it's imported.
+    os.environ.update({
+        'WORKSPACE_DIR': workspace,
+        'UPLOAD_TARGET': f'file://{bucket_dir}',
+        'RESULT_CACHE_BACKEND': 'none',
+        'SINGLE_FLIGHT_URL': 'none://',
+        'RASTER_CLIP_ENGINE': scenario['engine'],
+        'VECTOR_CLIP_ENGINE': scenario['engine'],
+        'GDAL_PROFILE': scenario['gdal_profile'],
+        'CLIP_MAX_PIXELS': str(10**12),
+        'CLIP_MAX_FEATURES': str(10**9),
+        'CLIP_MAX_BYTES': str(1024**4),
+    })
+    import app as clipping_app
+    # The range server stands in for the trusted hosts.
+    clipping_app.TRUSTED_URL_PREFIXES = (f'{server_url}/',)
+    client = clipping_app.app.test_client()
+
+    parameters = {
+        'file_url': f"{server_url}/{scenario['source']}",
+        'layer_type': scenario['layer_type'],
+        'target_bbox': bbox,
+    }
+    if scenario['target_epsg'] is not None:
+        parameters['target_epsg'] = scenario['target_epsg']
+    if scenario.get('target_cellsize') is not None:
+        parameters['target_cellsize'] = scenario['target_cellsize']
+
+    timings = []
+    output_bytes = None
+    try:
+        for _ in range(repeat):
+            # Start each run cold, as a new source would be.
+            gdal.VSICurlClearCache()
+            start = time.perf_counter()
+            response = client.post('/clip', json=parameters)
+            timings.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                raise RuntimeError(f"{scenario['name']} failed: "
+                                   f"{response.get_data(as_text=True)}")
+            object_name = response.get_json()['url'].rsplit('/', 1)[-1]
+            output_bytes = os.path.getsize(os.path.join(
+                bucket_dir, clipping_app.TARGET_BUCKET_SUBDIR, object_name))
+    finally:
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    return {
+        'seconds': min(timings),
+        'output_bytes': output_bytes,
+        # ru_maxrss is in KiB on Linux.
+        'peak_rss_bytes': resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }
+
+
+def run(scenarios, data_dir, bbox, latency=0.0, repeat=3):
+    """Run scenarios and print a row of results for each.
+
+    Args:
+        scenarios (list): as returned by ``_scenarios``.
+        data_dir (str): the directory of the sources.
+        bbox (list): the bounding box to clip to.
+        latency=0.0 (float): seconds the range server adds to every request.
+        repeat=3 (int): the number of runs per scenario; the best is
+            reported.
+
+    Returns:
+        A list of the scenarios with their results.
+    """
+    results = []
+    print(f"{'scenario':<56} {'seconds':>8} {'units/s':>12} "
+          f"{'output MiB':>10} {'peak MiB':>9}")
+    with range_server.RangeServer(data_dir, latency=latency) as server:
+        server_url = server.url('').rstrip('/')
+        for scenario in scenarios:
+            units = _work_units(
+                scenario, os.path.join(data_dir, scenario['source']), bbox)
+            # A process per scenario, so that the peak memory is its own.
+            with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=1,
+                    mp_context=multiprocessing.get_context('spawn')) as pool:
+                result = pool.submit(
+                    _run_scenario, scenario, server_url, bbox,
+                    repeat).result()
+            result.update(scenario, units=units,
+                          units_per_second=units / result['seconds'])
+            results.append(result)
+            print(f"{scenario['name']:<56} {result['seconds']:8.3f} "
+                  f"{result['units_per_second']:12.0f} "
+                  f"{result['output_bytes'] / 1024**2:10.1f} "
+                  f"{result['peak_rss_bytes'] / 1024**2:9.0f}", flush=True)
+    return results
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(__file__),
+        description="Benchmark clips through the clipping service.")
+    parser.add_argument('--data-dir', default=os.path.join(
+        tempfile.gettempdir(), 'clipping-benchmarks'), help=(
+            "Where synthetic sources are kept between runs."))
+    parser.add_argument('--raster-sizes', type=int, nargs='*',
+                        default=[4096, 16384], help=(
+                            "The widths and heights of the synthetic COGs, "
+                            "in pixels."))
+    parser.add_argument('--vector-features', type=int, nargs='*',
+                        default=[10000, 1000000], help=(
+                            "The numbers of features of the synthetic "
+                            "FlatGeobufs."))
+    parser.add_argument('--geometry-types', nargs='+',
+                        default=list(synthetic.GEOMETRY_TYPES))
+    parser.add_argument('--raster-engines', nargs='+',
+                        default=RASTER_ENGINES)
+    parser.add_argument('--vector-engines', nargs='+',
+                        default=VECTOR_ENGINES)
+    parser.add_argument('--gdal-profiles', nargs='+',
+                        default=['remote-cog'], help=(
+                            "The GDAL profiles to clip with; see "
+                            "app/gdal_profile.py."))
+    parser.add_argument('--bbox', type=float, nargs=4,
+                        default=[-90, -45, 90, 45], help=(
+                            "The bounding box to clip to."))
+    parser.add_argument('--latency', type=float, default=0.0, help=(
+        "Seconds the range server adds to every request."))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--quick', action='store_true', help=(
+        "Run small scenarios once, e.g. to check the setup."))
+    parser.add_argument('--json', default=None, help=(
+        "Save the results to this JSON file."))
+    args = parser.parse_args(args)
+
+    if args.quick:
+        args.raster_sizes = [2048]
+        args.vector_features = [10000]
+        args.repeat = 1
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    results = run(_scenarios(args), args.data_dir, args.bbox,
+                  args.latency, args.repeat)
+    if args.json is not None:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""Compare the throughput of the vector clipping engines.
+
+Creates a synthetic FlatGeobuf (unless one is given) and clips it to a
+bounding box with each engine, reporting the wall time and the number of
+source features processed per second.
+
+    $ python clipping-service/benchmarks/bench_vector_clip.py --features 1000000
+
+Pass ``--epsg`` to compare reprojected clips, e.g. ``--epsg 3857``.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+from osgeo import gdal
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'app'))
+import synthetic  # noqa: E402
+import vector_clip  # noqa: E402
+
+gdal.UseExceptions()
+
+
+def _feature_count(path, bbox=None):
+    vector = gdal.OpenEx(path, gdal.OF_VECTOR)
+    layer = vector.GetLayer()
+    if bbox is not None:
+        layer.SetSpatialFilterRect(*bbox)
+    return layer.GetFeatureCount()
+
+
+def benchmark(source_path, bbox, engines, target_epsg=None, repeat=3):
+    """Clip ``source_path`` with each engine and print the timings.
+
+    Args:
+        source_path (str): path to the FlatGeobuf to clip.
+        bbox (list): the bounding box to clip to.
+        engines (list): the names of the engines to run.
+        target_epsg=None (int): reproject to this EPSG code, if given.
+        repeat=3 (int): the number of runs per engine; the best is reported.
+
+    Returns:
+        A dict mapping engine names to their best time in seconds.
+    """
+    target_projection_wkt = None
+    if target_epsg is not None:
+        target_projection_wkt = synthetic._srs(target_epsg).ExportToWkt()
+
+    n_features = _feature_count(source_path, bbox)
+    print(f"{n_features} features in the bounding box of {source_path}")
+
+    results = {}
+    with tempfile.TemporaryDirectory() as workspace:
+        for engine in engines:
+            timings = []
+            for run in range(repeat):
+                target_path = os.path.join(workspace, f'{engine}-{run}.fgb')
+                start = time.perf_counter()
+                vector_clip.clip_vector_to_bounding_box(
+                    source_path, bbox, target_path, target_projection_wkt,
+                    engine=engine)
+                timings.append(time.perf_counter() - start)
+                n_kept = _feature_count(target_path)
+            best = min(timings)
+            results[engine] = best
+            print(f"{engine:>12}: {best:8.3f} s  "
+                  f"{n_features / best:12.0f} features/s  "
+                  f"({n_kept} kept)")
+
+    if len(results) > 1:
+        baseline = results[engines[0]]
+        for engine in engines[1:]:
+            print(f"{engine} is {baseline / results[engine]:.1f}x as fast as "
+                  f"{engines[0]}")
+    return results
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(__file__),
+        description="Benchmark the vector clipping engines.")
+    parser.add_argument('--source', default=None, help=(
+        "A FlatGeobuf to clip.  A synthetic one is created if not given."))
+    parser.add_argument('--features', type=int, default=100000, help=(
+        "The number of features in the synthetic FlatGeobuf."))
+    parser.add_argument('--bbox', type=float, nargs=4,
+                        default=[-90, -45, 90, 45], help=(
+                            "The bounding box to clip to."))
+    parser.add_argument('--epsg', type=int, default=None, help=(
+        "Reproject the clipped features to this EPSG code."))
+    parser.add_argument('--engines', nargs='+',
+                        default=[vector_clip.PER_FEATURE, vector_clip.BATCHED],
+                        help="The engines to compare.")
+    parser.add_argument('--processes', type=int, default=None, help=(
+        "Clip by spatial partitions with this many processes in the batched "
+        "engine, regardless of the number of features."))
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args(args)
+
+    if args.processes is not None:
+        vector_clip.VECTOR_CLIP_PROCESSES = args.processes
+        vector_clip.PARTITION_MIN_FEATURES = 0
+
+    with tempfile.TemporaryDirectory() as workspace:
+        source_path = args.source
+        if source_path is None:
+            source_path = os.path.join(workspace, 'synthetic.fgb')
+            print(f"Creating {args.features} synthetic features...")
+            synthetic.make_flatgeobuf(source_path, args.features)
+        benchmark(source_path, args.bbox, args.engines, args.epsg,
+                  args.repeat)
+
+
+if __name__ == '__main__':
+    main()
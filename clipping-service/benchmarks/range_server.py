@@ -0,0 +1,135 @@
+"""A local HTTP server that supports byte range requests.
+
+GDAL reads remote rasters through ``/vsicurl/`` with range requests, which
+Python's ``http.server`` doesn't support.  This serves a directory with
+``Range`` support, optionally adding a fixed latency to every request to
+mimic a remote bucket.
+
+    $ python clipping-service/benchmarks/range_server.py /tmp/data --port 8765
+"""
+import argparse
+import functools
+import http.server
+import os
+import re
+import threading
+import time
+
+_RANGE_PATTERN = re.compile(r'bytes=(\d*)-(\d*)$')
+
+
+class RangeRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """Serves files, honouring single ``bytes=start-end`` ranges."""
+
+    # Seconds added to every request.
+    latency = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_head(self):
+        if self.latency:
+            time.sleep(self.latency)
+        match = _RANGE_PATTERN.match(self.headers.get('Range', ''))
+        path = self.translate_path(self.path)
+        if match is None or not os.path.isfile(path):
+            return super().send_head()
+
+        file_size = os.path.getsize(path)
+        start, end = match.groups()
+        if start:
+            start = int(start)
+            end = min(int(end), file_size - 1) if end else file_size - 1
+        else:
+            # A suffix range: the last ``end`` bytes.
+            start = max(0, file_size - int(end))
+            end = file_size - 1
+        if start >= file_size or start > end:
+            self.send_error(416, "Requested range not satisfiable")
+            return None
+
+        source = open(path, 'rb')
+        source.seek(start)
+        self.send_response(206)
+        self.send_header('Content-Type', self.guess_type(path))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Range', f'bytes {start}-{end}/{file_size}')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Last-Modified',
+                         self.date_time_string(os.path.getmtime(path)))
+        self.end_headers()
+        self._remaining = end - start + 1
+        return source
+
+    def copyfile(self, source, outputfile):
+        remaining = getattr(self, '_remaining', None)
+        if remaining is None:
+            return super().copyfile(source, outputfile)
+        while remaining > 0:
+            chunk = source.read(min(remaining, 64 * 1024))
+            if not chunk:
+                break
+            outputfile.write(chunk)
+            remaining -= len(chunk)
+        self._remaining = None
+
+
+class RangeServer:
+    """Serve a directory on localhost in a background thread.
+
+    Use as a context manager::
+
+        with RangeServer(directory) as server:
+            url = server.url('raster.tif')
+
+    Args:
+        directory (str): the directory to serve.
+        port=0 (int): the port; 0 picks a free one.
+        latency=0.0 (float): seconds added to every request.
+    """
+
+    def __init__(self, directory, port=0, latency=0.0):
+        handler = type('Handler', (RangeRequestHandler,), {
+            'latency': latency})
+        self._server = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', port),
+            functools.partial(handler, directory=directory))
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, daemon=True)
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def url(self, filename):
+        return f'http://127.0.0.1:{self.port}/{filename}'
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(__file__),
+        description="Serve a directory with HTTP range request support.")
+    parser.add_argument('directory')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0, help=(
+        "Seconds added to every request."))
+    args = parser.parse_args(args)
+
+    with RangeServer(args.directory, args.port, args.latency) as server:
+        print(f"Serving {args.directory} at http://127.0.0.1:{server.port}/")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+"""Generators of synthetic data for the clipping service benchmarks.
+
+The data are random but reproducible for a given seed, so results of
+different engines can be compared.
+"""
+import numpy
+import pyarrow
+import shapely
+from osgeo import gdal
+from osgeo import ogr
+from osgeo import osr
+
+# A world-spanning extent in EPSG:4326.
+WORLD_BBOX = [-180, -90, 180, 90]
+
+
+def _srs(epsg_code):
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(epsg_code)
+    srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return srs
+
+
+POINT = 'point'
+LINE = 'line'
+POLYGON = 'polygon'
+GEOMETRY_TYPES = {
+    POINT: ogr.wkbPoint,
+    LINE: ogr.wkbLineString,
+    POLYGON: ogr.wkbPolygon,
+}
+
+# Features are written in batches of this many, each with one WritePyArrow
+# call.
+_BATCH_SIZE = 100000
+
+
+def _geometries(rng, n_features, geometry_type, bbox, invalid_fraction):
+    """Create random geometries of a type, as an array of WKB."""
+    size = (bbox[2] - bbox[0]) / 1000
+    xs = rng.uniform(bbox[0], bbox[2] - size, n_features)
+    ys = rng.uniform(bbox[1], bbox[3] - size, n_features)
+    if geometry_type == POINT:
+        geometries = shapely.points(xs, ys)
+    elif geometry_type == LINE:
+        # Short random walks of 8 vertices.
+        steps = rng.uniform(0, size / 8, (n_features, 7, 2))
+        coords = numpy.concatenate([
+            numpy.column_stack([xs, ys])[:, numpy.newaxis, :],
+            numpy.column_stack([xs, ys])[:, numpy.newaxis, :] +
+            numpy.cumsum(steps, axis=1)], axis=1)
+        geometries = shapely.linestrings(coords)
+    elif geometry_type == POLYGON:
+        # Small squares; a fraction of them are self-intersecting
+        # "bowties", which are not valid.
+        invalid = rng.random(n_features) < invalid_fraction
+        corners = numpy.array([[0, 0], [1, 0], [1, 1], [0, 1], [0, 0]])
+        bowtie_corners = numpy.array([[0, 0], [1, 1], [1, 0], [0, 1], [0, 0]])
+        offsets = numpy.where(
+            invalid[:, numpy.newaxis, numpy.newaxis], bowtie_corners, corners)
+        coords = (numpy.column_stack([xs, ys])[:, numpy.newaxis, :] +
+                  offsets * size)
+        geometries = shapely.polygons(coords)
+    else:
+        raise ValueError(f"Unknown geometry type: {geometry_type}")
+    return shapely.to_wkb(geometries)
+
+
+def make_flatgeobuf(path, n_features, invalid_fraction=0.001, seed=0,
+                    bbox=WORLD_BBOX, epsg_code=4326, geometry_type=POLYGON):
+    """Create a FlatGeobuf of small random features.
+
+    Needs GDAL >= 3.8 and pyarrow, like the batched vector engine.  For
+    polygons, a fraction of the features are self-intersecting "bowties",
+    which are not valid and are skipped by the clipping engines.
+
+    Args:
+        path (str): where to write the FlatGeobuf.
+        n_features (int): the number of features.
+        invalid_fraction=0.001 (float): the fraction of invalid polygons.
+        seed=0 (int): the random seed.
+        bbox=WORLD_BBOX (list): the extent of the features, as
+            [xmin, ymin, xmax, ymax].
+        epsg_code=4326 (int): the projection of the features.
+        geometry_type='polygon' (str): ``point``, ``line`` or ``polygon``.
+
+    Returns:
+        None
+    """
+    rng = numpy.random.default_rng(seed)
+    vector = gdal.GetDriverByName('FlatGeobuf').Create(
+        path, 0, 0, 0, gdal.GDT_Unknown)
+    layer = vector.CreateLayer(
+        'synthetic', _srs(epsg_code), GEOMETRY_TYPES[geometry_type])
+    layer.CreateField(ogr.FieldDefn('id', ogr.OFTInteger64))
+    layer.CreateField(ogr.FieldDefn('value', ogr.OFTReal))
+    layer.CreateField(ogr.FieldDefn('label', ogr.OFTString))
+    geometry_column = layer.GetGeometryColumn() or 'wkb_geometry'
+
+    layer.StartTransaction()
+    for batch_start in range(0, n_features, _BATCH_SIZE):
+        n_batch = min(_BATCH_SIZE, n_features - batch_start)
+        wkb_geometries = _geometries(
+            rng, n_batch, geometry_type, bbox, invalid_fraction)
+        ids = numpy.arange(batch_start, batch_start + n_batch)
+        batch = pyarrow.record_batch({
+            'id': pyarrow.array(ids, type=pyarrow.int64()),
+            'value': pyarrow.array(rng.random(n_batch)),
+            'label': pyarrow.array(
+                [f'feature {fid}' for fid in ids.tolist()]),
+            geometry_column: pyarrow.array(
+                wkb_geometries, type=pyarrow.binary()),
+        })
+        layer.WritePyArrow(
+            batch, options=[f'GEOMETRY_NAME={geometry_column}'])
+    layer.CommitTransaction()
+
+    layer = None
+    vector = None
+
+
+def make_cog(path, size=8192, n_bands=1, seed=0, bbox=WORLD_BBOX,
+             epsg_code=4326, overviews=True):
+    """Create a Cloud Optimized GeoTIFF of smooth random noise.
+
+    Args:
+        path (str): where to write the COG.
+        size=8192 (int): the width and height of the raster, in pixels.
+        n_bands=1 (int): the number of bands.
+        seed=0 (int): the random seed.
+        bbox=WORLD_BBOX (list): the extent of the raster, as
+            [xmin, ymin, xmax, ymax].
+        epsg_code=4326 (int): the projection of the raster.
+        overviews=True (bool): whether to build overviews.
+
+    Returns:
+        None
+    """
+    rng = numpy.random.default_rng(seed)
+    # Written through a temporary GeoTIFF, since the COG driver can only
+    # copy an existing raster.
+    scratch_path = f'{path}.scratch.tif'
+    raster = gdal.GetDriverByName('GTiff').Create(
+        scratch_path, size, size, n_bands, gdal.GDT_Float32,
+        options=['TILED=YES', 'BIGTIFF=IF_SAFER'])
+    raster.SetGeoTransform([
+        bbox[0], (bbox[2] - bbox[0]) / size, 0,
+        bbox[3], 0, -(bbox[3] - bbox[1]) / size])
+    raster.SetProjection(_srs(epsg_code).ExportToWkt())
+    block_rows = 512
+    for band_index in range(1, n_bands + 1):
+        band = raster.GetRasterBand(band_index)
+        band.SetNoDataValue(-9999)
+        for row in range(0, size, block_rows):
+            n_rows = min(block_rows, size - row)
+            values = numpy.cumsum(
+                rng.normal(size=(n_rows, size)), axis=1, dtype=numpy.float32)
+            band.WriteArray(values, 0, row)
+    raster = None
+
+    gdal.Translate(path, scratch_path, options=gdal.TranslateOptions(
+        format='COG', creationOptions=[
+            'COMPRESS=DEFLATE', 'BIGTIFF=IF_SAFER',
+            f"OVERVIEWS={'AUTO' if overviews else 'NONE'}"]))
+    gdal.Unlink(scratch_path)
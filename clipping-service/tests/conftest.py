@@ -0,0 +1,10 @@
+"""Shared test setup.
+
+The service's modules import each other by name from ``app/``, as they do
+when gunicorn runs them from that directory.
+"""
+import os
+import sys
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.dirname(__file__)), 'app'))
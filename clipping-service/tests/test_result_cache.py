@@ -0,0 +1,136 @@
+"""Tests for result_cache.py, against a FilesystemBucket."""
+import pytest
+
+import result_cache
+import upload
+
+MAX_AGE = 100
+URL_LIFETIME = 50
+
+
+class Clock:
+    """Stands in for the ``time`` module of result_cache."""
+
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(result_cache, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def bucket(tmp_path):
+    return upload.FilesystemBucket(str(tmp_path / 'bucket'))
+
+
+@pytest.fixture(params=['local', 'gcs'])
+def cache(request, tmp_path, bucket, clock):
+    cache = result_cache.get_result_cache(
+        request.param, bucket, str(tmp_path), 'result-cache', MAX_AGE,
+        max_bytes=1000, url_lifetime=URL_LIFETIME)
+    # Only evict when a test asks to.
+    cache._last_eviction = clock.now
+    return cache
+
+
+def _put_clip(cache, bucket, key, nbytes=10):
+    object_name = f'clips/{key}.tif'
+    bucket.blob(object_name).upload_from_string(b'x' * nbytes)
+    cache.put(key, f'https://example.com/{object_name}', object_name,
+              nbytes, f'{nbytes} Bytes')
+    return object_name
+
+
+def test_get_put(cache, bucket):
+    assert cache.get('a') is None
+    object_name = _put_clip(cache, bucket, 'a')
+
+    entry = cache.get('a')
+    assert entry['url'] == f'https://example.com/{object_name}'
+    assert entry['object_name'] == object_name
+    assert entry['nbytes'] == 10
+    assert cache.get('b') is None
+
+
+def test_get_expired(cache, bucket, clock):
+    _put_clip(cache, bucket, 'a')
+    clock.now += MAX_AGE - 1
+    assert cache.get('a') is not None
+    clock.now += 2
+    assert cache.get('a') is None
+
+
+def test_get_drops_entry_of_deleted_object(cache, bucket):
+    object_name = _put_clip(cache, bucket, 'a')
+    bucket.blob(object_name).delete()
+
+    assert cache.get('a') is None
+    assert cache._get('a') is None
+
+
+def test_evict_deletes_unused_files(cache, bucket, clock):
+    object_name = _put_clip(cache, bucket, 'a')
+    clock.now += MAX_AGE + URL_LIFETIME + 1
+    cache.evict()
+
+    assert cache._get('a') is None
+    assert not bucket.blob(object_name).exists()
+
+
+def test_evict_keeps_files_whose_urls_may_be_in_use(cache, bucket, clock):
+    object_name = _put_clip(cache, bucket, 'a')
+    clock.now += MAX_AGE + 1
+    cache.evict()
+
+    assert cache.get('a') is None
+    assert bucket.blob(object_name).exists()
+
+
+def test_evict_over_size_drops_oldest_from_index(cache, bucket, clock):
+    object_names = []
+    for key in ('a', 'b', 'c'):
+        object_names.append(_put_clip(cache, bucket, key, nbytes=400))
+        clock.now += 1
+    cache.evict()
+
+    assert cache.get('a') is None
+    assert cache.get('b') is not None
+    assert cache.get('c') is not None
+    # Its URL may still be in use.
+    assert bucket.blob(object_names[0]).exists()
+
+
+def test_put_evicts_periodically(cache, bucket, clock):
+    object_name = _put_clip(cache, bucket, 'a')
+    clock.now += result_cache.EVICTION_PERIOD + MAX_AGE + URL_LIFETIME
+    _put_clip(cache, bucket, 'b')
+
+    assert cache._get('a') is None
+    assert not bucket.blob(object_name).exists()
+    assert cache.get('b') is not None
+
+
+def test_gcs_unreadable_entry_is_a_miss(bucket, clock):
+    cache = result_cache.GCSResultCache(
+        'result-cache', bucket, MAX_AGE, max_bytes=1000)
+    _put_clip(cache, bucket, 'a')
+    bucket.blob('result-cache/a.json').upload_from_string('not json')
+
+    assert cache.get('a') is None
+
+
+def test_gcs_entries_are_objects_under_the_prefix(bucket, clock):
+    cache = result_cache.GCSResultCache(
+        'result-cache/', bucket, MAX_AGE, max_bytes=1000)
+    _put_clip(cache, bucket, 'a')
+
+    assert [blob.name for blob in bucket.list_blobs('result-cache/')] == [
+        'result-cache/a.json']
+    assert [key for key, _ in cache._entries()] == ['a']
@@ -0,0 +1,185 @@
+"""Tests for upload.py, against a FilesystemBucket."""
+import os
+
+import pytest
+
+import upload
+
+CHUNK_SIZE = upload._CHUNK_ALIGNMENT
+
+
+@pytest.fixture(autouse=True)
+def small_chunks(monkeypatch):
+    monkeypatch.setattr(upload, 'CHUNK_SIZE', CHUNK_SIZE)
+    monkeypatch.setattr(upload, 'PARALLEL_THRESHOLD', 4 * CHUNK_SIZE)
+    monkeypatch.setattr(upload, 'UPLOAD_WORKERS', 4)
+    monkeypatch.setattr(upload, 'RETRY_DELAY', 0)
+
+
+@pytest.fixture
+def bucket(tmp_path):
+    return upload.FilesystemBucket(str(tmp_path / 'bucket'))
+
+
+def _make_file(tmp_path, nbytes):
+    path = str(tmp_path / f'{nbytes}.bin')
+    with open(path, 'wb') as local_file:
+        local_file.write(os.urandom(nbytes))
+    return path
+
+
+def _read(path):
+    with open(path, 'rb') as source:
+        return source.read()
+
+
+def _assert_uploaded(bucket, local_path, object_name):
+    assert _read(bucket.blob(object_name).path) == _read(local_path)
+    # No parts or session files are left behind.
+    assert [blob.name for blob in bucket.list_blobs()] == [object_name]
+
+
+def test_single_shot(tmp_path, bucket, monkeypatch):
+    def _no_session(*args, **kwargs):
+        raise AssertionError("Small files are uploaded in one request")
+    monkeypatch.setattr(upload.FilesystemBlob,
+                        'create_resumable_upload_session', _no_session)
+    local_path = _make_file(tmp_path, CHUNK_SIZE - 1)
+
+    result = upload.upload_file(bucket, local_path, 'clips/a.bin')
+
+    assert result['nbytes'] == CHUNK_SIZE - 1
+    assert result['parts'] == 1
+    _assert_uploaded(bucket, local_path, 'clips/a.bin')
+
+
+def test_resumable(tmp_path, bucket, monkeypatch):
+    offsets = []
+    send = upload._FilesystemUploadSession.send
+
+    def _send(session, data, offset):
+        offsets.append(offset)
+        return send(session, data, offset)
+    monkeypatch.setattr(upload._FilesystemUploadSession, 'send', _send)
+    local_path = _make_file(tmp_path, 3 * CHUNK_SIZE + 5)
+
+    result = upload.upload_file(bucket, local_path, 'clips/a.bin')
+
+    assert result['parts'] == 1
+    assert offsets == [0, CHUNK_SIZE, 2 * CHUNK_SIZE, 3 * CHUNK_SIZE]
+    _assert_uploaded(bucket, local_path, 'clips/a.bin')
+
+
+def test_composite(tmp_path, bucket):
+    local_path = _make_file(tmp_path, 6 * CHUNK_SIZE + 5)
+
+    result = upload.upload_file(bucket, local_path, 'clips/a.bin')
+
+    assert result['parts'] == 7
+    _assert_uploaded(bucket, local_path, 'clips/a.bin')
+
+
+@pytest.mark.parametrize('nbytes', [
+    CHUNK_SIZE - 1, 3 * CHUNK_SIZE, 6 * CHUNK_SIZE])
+def test_generation_precondition(tmp_path, bucket, nbytes):
+    bucket.blob('clips/a.bin').upload_from_string(b'existing')
+    local_path = _make_file(tmp_path, nbytes)
+
+    with pytest.raises(FileExistsError):
+        upload.upload_file(bucket, local_path, 'clips/a.bin')
+
+    assert _read(bucket.blob('clips/a.bin').path) == b'existing'
+
+
+def test_resumes_after_transient_failure(tmp_path, bucket, monkeypatch):
+    offsets = []
+    send = upload._FilesystemUploadSession.send
+
+    def _send(session, data, offset):
+        offsets.append(offset)
+        if len(offsets) == 3:
+            raise ConnectionError("Injected failure")
+        return send(session, data, offset)
+    monkeypatch.setattr(upload._FilesystemUploadSession, 'send', _send)
+    local_path = _make_file(tmp_path, 3 * CHUNK_SIZE + 5)
+
+    upload.upload_file(bucket, local_path, 'clips/a.bin')
+
+    # The failed chunk is sent again; the chunks before it aren't.
+    assert offsets == [0, CHUNK_SIZE, 2 * CHUNK_SIZE, 2 * CHUNK_SIZE,
+                       3 * CHUNK_SIZE]
+    _assert_uploaded(bucket, local_path, 'clips/a.bin')
+
+
+def test_resumes_after_lost_response(tmp_path, bucket, monkeypatch):
+    offsets = []
+    send = upload._FilesystemUploadSession.send
+
+    def _send(session, data, offset):
+        offsets.append(offset)
+        committed = send(session, data, offset)
+        if len(offsets) == 2:
+            raise ConnectionError("Injected lost response")
+        return committed
+    monkeypatch.setattr(upload._FilesystemUploadSession, 'send', _send)
+    local_path = _make_file(tmp_path, 3 * CHUNK_SIZE + 5)
+
+    upload.upload_file(bucket, local_path, 'clips/a.bin')
+
+    # The session had committed the chunk whose response was lost.
+    assert offsets == [0, CHUNK_SIZE, 2 * CHUNK_SIZE, 3 * CHUNK_SIZE]
+    _assert_uploaded(bucket, local_path, 'clips/a.bin')
+
+
+def test_gives_up_after_every_attempt(tmp_path, bucket, monkeypatch):
+    def _send(session, data, offset):
+        raise ConnectionError("Injected failure")
+    monkeypatch.setattr(upload._FilesystemUploadSession, 'send', _send)
+    local_path = _make_file(tmp_path, 3 * CHUNK_SIZE)
+
+    with pytest.raises(ConnectionError):
+        upload.upload_file(bucket, local_path, 'clips/a.bin')
+
+    assert not bucket.blob('clips/a.bin').exists()
+
+
+@pytest.mark.parametrize('writes_before_failing', [False, True])
+def test_single_shot_retries(tmp_path, bucket, monkeypatch,
+                             writes_before_failing):
+    calls = []
+    upload_from_filename = upload.FilesystemBlob.upload_from_filename
+
+    def _upload_from_filename(blob, *args, **kwargs):
+        calls.append(kwargs['if_generation_match'])
+        if len(calls) == 1:
+            if writes_before_failing:
+                upload_from_filename(blob, *args, **kwargs)
+            raise ConnectionError("Injected failure")
+        return upload_from_filename(blob, *args, **kwargs)
+    monkeypatch.setattr(upload.FilesystemBlob, 'upload_from_filename',
+                        _upload_from_filename)
+    local_path = _make_file(tmp_path, 100)
+
+    upload.upload_file(bucket, local_path, 'clips/a.bin')
+
+    # Every attempt keeps the precondition, so a retry can't overwrite.
+    assert calls == [0, 0]
+    _assert_uploaded(bucket, local_path, 'clips/a.bin')
+
+
+def test_composite_retries_compose(tmp_path, bucket, monkeypatch):
+    calls = []
+    compose = upload.FilesystemBlob.compose
+
+    def _compose(blob, *args, **kwargs):
+        calls.append(kwargs['if_generation_match'])
+        if len(calls) == 1:
+            raise ConnectionError("Injected failure")
+        return compose(blob, *args, **kwargs)
+    monkeypatch.setattr(upload.FilesystemBlob, 'compose', _compose)
+    local_path = _make_file(tmp_path, 6 * CHUNK_SIZE)
+
+    upload.upload_file(bucket, local_path, 'clips/a.bin')
+
+    assert calls == [0, 0]
+    _assert_uploaded(bucket, local_path, 'clips/a.bin')
@@ -5,6 +5,7 @@ app/dependencies.py
 """
 
 import json
+import os
 from typing import Dict
 from typing import Literal
 from typing import Optional
@@ -75,6 +76,18 @@ ALLOWED_PREFIXES = (
     'http://data.naturalcapitalproject.stanford.edu'
 )
 
+# Read datasets through the byte-range cache shared with the clipping
+# service (clipping-service/app/range_cache.py), if one is running.
+RANGE_CACHE_URL = os.environ.get('RANGE_CACHE_URL', '').rstrip('/')
+
+# The URLs the range cache proxies; others are read directly.  Keep this the
+# same as TRUSTED_URL_PREFIXES in clipping-service/app/remote.py.
+RANGE_CACHE_PREFIXES = (
+    'https://storage.googleapis.com/natcap-data-cache/',
+    'https://data.naturalcapitalalliance.stanford.edu/download/',
+    'https://data.naturalcapitalproject.stanford.edu/download/',
+)
+
 def DatasetPathParams(url: Annotated[str, Query(description="Dataset URL")]) -> str:
     """Create dataset path from args"""
     if not url.startswith(ALLOWED_PREFIXES):
@@ -82,4 +95,6 @@ def DatasetPathParams(url: Annotated[str, Query(description="Dataset URL")]) ->
             status_code=401,
             detail="Access denied; please use an allowed dataset URL."
         )
+    if RANGE_CACHE_URL and url.startswith(RANGE_CACHE_PREFIXES):
+        return f'{RANGE_CACHE_URL}/{url}'
     return url